@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+
+from synthetic import make_synthetic_inputs
+from tlm_sterodynamics.tlm_sterodynamics_preprocess_thermalexpansion import (
+    tlm_preprocess_thermalexpansion,
+)
+from tlm_sterodynamics.tlm_sterodynamics_preprocess_oceandynamics import (
+    tlm_preprocess_oceandynamics,
+)
+from tlm_sterodynamics.tlm_sterodynamics_fit_thermalexpansion import (
+    tlm_fit_thermalexpansion,
+)
+from tlm_sterodynamics.tlm_sterodynamics_fit_oceandynamics import tlm_fit_oceandynamics
+from tlm_sterodynamics.tlm_sterodynamics_project import tlm_project_thermalexpansion
+from tlm_sterodynamics.tlm_sterodynamics_postprocess import open_te_projections
+
+""" conftest.py
+
+Fixtures for the stage benchmarks. Synthetic inputs of a fixed size are written
+once per session, and each stage's inputs are made by running the stages before
+it once.
+
+"""
+
+# Fixed size of the benchmark inputs. Changing these changes every benchmark, so
+# results are only comparable between runs with the same sizes.
+BENCH_INPUTS = {
+    "nmodels": 6,
+    "nlat": 36,
+    "nlon": 72,
+    "nsamps": 2000,
+    "nlocations": 200,
+    "scenario": "ssp585",
+    "seed": 0,
+}
+
+# Run settings of the benchmarked stages
+BENCH_SETTINGS = {
+    "scenario": "ssp585",
+    "baseyear": 2005,
+    "pyear_start": 2020,
+    "pyear_end": 2300,
+    "pyear_step": 10,
+    "nsamps": 2000,
+    "seed": 1234,
+    "chunksize": 50,
+}
+
+
+@pytest.fixture(scope="session")
+def synthetic_inputs(tmp_path_factory):
+    return make_synthetic_inputs(
+        str(tmp_path_factory.mktemp("synthetic")), **BENCH_INPUTS
+    )
+
+
+@pytest.fixture(scope="session")
+def te_preprocessed(synthetic_inputs):
+    return tlm_preprocess_thermalexpansion(
+        BENCH_SETTINGS["scenario"],
+        "bench",
+        synthetic_inputs["climate_data_file"],
+        synthetic_inputs["expansion_coefficients_file"],
+        synthetic_inputs["gsat_rmses_file"],
+    )
+
+
+@pytest.fixture(scope="session")
+def od_preprocessed(synthetic_inputs):
+    return tlm_preprocess_oceandynamics(
+        BENCH_SETTINGS["scenario"],
+        synthetic_inputs["model_dir"],
+        True,
+        False,
+        BENCH_SETTINGS["pyear_start"],
+        BENCH_SETTINGS["pyear_end"],
+        BENCH_SETTINGS["pyear_step"],
+        synthetic_inputs["location_file"],
+        BENCH_SETTINGS["baseyear"],
+        "bench",
+    )
+
+
+@pytest.fixture(scope="session")
+def te_fit(te_preprocessed):
+    return tlm_fit_thermalexpansion(te_preprocessed)
+
+
+@pytest.fixture(scope="session")
+def od_fit(od_preprocessed):
+    (od_config, od_zostoga, od_zos) = od_preprocessed
+    (_, od_oceandynamics_fit) = tlm_fit_oceandynamics(
+        od_config, od_zostoga, od_zos, "bench"
+    )
+    return od_oceandynamics_fit
+
+
+@pytest.fixture(scope="session")
+def te_projections(te_preprocessed, te_fit, tmp_path_factory):
+    # Samples are localized from the global SLR file, as in a run
+    gslr_file = str(tmp_path_factory.mktemp("projection") / "gslr.nc")
+    projections = tlm_project_thermalexpansion(
+        te_preprocessed,
+        te_fit,
+        BENCH_SETTINGS["seed"],
+        BENCH_SETTINGS["nsamps"],
+        "bench",
+        BENCH_SETTINGS["scenario"],
+        BENCH_SETTINGS["pyear_start"],
+        BENCH_SETTINGS["pyear_end"],
+        BENCH_SETTINGS["pyear_step"],
+        BENCH_SETTINGS["baseyear"],
+        gslr_file,
+    )
+    return open_te_projections(
+        gslr_file, BENCH_SETTINGS["nsamps"], projections["targyears"]
+    )
+
+
+@pytest.fixture(scope="session")
+def model_grid():
+    """Latitudes and longitudes of a 1 degree model grid, as the IDW functions use"""
+    lats = np.linspace(-89.5, 89.5, 180)
+    lons = np.linspace(0.5, 359.5, 360)
+    return (np.tile(lats, (len(lons), 1)), np.tile(lons, (len(lats), 1)).T)
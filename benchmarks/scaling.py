@@ -0,0 +1,293 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+from synthetic import make_synthetic_inputs
+
+""" scaling.py
+
+Runs the full tlm-sterodynamics pipeline on synthetic inputs across a grid of
+sample, location, and model counts and --chunksize, and reports throughput in
+location-samples per second and the peak memory of each run. Results can be
+saved as a baseline and later runs compared against it, failing if throughput
+drops or peak memory grows by more than a tolerance.
+
+Each run is a separate process writing a --metrics-file report, so peak memory
+is measured per run.
+
+Parameters:
+nsamps = Comma-separated numbers of samples
+nlocations = Comma-separated numbers of locations
+nmodels = Comma-separated numbers of CMIP6 models
+chunksize = Comma-separated numbers of locations processed at a time
+baseline = JSON file of baseline results to compare against or save to
+throughput_tolerance = Allowed fractional drop in throughput
+memory_tolerance = Allowed fractional growth in peak memory
+
+Baselines depend on the machine, so save and compare them on the same machine,
+i.e. save on the main branch and compare on a feature branch.
+
+"""
+
+# Size of the synthetic model grid. Runs read every model file, so a coarse
+# grid keeps the harness quick.
+GRID = (36, 72)
+
+# Throughputs compared against the baseline, in location-samples per second
+THROUGHPUTS = ("throughput", "postprocess_throughput")
+
+
+def case_name(nsamps, nlocations, nmodels, chunksize):
+    return "s{}-l{}-m{}-c{}".format(nsamps, nlocations, nmodels, chunksize)
+
+
+def write_location_subset(location_file, nlocations, path):
+    """Write the first ``nlocations`` locations of ``location_file`` to ``path``"""
+    with open(location_file) as f:
+        lines = [next(f) for _ in range(nlocations)]
+    with open(path, "w") as f:
+        f.writelines(lines)
+
+
+def run_case(inputs, location_file, nsamps, chunksize, workdir, scheduler):
+    """Run the pipeline once and return its metrics report"""
+    metrics_file = os.path.join(workdir, "metrics.json")
+    args = [
+        "--pipeline-id=scaling",
+        "--scenario=ssp585",
+        "--nsamps={}".format(nsamps),
+        "--chunksize={}".format(chunksize),
+        "--scheduler={}".format(scheduler),
+        "--climate-data-file={}".format(inputs["climate_data_file"]),
+        "--expansion-coefficients-file={}".format(
+            inputs["expansion_coefficients_file"]
+        ),
+        "--gsat-rmses-file={}".format(inputs["gsat_rmses_file"]),
+        "--model-dir={}".format(inputs["model_dir"]),
+        "--location-file={}".format(location_file),
+        "--output-gslr-file={}".format(os.path.join(workdir, "gslr.nc")),
+        "--output-lslr-file={}".format(os.path.join(workdir, "lslr.nc")),
+        "--metrics-file={}".format(metrics_file),
+    ]
+    run = subprocess.run(
+        [sys.executable, "-c", "from tlm_sterodynamics.cli import main; main()", *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if run.returncode != 0:
+        raise RuntimeError("tlm-sterodynamics failed:\n" + run.stderr)
+    with open(metrics_file) as f:
+        return json.load(f)
+
+
+def summarize(report, nsamps, nlocations):
+    """Throughput and peak memory of a run from its metrics report"""
+    stages = {stage["stage"]: stage for stage in report["stages"]}
+    location_samples = nsamps * nlocations
+    wall = report["total"]["wall_seconds"]
+    postprocess_wall = stages["postprocess_oceandynamics"]["wall_seconds"]
+    return {
+        "wall_seconds": wall,
+        "throughput": location_samples / wall,
+        "postprocess_throughput": location_samples / postprocess_wall,
+        "peak_rss_bytes": report["total"]["peak_rss_bytes"],
+        "stage_seconds": {
+            name: stage["wall_seconds"] for name, stage in stages.items()
+        },
+    }
+
+
+def best_of(results):
+    """Best throughputs and lowest peak memory of repeated runs"""
+    best = dict(min(results, key=lambda r: r["wall_seconds"]))
+    for key in THROUGHPUTS:
+        best[key] = max(r[key] for r in results)
+    best["peak_rss_bytes"] = min(r["peak_rss_bytes"] for r in results)
+    return best
+
+
+def compare(results, baseline, throughput_tolerance, memory_tolerance):
+    """Messages describing each regression from the baseline"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        for key in THROUGHPUTS:
+            if result[key] < base[key] * (1 - throughput_tolerance):
+                regressions.append(
+                    "{}: {} dropped {:.0%} to {:.3g} location-samples/s".format(
+                        name, key, 1 - result[key] / base[key], result[key]
+                    )
+                )
+        if result["peak_rss_bytes"] > base["peak_rss_bytes"] * (1 + memory_tolerance):
+            regressions.append(
+                "{}: peak memory grew {:.0%} to {:.1f} MiB".format(
+                    name,
+                    result["peak_rss_bytes"] / base["peak_rss_bytes"] - 1,
+                    result["peak_rss_bytes"] / 2**20,
+                )
+            )
+    return regressions
+
+
+def machine():
+    return {
+        "node": platform.node(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_grid(
+    nsamps_list,
+    nlocations_list,
+    nmodels_list,
+    chunksize_list,
+    workdir,
+    repeat=1,
+    scheduler="threads",
+):
+    """Run every case of the grid and return results keyed by case name"""
+    results = {}
+    for nmodels in nmodels_list:
+        # One set of inputs per model count, large enough for every case
+        inputs = make_synthetic_inputs(
+            os.path.join(workdir, "inputs_m{}".format(nmodels)),
+            nmodels=nmodels,
+            nlat=GRID[0],
+            nlon=GRID[1],
+            nsamps=max(nsamps_list),
+            nlocations=max(nlocations_list),
+        )
+        for nlocations in nlocations_list:
+            location_file = os.path.join(
+                workdir, "locations_m{}_l{}.lst".format(nmodels, nlocations)
+            )
+            write_location_subset(inputs["location_file"], nlocations, location_file)
+            for nsamps, chunksize in itertools.product(nsamps_list, chunksize_list):
+                name = case_name(nsamps, nlocations, nmodels, chunksize)
+                runs = []
+                for _ in range(repeat):
+                    report = run_case(
+                        inputs, location_file, nsamps, chunksize, workdir, scheduler
+                    )
+                    runs.append(summarize(report, nsamps, nlocations))
+                results[name] = best_of(runs)
+                print(
+                    "{:<28} {:>10.3g} loc-samp/s {:>10.3g} postprocess loc-samp/s {:>8.1f} MiB".format(
+                        name,
+                        results[name]["throughput"],
+                        results[name]["postprocess_throughput"],
+                        results[name]["peak_rss_bytes"] / 2**20,
+                    ),
+                    flush=True,
+                )
+    return results
+
+
+def _int_list(value):
+    return [int(x) for x in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run tlm-sterodynamics across a grid of problem sizes and compare throughput and peak memory to a baseline",
+    )
+    parser.add_argument("--nsamps", type=_int_list, default=[500, 2000])
+    parser.add_argument("--nlocations", type=_int_list, default=[50, 200])
+    parser.add_argument("--nmodels", type=_int_list, default=[6])
+    parser.add_argument("--chunksize", type=_int_list, default=[50])
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Runs of each case, keeping the best [default=1]",
+    )
+    parser.add_argument(
+        "--scheduler",
+        default="threads",
+        help="Dask scheduler of the runs [default=threads]",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=os.path.join(os.path.dirname(__file__), "scaling_baseline.json"),
+        help="JSON file of baseline results [default=benchmarks/scaling_baseline.json]",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Save results as the baseline instead of comparing against it",
+    )
+    parser.add_argument(
+        "--throughput-tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed fractional drop in throughput [default=0.2]",
+    )
+    parser.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed fractional growth in peak memory [default=0.2]",
+    )
+    parser.add_argument("--output", help="Also write results to this JSON file")
+    parser.add_argument("--workdir", help="Directory for inputs and outputs")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        results = run_grid(
+            args.nsamps,
+            args.nlocations,
+            args.nmodels,
+            args.chunksize,
+            workdir,
+            repeat=args.repeat,
+            scheduler=args.scheduler,
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"machine": machine(), "results": results}, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"machine": machine(), "results": results}, f, indent=2)
+        print("Saved baseline to {}".format(args.baseline))
+        sys.exit()
+
+    if not os.path.isfile(args.baseline):
+        print("No baseline at {}, run with --save-baseline first".format(args.baseline))
+        sys.exit()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["machine"] != machine():
+        print(
+            "Warning: baseline was saved on a different machine {}".format(
+                baseline["machine"]
+            )
+        )
+    missing = sorted(set(results) - set(baseline["results"]))
+    if missing:
+        print("No baseline for {}".format(", ".join(missing)))
+
+    regressions = compare(
+        results,
+        baseline["results"],
+        args.throughput_tolerance,
+        args.memory_tolerance,
+    )
+    if regressions:
+        print("Regressions against {}:".format(args.baseline))
+        for message in regressions:
+            print("  " + message)
+        sys.exit(1)
+    print("No regressions against {}".format(args.baseline))
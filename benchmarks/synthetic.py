@@ -0,0 +1,254 @@
+import argparse
+import os
+
+import h5py
+import numpy as np
+from netCDF4 import Dataset
+
+""" synthetic.py
+
+Writes synthetic inputs for tlm-sterodynamics with the layout, variables, and
+shapes of the real inputs, so stages can be benchmarked without downloading the
+CMIP6 and FaIR data. Values are smooth trends plus noise, so they only exercise
+the code and are not physically meaningful.
+
+Writes under 'root':
+climate.h5       = FaIR-style two-layer model samples, a group per scenario with
+                   'surface_temperature' and 'ocean_heat_content' (years, samples)
+expcoefs.nc      = Thermal expansion coefficient of each model
+rmses.nc         = GSAT RMSE of each model
+location.lst     = Tab-separated name, id, lat, and lon of ocean locations
+cmip6/tas        = Monthly global mean 'tas' of each model
+cmip6/zos        = Monthly 'zos' (time, lat, lon) of each model, masked over land
+cmip6/zostoga    = Monthly 'zostoga' of each model
+
+Parameters:
+root = Directory to write inputs to
+nmodels = Number of CMIP6 models
+nlat, nlon = Size of the model grid. 180 x 360 is the usual 1 degree grid.
+nsamps = Number of two-layer model samples
+nlocations = Number of locations in the location file
+scenario = SSP scenario of the model runs and climate samples
+hist_years, ssp_years = First and last years of the historical and SSP runs
+seed = Seed of the random number generator
+
+"""
+
+# Years of the two-layer model samples
+CLIMATE_YEARS = (1750, 2300)
+
+# Write monthly 'zos' this many years at a time to bound memory
+ZOS_WRITE_YEARS = 10
+
+
+def make_synthetic_inputs(
+    root,
+    nmodels=6,
+    nlat=180,
+    nlon=360,
+    nsamps=2237,
+    nlocations=1000,
+    scenario="ssp585",
+    hist_years=(1850, 2014),
+    ssp_years=(2015, 2300),
+    seed=0,
+):
+    """
+    Write synthetic inputs under ``root``.
+
+    Returns a dict of the input paths, keyed by the name of the matching
+    ``tlm_sterodynamics.cli.main`` argument.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(root, exist_ok=True)
+    models = ["SYN-{:02d}".format(i) for i in range(nmodels)]
+
+    lats = np.linspace(-90 + 90 / nlat, 90 - 90 / nlat, nlat)
+    lons = np.linspace(180 / nlon, 360 - 180 / nlon, nlon)
+    ocean = _ocean_mask(lats, lons)
+
+    paths = {
+        "climate_data_file": os.path.join(root, "climate.h5"),
+        "expansion_coefficients_file": os.path.join(root, "expcoefs.nc"),
+        "gsat_rmses_file": os.path.join(root, "rmses.nc"),
+        "location_file": os.path.join(root, "location.lst"),
+        "model_dir": os.path.join(root, "cmip6"),
+    }
+
+    _write_climate(paths["climate_data_file"], scenario, nsamps, rng)
+    _write_model_values(
+        paths["expansion_coefficients_file"],
+        "expcoefs",
+        models,
+        rng.normal(0.115, 0.01, nmodels),
+    )
+    _write_model_values(
+        paths["gsat_rmses_file"], "gsat_rmse", models, rng.uniform(0.05, 0.3, nmodels)
+    )
+    _write_locations(paths["location_file"], nlocations, lats, lons, ocean, rng)
+
+    for i, model in enumerate(models):
+        # Models warm and expand at different rates
+        rate = 1 + 0.5 * i / max(nmodels - 1, 1)
+        for runtype, years in (("historical", hist_years), (scenario, ssp_years)):
+            months = _months(years)
+            _write_tas(paths["model_dir"], model, runtype, months, rate, rng)
+            _write_zostoga(paths["model_dir"], model, runtype, months, rate, rng)
+            _write_zos(
+                paths["model_dir"], model, runtype, months, rate, lats, lons, ocean, rng
+            )
+
+    return paths
+
+
+def _ocean_mask(lats, lons):
+    """Ocean cells of a few smooth continents and polar land"""
+    (lon2d, lat2d) = np.meshgrid(np.radians(lons), np.radians(lats))
+    land = (
+        np.sin(2 * lon2d) * np.cos(lat2d) + 0.5 * np.sin(3 * lat2d + lon2d) > 0.7
+    ) | (np.abs(np.degrees(lat2d)) > 78)
+    return ~land
+
+
+def _months(years):
+    """Decimal year at the middle of each month of the inclusive ``years``"""
+    nmonths = (years[1] - years[0] + 1) * 12
+    return years[0] + (np.arange(nmonths) + 0.5) / 12
+
+
+def _anomaly(months, rate):
+    """Accelerating change since 1850"""
+    t = np.clip(months - 1850, 0, None) / 250
+    return rate * t**2
+
+
+def _time_variable(nc, months):
+    nc.createDimension("time", len(months))
+    time_var = nc.createVariable("time", "f8", ("time",))
+    time_var.units = "days since 1850-01-01 00:00:00"
+    time_var.calendar = "365_day"
+    time_var[:] = (months - 1850) * 365
+
+
+def _model_file(model_dir, varname, table, model, runtype, months):
+    directory = os.path.join(model_dir, varname, model)
+    os.makedirs(directory, exist_ok=True)
+    first = int(months[0])
+    last = int(months[-1])
+    return os.path.join(
+        directory,
+        "{}_{}_{}_{}_r1i1p1f1_gn_{}01-{}12.nc".format(
+            varname, table, model, runtype, first, last
+        ),
+    )
+
+
+def _write_climate(path, scenario, nsamps, rng):
+    years = np.arange(CLIMATE_YEARS[0], CLIMATE_YEARS[1] + 1)
+    t = np.clip(years - 1850, 0, None)[:, np.newaxis] / 250
+    sensitivity = rng.lognormal(0, 0.25, nsamps)[np.newaxis, :]
+    with h5py.File(path, "w") as hf:
+        hf["year"] = years
+        group = hf.create_group(scenario)
+        group["surface_temperature"] = 4 * sensitivity * t**2 + rng.normal(
+            0, 0.1, (len(years), nsamps)
+        )
+        group["ocean_heat_content"] = 2e24 * sensitivity * t**2 + rng.normal(
+            0, 1e22, (len(years), nsamps)
+        )
+
+
+def _write_model_values(path, varname, models, values):
+    with Dataset(path, "w") as nc:
+        nc.createDimension("model", len(models))
+        model_var = nc.createVariable("model", str, ("model",))
+        for i, model in enumerate(models):
+            model_var[i] = model
+        nc.createVariable(varname, "f8", ("model",))[:] = values
+
+
+def _write_locations(path, nlocations, lats, lons, ocean, rng):
+    ocean_lat_idx, ocean_lon_idx = np.nonzero(ocean)
+    pick = rng.choice(len(ocean_lat_idx), nlocations, replace=False)
+    site_lats = lats[ocean_lat_idx[pick]] + rng.uniform(-0.25, 0.25, nlocations)
+    site_lons = lons[ocean_lon_idx[pick]] + rng.uniform(-0.25, 0.25, nlocations)
+    site_lons = np.where(site_lons > 180, site_lons - 360, site_lons)
+    with open(path, "w") as f:
+        for i in range(nlocations):
+            f.write(
+                "site_{}\t{}\t{:.3f}\t{:.3f}\n".format(i, i, site_lats[i], site_lons[i])
+            )
+
+
+def _write_tas(model_dir, model, runtype, months, rate, rng):
+    path = _model_file(model_dir, "tas", "Amon", model, runtype, months)
+    with Dataset(path, "w") as nc:
+        _time_variable(nc, months)
+        tas = nc.createVariable("tas", "f4", ("time",))
+        tas.units = "K"
+        tas[:] = 287 + 4 * _anomaly(months, rate) + rng.normal(0, 0.2, len(months))
+
+
+def _write_zostoga(model_dir, model, runtype, months, rate, rng):
+    path = _model_file(model_dir, "zostoga", "Omon", model, runtype, months)
+    with Dataset(path, "w") as nc:
+        _time_variable(nc, months)
+        zostoga = nc.createVariable("zostoga", "f4", ("time",))
+        zostoga.units = "m"
+        zostoga[:] = 0.3 * _anomaly(months, rate) + rng.normal(0, 0.002, len(months))
+
+
+def _write_zos(model_dir, model, runtype, months, rate, lats, lons, ocean, rng):
+    path = _model_file(model_dir, "zos", "Omon", model, runtype, months)
+    (lon2d, lat2d) = np.meshgrid(np.radians(lons), np.radians(lats))
+    pattern = (0.2 * np.sin(2 * lat2d) * np.cos(lon2d + rate)).astype(np.float32)
+    with Dataset(path, "w") as nc:
+        _time_variable(nc, months)
+        nc.createDimension("lat", len(lats))
+        nc.createDimension("lon", len(lons))
+        nc.createVariable("lat", "f8", ("lat",))[:] = lats
+        nc.createVariable("lon", "f8", ("lon",))[:] = lons
+        zos = nc.createVariable(
+            "zos",
+            "f4",
+            ("time", "lat", "lon"),
+            fill_value=np.float32(1e20),
+            chunksizes=(12, len(lats), len(lons)),
+        )
+        zos.units = "m"
+        step = ZOS_WRITE_YEARS * 12
+        for start in range(0, len(months), step):
+            block = months[start : start + step]
+            dat = _anomaly(block, rate)[:, np.newaxis, np.newaxis] * pattern
+            dat = dat + rng.normal(0, 0.01, dat.shape).astype(np.float32)
+            zos[start : start + step] = np.ma.masked_array(
+                dat, mask=np.broadcast_to(~ocean, dat.shape)
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write synthetic inputs for tlm-sterodynamics benchmarks",
+    )
+    parser.add_argument("root", help="Directory to write inputs to")
+    parser.add_argument("--nmodels", type=int, default=6)
+    parser.add_argument("--nlat", type=int, default=180)
+    parser.add_argument("--nlon", type=int, default=360)
+    parser.add_argument("--nsamps", type=int, default=2237)
+    parser.add_argument("--nlocations", type=int, default=1000)
+    parser.add_argument("--scenario", default="ssp585")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    paths = make_synthetic_inputs(
+        args.root,
+        nmodels=args.nmodels,
+        nlat=args.nlat,
+        nlon=args.nlon,
+        nsamps=args.nsamps,
+        nlocations=args.nlocations,
+        scenario=args.scenario,
+        seed=args.seed,
+    )
+    for name, path in paths.items():
+        print("--{}={}".format(name.replace("_", "-"), path))
@@ -0,0 +1,130 @@
+import numpy as np
+
+from conftest import BENCH_SETTINGS
+from tlm_sterodynamics.Import2lmData import Import2lmData
+from tlm_sterodynamics.IncludeCMIP6ZOSModels import (
+    CalcWeights,
+    IDW,
+    idw_min,
+    idw_pow,
+    idw_rad,
+)
+from tlm_sterodynamics.parallel import parallel_execution
+from tlm_sterodynamics.Smooth import NanSmooth, Smooth
+from tlm_sterodynamics.SmoothZOSTOGA import SmoothZOSTOGA
+from tlm_sterodynamics.tlm_sterodynamics_fit_oceandynamics import tlm_fit_oceandynamics
+from tlm_sterodynamics.tlm_sterodynamics_fit_thermalexpansion import (
+    tlm_fit_thermalexpansion,
+)
+from tlm_sterodynamics.tlm_sterodynamics_postprocess import (
+    tlm_postprocess_oceandynamics,
+)
+from tlm_sterodynamics.tlm_sterodynamics_preprocess_oceandynamics import (
+    tlm_preprocess_oceandynamics,
+)
+
+""" test_stages.py
+
+Micro-benchmarks of the stages and their hot functions on fixed data sizes. Run
+with 'pytest benchmarks'. See the pytest-benchmark documentation for saving and
+comparing runs, i.e. '--benchmark-autosave' and '--benchmark-compare'.
+
+"""
+
+# Years of the preprocessed series
+DATAYEARS = np.arange(1861, 2301)
+
+
+def test_calc_weights(benchmark, model_grid):
+    (lats, lons) = model_grid
+    benchmark(CalcWeights, 40.7, -74.0, lats, lons, idw_rad, idw_pow, idw_min)
+
+
+def test_idw(benchmark, model_grid):
+    (lats, lons) = model_grid
+    (idx, weights) = CalcWeights(40.7, -74.0, lats, lons, idw_rad, idw_pow, idw_min)
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(lats.shape[0], lats.shape[1], len(DATAYEARS)))
+    data[idx[0][::4], idx[1][::4], :100] = np.nan
+    benchmark(IDW, data, weights, idx)
+
+
+def test_smooth(benchmark):
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=len(DATAYEARS))
+    benchmark(Smooth, x, 19)
+
+
+def test_nan_smooth(benchmark):
+    # (years, models, sites), with models missing the first or last years
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(len(DATAYEARS), 20, 1000))
+    x[:10, ::3] = np.nan
+    x[-50:, 1::4] = np.nan
+    benchmark(NanSmooth, x, 19)
+
+
+def test_smooth_zostoga(benchmark):
+    rng = np.random.default_rng(0)
+    zostoga = np.cumsum(rng.normal(size=(len(DATAYEARS), 20)), axis=0)
+    zostoga[-50:, ::3] = np.nan
+    benchmark(SmoothZOSTOGA, zostoga, DATAYEARS, 2005, 19)
+
+
+def test_import_2lm_data(benchmark, synthetic_inputs):
+    benchmark(
+        Import2lmData,
+        "ocean_heat_content",
+        BENCH_SETTINGS["scenario"],
+        climate_fname=synthetic_inputs["climate_data_file"],
+    )
+
+
+def test_preprocess_oceandynamics(benchmark, synthetic_inputs):
+    benchmark.pedantic(
+        tlm_preprocess_oceandynamics,
+        args=(
+            BENCH_SETTINGS["scenario"],
+            synthetic_inputs["model_dir"],
+            True,
+            False,
+            BENCH_SETTINGS["pyear_start"],
+            BENCH_SETTINGS["pyear_end"],
+            BENCH_SETTINGS["pyear_step"],
+            synthetic_inputs["location_file"],
+            BENCH_SETTINGS["baseyear"],
+            "bench",
+        ),
+        rounds=3,
+    )
+
+
+def test_fit_thermalexpansion(benchmark, te_preprocessed):
+    benchmark(tlm_fit_thermalexpansion, te_preprocessed)
+
+
+def test_fit_oceandynamics(benchmark, od_preprocessed):
+    (od_config, od_zostoga, od_zos) = od_preprocessed
+    benchmark(tlm_fit_oceandynamics, od_config, od_zostoga, od_zos, "bench")
+
+
+def test_postprocess_oceandynamics(
+    benchmark, od_preprocessed, od_fit, te_projections, tmp_path
+):
+    (od_config, _, od_zos) = od_preprocessed
+
+    def postprocess():
+        # One thread, so timings do not depend on the number of cores
+        with parallel_execution(scheduler="synchronous"):
+            tlm_postprocess_oceandynamics(
+                od_config,
+                od_zos,
+                od_fit,
+                te_projections,
+                BENCH_SETTINGS["nsamps"],
+                BENCH_SETTINGS["seed"],
+                BENCH_SETTINGS["chunksize"],
+                str(tmp_path / "lslr.nc"),
+            )
+
+    benchmark.pedantic(postprocess, rounds=3)
@@ -2,6 +2,7 @@ import numpy as np
 import sys
 import h5py
 import re
+from tlm_sterodynamics.tracing import span
 
 """
 Import2lmData()
@@ -79,8 +80,11 @@ def Import2lmData(
 
             # Extract the samples
             try:
-                these_samps = hf[this_scenario][variable][()]
-                these_temp_samps = hf[this_scenario]["surface_temperature"][()]
+                with span(
+                    "read 2lm samples", scenario=this_scenario, variable=variable
+                ):
+                    these_samps = hf[this_scenario][variable][()]
+                    these_temp_samps = hf[this_scenario]["surface_temperature"][()]
             except Exception as e:
                 print(
                     "Cannot extract data for this combination: {} - {}".format(
@@ -103,7 +107,8 @@ def Import2lmData(
     # We have a standard SSP scenario
     else:
         try:
-            samps = hf[scenario][variable][()]
+            with span("read 2lm samples", scenario=scenario, variable=variable):
+                samps = hf[scenario][variable][()]
         except Exception as e:
             print(
                 "Cannot extract data for this combination: {} - {}".format(
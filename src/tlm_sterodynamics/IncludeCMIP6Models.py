@@ -2,6 +2,7 @@ import numpy as np
 import os
 import cftime
 from netCDF4 import Dataset
+from tlm_sterodynamics.tracing import span
 
 """ IncludeCMIP6Models.py
 
@@ -73,17 +74,21 @@ def IncludeCMIP6Models(model_dir, varname, years, include_models, include_scenar
 
             if incorporate:
                 # read out data
-                nc_fid = Dataset(os.path.join(model_dir, model, filename), "r")
+                with span("open {} file".format(varname), model=model, runtype=runtype):
+                    nc_fid = Dataset(os.path.join(model_dir, model, filename), "r")
                 # datayrs = nc_fid.variables['year'][:]
                 nctime = nc_fid.variables["time"]
-                temp_nctime = cftime.num2date(nctime, nctime.units, nctime.calendar)
-                datayrs = np.array([int(x.strftime("%Y")) for x in temp_nctime])
-                dat = nc_fid.variables[varname][:]
+                with span("decode time"):
+                    temp_nctime = cftime.num2date(nctime, nctime.units, nctime.calendar)
+                    datayrs = np.array([int(x.strftime("%Y")) for x in temp_nctime])
+                with span("read {}".format(varname)):
+                    dat = nc_fid.variables[varname][:]
 
                 # if monthly means, convert to annual
                 if datayrs[0] == datayrs[1]:
                     # rearrange per year and compute average along year axis
-                    dat = np.mean(np.reshape(dat, (int(len(dat) / 12), 12)), axis=1)
+                    with span("monthly reduction"):
+                        dat = np.mean(np.reshape(dat, (int(len(dat) / 12), 12)), axis=1)
                     datayrs = datayrs[0::12]
 
                 # store into dict for each cmip6 runtype
@@ -3,6 +3,14 @@ import os
 import sys
 from netCDF4 import Dataset
 import cftime
+from tlm_sterodynamics.fit_store import MatchSites
+from tlm_sterodynamics.grid_locations import GridZOS
+from tlm_sterodynamics.tracing import span
+from tlm_sterodynamics.model_store import (
+    AddToModelStore,
+    LoadModelStore,
+    ModelStoreKey,
+)
 
 """ IncludeCMIP6ZOSModels.py
 
@@ -15,6 +23,8 @@ model_dir       = Directory of model output. Each model is a subdirectory within
 varname        = Name of the variables of interest
 years           = Years of interest.
 scenario    = SSP of interest
+model_store = Optional directory of stored localized model series. Models are only read for sites missing from it.
+grid = Optional grid of locations from GridLocations. Sites are then grid locations and are localized without IDW.
 
 Return:
 model_list  = Vector of model names that are to be included (nmodels)
@@ -89,6 +99,183 @@ def IDW(val, idw_weights, idw_idx):
 
 # -----------------------------------------------------------------------------------------
 
+# Initialize IDW parameters
+idw_rad = 3.5
+# idw_rad = 5.0
+idw_pow = 3.0
+idw_min = 0.005
+
+
+def CalcSitesWeights(sites_lats, sites_lons, model_lats, model_lons):
+    """
+    IDW indices and weights of each site on a model grid.
+
+    Indices are into the box of grid points used by any site, which is
+    returned as (lat, lon) slices so that only the box needs to be read.
+    """
+    n_model_lats = len(model_lats)
+    n_model_lons = len(model_lons)
+
+    # Reshape for use in IDW functions
+    model_lats = np.tile(model_lats, (n_model_lons, 1))
+    model_lons = np.tile(model_lons, (n_model_lats, 1)).T
+
+    # Calculate the weights for all the sites
+    all_idx = []
+    all_weights = []
+    for i in np.arange(len(sites_lats)):
+        # Calculate the weights
+        (idx, weights) = CalcWeights(
+            sites_lats[i],
+            sites_lons[i],
+            model_lats,
+            model_lons,
+            idw_rad,
+            idw_pow,
+            idw_min,
+        )
+        all_idx.append(idx)
+        all_weights.append(weights)
+
+    # Only read the box of grid points used by the sites and index the weights
+    # into that box
+    box_lon_idx = np.concatenate([idx[0] for idx in all_idx])
+    box_lat_idx = np.concatenate([idx[1] for idx in all_idx])
+    if len(box_lon_idx) > 0:
+        lon_box = slice(box_lon_idx.min(), box_lon_idx.max() + 1)
+        lat_box = slice(box_lat_idx.min(), box_lat_idx.max() + 1)
+    else:
+        lon_box = slice(0, 1)
+        lat_box = slice(0, 1)
+    all_idx = [(idx[0] - lon_box.start, idx[1] - lat_box.start) for idx in all_idx]
+
+    return (all_idx, all_weights, lat_box, lon_box)
+
+
+def ReadZOSModel(
+    model_dir,
+    varname,
+    model,
+    filenames,
+    years,
+    sites_lats,
+    sites_lons,
+    weights_cache=None,
+    grid=None,
+    sites_ids=None,
+):
+    """
+    Localize one model's annual mean 'zos' to the sites (sites, years).
+
+    'filenames' maps the historical and scenario runtypes to their files.
+    IDW weights are reused from 'weights_cache' for models on the same grid.
+    If 'grid' is given, the sites are the grid locations 'sites_ids' instead.
+    """
+    if weights_cache is None:
+        weights_cache = {}
+
+    runtype_data = {}
+    runtype_datayrs = {}
+
+    # Read in historical and ssp data
+    for runtype, filename in filenames.items():
+        # Open the netCDF file
+        with (
+            span("read zos file", model=model, runtype=runtype),
+            Dataset(os.path.join(model_dir, model, filename), "r") as nc_fid,
+        ):
+            # If this is the historical run, find the IDW weights of the sites
+            # on the model grid. These are reused for models on the same grid.
+            if runtype == "historical" and grid is not None:
+                # Grid locations use the whole model grid
+                model_shape = (
+                    len(nc_fid.variables["lat"]),
+                    len(nc_fid.variables["lon"]),
+                )
+                if model_shape != grid["cells_shape"]:
+                    raise Exception(
+                        "{} grid {} does not match the location grid {}".format(
+                            model, model_shape, grid["cells_shape"]
+                        )
+                    )
+                lat_box = slice(None)
+                lon_box = slice(None)
+            elif runtype == "historical":
+                model_lats = nc_fid.variables["lat"][:]
+                model_lons = nc_fid.variables["lon"][:]
+                cache_key = (
+                    np.asarray(model_lats).tobytes(),
+                    np.asarray(model_lons).tobytes(),
+                    np.asarray(sites_lats).tobytes(),
+                    np.asarray(sites_lons).tobytes(),
+                )
+                if cache_key not in weights_cache:
+                    with span("IDW weights", sites=len(sites_lats)):
+                        weights_cache[cache_key] = CalcSitesWeights(
+                            sites_lats, sites_lons, model_lats, model_lons
+                        )
+                (all_idx, all_weights, lat_box, lon_box) = weights_cache[cache_key]
+
+            # read out the data
+            datatime = nc_fid.variables["time"]
+            with span("read zos"):
+                dat = nc_fid.variables[varname][:, lat_box, lon_box]
+                dat = np.array(dat.filled(np.nan))
+
+            # rearrange per year and compute average along year axis
+            with span("monthly reduction"):
+                dat = np.mean(
+                    np.reshape(
+                        dat, (int(dat.shape[0] / 12), 12, dat.shape[1], dat.shape[2])
+                    ),
+                    axis=1,
+                )
+
+            # Calculate the years
+            with span("decode time"):
+                nctime = cftime.num2date(datatime, datatime.units, datatime.calendar)
+                datayrs = [int(x.strftime("%Y")) for x in nctime]
+
+        # store into dict for each cmip6 runtype
+        runtype_data[runtype] = np.array(dat).T
+        runtype_datayrs[runtype] = np.array(datayrs[::12])
+
+    scenario = [runtype for runtype in filenames if runtype != "historical"][0]
+
+    # check for overlap of historical and scenario datasets using data years
+    overlap = np.isin(
+        runtype_datayrs["historical"], runtype_datayrs[scenario], invert=True
+    )  # if historical years are in scenario
+    runtype_datayrs["historical"] = runtype_datayrs["historical"][
+        overlap
+    ]  # remove these from the historical arrays
+    runtype_data["historical"] = runtype_data["historical"][:, :, overlap]
+
+    # concatenate historical and scenario years into full series
+    fullyrs = np.concatenate((runtype_datayrs["historical"], runtype_datayrs[scenario]))
+    fulldata = np.concatenate(
+        (runtype_data["historical"], runtype_data[scenario]), axis=2
+    )
+
+    # Put the ZOS data onto the requested years
+    with span("interpolate years"):
+        reduced_data = np.apply_along_axis(
+            lambda fp, xp: np.interp(years, xp, fp, left=np.nan, right=np.nan),
+            axis=2,
+            arr=fulldata,
+            xp=fullyrs,
+        )
+
+    # Grid locations are the mean of their cells
+    if grid is not None:
+        with span("grid cells", model=model, sites=len(sites_ids)):
+            return GridZOS(reduced_data, grid, sites_ids)
+
+    # Calculate the zos values for all sites from this model
+    with span("IDW", model=model, sites=len(all_idx)):
+        model_zos = map(lambda idx, w: IDW(reduced_data, w, idx), all_idx, all_weights)
+        return np.array(list(model_zos)).reshape(len(all_idx), len(years))
+
 
 def IncludeCMIP6ZOSModels(
     model_dir,
@@ -98,22 +285,15 @@ def IncludeCMIP6ZOSModels(
     include_scenarios,
     focus_sites_lats,
     focus_sites_lons,
+    model_store=None,
+    grid=None,
+    focus_sites_ids=None,
 ):
     # Initialize the model list and data matrix
     model_list = []
     scenario_list = []
-    init_zos = True
-
-    # Initialize variables to hold the IDW weights and indices
-    all_idx = []
-    all_weights = []
     ZOS = []
-
-    # Initialize IDW parameters
-    idw_rad = 3.5
-    # idw_rad = 5.0
-    idw_pow = 3.0
-    idw_min = 0.005
+    weights_cache = {}
 
     # Loop through available models in model_dir
     for i in np.arange(len(include_models)):
@@ -129,13 +309,10 @@ def IncludeCMIP6ZOSModels(
         if model not in os.listdir(model_dir):
             continue
 
-        # initialize lists to store data
-        runtype_data = {"historical": [], scenario: []}
-        runtype_datayrs = {"historical": [], scenario: []}
-
+        filenames = {}
         incorporate = True  # incorporate model or not
 
-        # Read in historical and ssp data
+        # Find the historical and ssp files
         for runtype in ("historical", scenario):
             # start of filename for runtype currently processed
             filename_id = varname + "_Omon_" + model + "_" + runtype
@@ -150,107 +327,72 @@ def IncludeCMIP6ZOSModels(
 
             if not filename:  # if the right filename cannot be found:
                 incorporate = False
+            filenames[runtype] = filename
 
-            if incorporate:
-                # Open the netCDF file
-                nc_fid = Dataset(os.path.join(model_dir, model, filename), "r")
-
-                # If this is the first model, collect the model lats and lons
-                # Note, this assumes all models have been put on the same grid
-                if init_zos and runtype == "historical":
-                    # Raw model lats/lons
-                    model_lats = nc_fid.variables["lat"][:]
-                    model_lons = nc_fid.variables["lon"][:]
-                    n_model_lats = len(model_lats)
-                    n_model_lons = len(model_lons)
-
-                    # Reshape for use in IDW functions
-                    model_lats = np.tile(model_lats, (n_model_lons, 1))
-                    model_lons = np.tile(model_lons, (n_model_lats, 1)).T
-
-                    # Calculate the weights for all the sites
-                    for i in np.arange(len(focus_sites_lats)):
-                        # Calculate the weights
-                        (idx, weights) = CalcWeights(
-                            focus_sites_lats[i],
-                            focus_sites_lons[i],
-                            model_lats,
-                            model_lons,
-                            idw_rad,
-                            idw_pow,
-                            idw_min,
-                        )
-                        all_idx.append(idx)
-                        all_weights.append(weights)
-
-                    # Done with initialization
-                    init_zos = False
-
-                # read out the data
-                datatime = nc_fid.variables["time"]
-                dat = nc_fid.variables[varname][:]
-                dat = np.array(dat.filled(np.nan))
-
-                # rearrange per year and compute average along year axis
-                dat = np.mean(
-                    np.reshape(
-                        dat, (int(dat.shape[0] / 12), 12, dat.shape[1], dat.shape[2])
-                    ),
-                    axis=1,
-                )
-
-                # Calculate the years
-                nctime = cftime.num2date(datatime, datatime.units, datatime.calendar)
-                datayrs = [int(x.strftime("%Y")) for x in nctime]
-                # start_time = datetime.datetime(year=1850, month=6, day=1, hour=0, minute=0, second=0)
-                # datayrs = [(start_time+datetime.timedelta(x)).year for x in datatime.data[0::12]]
-
-                # store into dict for each cmip6 runtype
-                runtype_data[runtype] = np.array(dat).T
-                runtype_datayrs[runtype] = np.array(datayrs[::12])
-                # runtype_data[runtype] = np.ma.array(dat).T
-                # runtype_datayrs[runtype] = np.ma.array(datayrs[::12])
-
-        if incorporate:
-            # check for overlap of historical and scenario datasets using data years
-            overlap = np.isin(
-                runtype_datayrs["historical"], runtype_datayrs[scenario], invert=True
-            )  # if historical years are in scenario
-            runtype_datayrs["historical"] = runtype_datayrs["historical"][
-                overlap
-            ]  # remove these from the historical arrays
-            runtype_data["historical"] = runtype_data["historical"][:, :, overlap]
-
-            # concatenate historical and scenario years into full series
-            fullyrs = np.concatenate(
-                (runtype_datayrs["historical"], runtype_datayrs[scenario])
-            )
-            fulldata = np.concatenate(
-                (runtype_data["historical"], runtype_data[scenario]), axis=2
-            )
+        if not incorporate:
+            continue
 
-            # Put the ZOS data onto the requested years
-            reduced_data = np.apply_along_axis(
-                lambda fp, xp: np.interp(years, xp, fp, left=np.nan, right=np.nan),
-                axis=2,
-                arr=fulldata,
-                xp=fullyrs,
+        # Only read the model for sites that are not in the model store
+        model_zos = np.full((len(focus_sites_lats), len(years)), np.nan)
+        if model_store is None:
+            read_idx = np.arange(len(focus_sites_lats))
+        else:
+            if grid is None:
+                localization = {"idw": [idw_rad, idw_pow, idw_min]}
+            else:
+                localization = {"grid": [grid["coarsen"], grid["coastal_band"]]}
+            store_key = ModelStoreKey(
+                model_dir,
+                varname,
+                model,
+                filenames,
+                {"years": np.asarray(years).tolist(), **localization},
             )
-
-            # Calculate the zos values for all sites from this model
-            model_zos = map(
-                lambda idx, w: IDW(reduced_data, w, idx), all_idx, all_weights
+            stored = LoadModelStore(model_store, store_key)
+            stored_idx = MatchSites(stored, focus_sites_lats, focus_sites_lons)
+            read_idx = np.flatnonzero(stored_idx < 0)
+            if stored is not None:
+                model_zos[stored_idx >= 0] = stored[varname][
+                    stored_idx[stored_idx >= 0]
+                ]
+
+        if len(read_idx) > 0:
+            model_zos[read_idx] = ReadZOSModel(
+                model_dir,
+                varname,
+                model,
+                filenames,
+                years,
+                np.asarray(focus_sites_lats)[read_idx],
+                np.asarray(focus_sites_lons)[read_idx],
+                weights_cache=weights_cache,
+                grid=grid,
+                sites_ids=None
+                if grid is None
+                else np.asarray(focus_sites_ids)[read_idx],
             )
+            if model_store is not None:
+                AddToModelStore(
+                    model_store,
+                    store_key,
+                    model,
+                    varname,
+                    years,
+                    stored,
+                    np.asarray(focus_sites_lats)[read_idx],
+                    np.asarray(focus_sites_lons)[read_idx],
+                    model_zos[read_idx],
+                )
 
-            # Add this model to the overall data structure
-            ZOS.append(np.array(list(model_zos)))
+        # Add this model to the overall data structure
+        ZOS.append(model_zos)
 
-            # Append the model to the model list
-            model_list.append(model)
-            scenario_list.append(scenario)
+        # Append the model to the model list
+        model_list.append(model)
+        scenario_list.append(scenario)
 
     # Convert ZOS to a numpy array and reshape (years, models, sites)
-    ZOS = np.array(ZOS)
+    ZOS = np.array(ZOS).reshape(len(model_list), len(focus_sites_lats), len(years))
     ZOS = np.transpose(ZOS, axes=(2, 0, 1))
 
     # Return variables
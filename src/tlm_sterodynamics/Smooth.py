@@ -11,6 +11,9 @@ w = Number of years contained in the smoothing window (Must be odd)
 Return: 
 y = Smoothed vector
 
+NanSmooth applies the same smoothing along the first axis of an array of any
+shape at once, skipping over NaN values in each column.
+
 """
 
 
@@ -21,3 +24,40 @@ def Smooth(x, w=5):
     stop = (np.cumsum(x[:-w:-1])[::2] / r)[::-1]
     y = np.concatenate((start, out0, stop))
     return y
+
+
+def NanSmooth(x, w=5):
+    """
+    Smooth each column of 'x' (along the first axis) as Smooth does.
+
+    NaN values are dropped from a column before smoothing and stay NaN. Columns
+    are grouped by which values are NaN and each group is smoothed at once.
+    """
+    x = np.asarray(x, dtype="double")
+    y = np.full(x.shape, np.nan)
+    x2 = x.reshape(x.shape[0], -1)
+    y2 = y.reshape(x.shape[0], -1)
+
+    # Pack each column's pattern of good values into bytes so that patterns
+    # are compared as single values
+    good = ~np.isnan(x2)
+    packed = np.ascontiguousarray(np.packbits(good, axis=0).T)
+    patterns, pattern_idx = np.unique(
+        packed.view(np.dtype((np.void, packed.shape[1]))).ravel(),
+        return_inverse=True,
+    )
+    r = np.arange(1, w - 1, 2, dtype="double")[:, np.newaxis]
+    for k in np.arange(len(patterns)):
+        cols = np.flatnonzero(pattern_idx == k)
+        idx = np.flatnonzero(good[:, cols[0]])
+        if len(idx) == 0:
+            continue
+        temp = x2[np.ix_(idx, cols)]
+        out0 = (
+            np.lib.stride_tricks.sliding_window_view(temp, w, axis=0).sum(axis=-1) / w
+        )
+        start = np.cumsum(temp[: w - 1], axis=0)[::2] / r
+        stop = (np.cumsum(temp[:-w:-1], axis=0)[::2] / r)[::-1]
+        y2[np.ix_(idx, cols)] = np.concatenate((start, out0, stop))
+
+    return y
@@ -1,5 +1,5 @@
 import numpy as np
-from tlm_sterodynamics.Smooth import Smooth
+from tlm_sterodynamics.Smooth import NanSmooth
 
 """ SmoothZOSTOGA.py
 
@@ -7,7 +7,7 @@ This script fixes the ZOSTOGA "suturing" problem and applies smoothing.
 
 Parameters: 
 ZOSTOGA = Time series of thermosteric sea-level change for each included model as derived
-		  by the IncludeModels.py script (years, nmodels)
+		  by the IncludeModels.py script (years, nmodels) or a single model (years)
 years = Years of interest
 baseyear = Base year from which to center ZOSTOGA on the mean
 smoothwin = Number of years contained in the smoothing window
@@ -20,32 +20,41 @@ sZOSTOGA = Smoothed ZOSTOGA (years, nmodels)
 
 
 def SmoothZOSTOGA(ZOSTOGA, years, baseyear, smoothwin):
-    # Initialize the smoothed ZOSTOGA variable
-    sZOSTOGA = np.nan * ZOSTOGA
+    # All models are processed at once
+    ZOSTOGA = np.array(ZOSTOGA, dtype="double")
+    vector_input = ZOSTOGA.ndim == 1
+    if vector_input:
+        ZOSTOGA = ZOSTOGA[:, np.newaxis]
 
     ## Center ZOSTOGA on its mean
     # Find the indices that are within 10 years of the baseyear
     temp1 = years <= (baseyear + 10)
     temp2 = years >= (baseyear - 10)
     center_inds = np.flatnonzero(temp1 * temp2)
-    good_inds = center_inds[np.flatnonzero(~np.isnan(ZOSTOGA[center_inds]))]
-    if len(good_inds) > 0:
-        ZOSTOGA = ZOSTOGA - np.mean(ZOSTOGA[good_inds])
+    center_good = ~np.isnan(ZOSTOGA[center_inds])
+    center_n = np.sum(center_good, axis=0)
+    center_sum = np.sum(np.where(center_good, ZOSTOGA[center_inds], 0.0), axis=0)
+    center_mean = np.divide(
+        center_sum,
+        center_n,
+        out=np.zeros(ZOSTOGA.shape[1]),
+        where=center_n > 0,
+    )
+    ZOSTOGA -= center_mean
 
     # Patch the suturing problem
-    syear_ind = int(np.flatnonzero(years == 2007))
+    syear_ind = np.flatnonzero(years == 2007)[0]
     diffa = ZOSTOGA[syear_ind] - ZOSTOGA[syear_ind - 1]
     diffb = ZOSTOGA[syear_ind - 2] - ZOSTOGA[syear_ind - 1]
-    if np.abs(diffa) > 20 * np.abs(diffb):
-        offset = diffa - diffb
-        ZOSTOGA[syear_ind:] = ZOSTOGA[syear_ind:] - offset
+    sutured = np.abs(diffa) > 20 * np.abs(diffb)
+    ZOSTOGA[syear_ind:, sutured] -= diffa[sutured] - diffb[sutured]
 
     # Smooth ZOSTOGA
-    good_inds = np.nonzero(~np.isnan(ZOSTOGA))[0]
-    if len(good_inds) > 0:
-        sZOSTOGA[good_inds] = Smooth(ZOSTOGA[good_inds], smoothwin)
+    sZOSTOGA = NanSmooth(ZOSTOGA, smoothwin)
 
     # Center the smoothed ZOSTOGA on the baseyear
     sZOSTOGA = sZOSTOGA - sZOSTOGA[np.flatnonzero(years == baseyear)]
 
+    if vector_input:
+        return (ZOSTOGA[:, 0], sZOSTOGA[:, 0])
     return (ZOSTOGA, sZOSTOGA)
@@ -3,8 +3,11 @@ Logic for the CLI.
 """
 
 import logging
+import os
 
 import click
+import numpy as np
+from dask.utils import format_bytes, parse_bytes
 
 from tlm_sterodynamics.tlm_sterodynamics_preprocess_thermalexpansion import (
     tlm_preprocess_thermalexpansion,
@@ -18,14 +21,65 @@ from tlm_sterodynamics.tlm_sterodynamics_preprocess_oceandynamics import (
 )
 from tlm_sterodynamics.tlm_sterodynamics_fit_oceandynamics import tlm_fit_oceandynamics
 from tlm_sterodynamics.tlm_sterodynamics_postprocess import (
+    open_te_projections,
     tlm_postprocess_oceandynamics,
 )
+from tlm_sterodynamics.parallel import (
+    SCHEDULERS,
+    auto_chunksizes,
+    concurrent_tasks,
+    parallel_execution,
+)
+from tlm_sterodynamics.merge_shards import merge_shards
+from tlm_sterodynamics.encoding import ENCODING_PROFILES
+from tlm_sterodynamics.metrics import RunMetrics
+from tlm_sterodynamics.plan import FormatPlan, PlanRun, ReusedSamples
+from tlm_sterodynamics import tracing
 
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
+def _parse_quantiles(ctx, param, value):
+    """Parse comma-separated quantiles from the command line"""
+    if value is None:
+        return None
+    try:
+        quantiles = [float(x) for x in value.split(",")]
+    except ValueError:
+        raise click.BadParameter("must be comma-separated numbers")
+    if not all(0.0 <= x <= 1.0 for x in quantiles):
+        raise click.BadParameter("quantiles must be within [0, 1]")
+    return quantiles
+
+
+def _parse_memory_limit(ctx, param, value):
+    """Parse a memory size (i.e. 16GiB) from the command line into bytes"""
+    if value is None:
+        return None
+    try:
+        memory_limit = parse_bytes(value)
+    except ValueError:
+        raise click.BadParameter("must be a memory size, i.e. 16GiB")
+    if memory_limit <= 0:
+        raise click.BadParameter("must be positive")
+    return memory_limit
+
+
+def _parse_location_shard(ctx, param, value):
+    """Parse a 'i/N' location shard from the command line"""
+    if value is None:
+        return None
+    try:
+        shard_index, nshards = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise click.BadParameter("must be formatted like 'i/N', i.e. 0/4")
+    if nshards < 1 or not (0 <= shard_index < nshards):
+        raise click.BadParameter("shard index i must be within [0, N)")
+    return (shard_index, nshards)
+
+
 @click.command
 @click.option(
     "--pipeline-id",
@@ -40,40 +94,73 @@ logging.basicConfig(level=logging.INFO)
     required=True,
     type=str,
 )
+@click.option(
+    "--reuse-gslr-file/--no-reuse-gslr-file",
+    envvar="TLM_STERODYNAMICS_REUSE_GSLR_FILE",
+    help="Read thermal expansion samples from the --output-gslr-file of an earlier run with the same --nsamps, --seed, and projection years instead of projecting them. Samples are read lazily a chunk at a time, so local projections can run as separate jobs, i.e. one per --location-shard.",
+    default=False,
+)
 @click.option(
     "--output-lslr-file",
     envvar="TLM_STERODYNAMICS_OUTPUT_LSLR_FILE",
-    help="Path to write output local SLR file.",
+    help="Path to write output local SLR file. Paths ending in '.zarr' are written as a Zarr store.",
     required=False,
     type=str,
 )
 @click.option(
     "--climate-data-file",
     envvar="TLM_STERODYNAMICS_CLIMATE_DATA_FILE",
-    help="NetCDF4/HDF5 file containing surface temperature data.",
+    help="NetCDF4/HDF5 file containing surface temperature data. Required unless --reuse-gslr-file is used.",
     type=str,
-    required=True,
+    required=False,
 )
 @click.option(
     "--expansion-coefficients-file",
     envvar="TLM_STERODYNAMICS_EXPANSION_COEFFICIENTS_FILE",
-    help="Path to NetCDF file containing expansion coefficients.",
+    help="Path to NetCDF file containing expansion coefficients. Required unless --reuse-gslr-file is used.",
     type=str,
-    required=True,
+    required=False,
 )
 @click.option(
     "--gsat-rmses-file",
     envvar="TLM_STERODYNAMICS_GSAT_RMSES_FILE",
-    help="Path to NetCDF file containing GSAT RMSEs.",
+    help="Path to NetCDF file containing GSAT RMSEs. Required unless --reuse-gslr-file is used.",
     type=str,
-    required=True,
+    required=False,
 )
 @click.option(
     "--location-file",
     envvar="TLM_STERODYNAMICS_LOCATION_FILE",
-    help="File containing name, id, lat, and lon of points for localization.",
+    help="File containing name, id, lat, and lon of points for localization. Tab-separated text, or NetCDF (.nc), NumPy (.npy), or Parquet (.parquet) files with lat and lon. Required unless --location-grid is used.",
     type=str,
-    required=True,
+    required=False,
+)
+@click.option(
+    "--location-shard",
+    envvar="TLM_STERODYNAMICS_LOCATION_SHARD",
+    help="Only localize shard i of N (i.e. 0/4) of the locations in --location-file or --location-grid. Shards are zero-indexed, contiguous blocks of locations. Every shard of a run uses the same samples. Requires --reuse-gslr-file.",
+    default=None,
+    callback=_parse_location_shard,
+)
+@click.option(
+    "--location-grid/--no-location-grid",
+    envvar="TLM_STERODYNAMICS_LOCATION_GRID",
+    help="Localize to every ocean cell of the CMIP6 ZOS grid instead of the points in --location-file, without inverse distance weighting. Local SLR output has 2D grid_lat and grid_lon coordinates, and location ids index the flattened grid.",
+    default=False,
+)
+@click.option(
+    "--grid-coarsen",
+    envvar="TLM_STERODYNAMICS_GRID_COARSEN",
+    help="With --location-grid, average blocks of N x N ocean cells into one location [default=1].",
+    default=1,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--grid-coastal-band",
+    envvar="TLM_STERODYNAMICS_GRID_COASTAL_BAND",
+    help="With --location-grid, only use ocean cells within N cells of land.",
+    default=None,
+    type=click.IntRange(min=1),
 )
 @click.option(
     "--model-dir",
@@ -82,6 +169,20 @@ logging.basicConfig(level=logging.INFO)
     type=str,
     required=True,
 )
+@click.option(
+    "--fit-store",
+    envvar="TLM_STERODYNAMICS_FIT_STORE",
+    help="Directory of stored per-site ocean dynamics fits. Only locations not already in the store are localized and fit, and they are added to it. Stored fits are only reused with the same CMIP6 inputs and settings.",
+    default=None,
+    type=str,
+)
+@click.option(
+    "--model-store",
+    envvar="TLM_STERODYNAMICS_MODEL_STORE",
+    help="Directory of stored per-model ZOS localized to each location. Models are only read and localized for locations missing from the store, so adding a model to --model-dir only reads that model. Stored series are only reused with the same model files.",
+    default=None,
+    type=str,
+)
 @click.option(
     "--scenario",
     envvar="TLM_STERODYNAMICS_SCENARIO",
@@ -134,7 +235,7 @@ logging.basicConfig(level=logging.INFO)
 @click.option(
     "--nsamps",
     envvar="TLM_STERODYNAMICS_NSAMPS",
-    help="Number of samples to generate.",
+    help="Number of samples to generate, from the first --nsamps climate samples. Must not exceed the number of climate samples.",
     default=20000,
 )
 @click.option(
@@ -143,11 +244,104 @@ logging.basicConfig(level=logging.INFO)
     help="Seed value for random number generator.",
     default=1234,
 )
+@click.option(
+    "--projection-blocksize",
+    envvar="TLM_STERODYNAMICS_PROJECTION_BLOCKSIZE",
+    help="Number of global thermal expansion samples to project and write at a time. Bounds memory use for very large --nsamps. Results do not depend on this. Defaults to all samples at once.",
+    default=None,
+    type=click.IntRange(min=1),
+)
 @click.option(
     "--chunksize",
     envvar="TLM_STERODYNAMICS_CHUNKSIZE",
-    help="Number of locations to process at a time [default=50].",
-    default=50,
+    help="Number of locations to process at a time [default=50, or picked from --memory-limit].",
+    default=None,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--sample-chunksize",
+    envvar="TLM_STERODYNAMICS_SAMPLE_CHUNKSIZE",
+    help="Number of local samples to generate and write at a time, so memory per task does not grow with --nsamps. Results do not depend on this. Ignored with --output-quantiles. Defaults to all samples at once, or is picked from --memory-limit.",
+    default=None,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--output-quantiles",
+    envvar="TLM_STERODYNAMICS_OUTPUT_QUANTILES",
+    help="Comma-separated quantiles (i.e. 0.05,0.17,0.5,0.83,0.95). If given, output files only hold these quantiles and the mean and standard deviation across samples rather than every sample.",
+    default=None,
+    callback=_parse_quantiles,
+)
+@click.option(
+    "--encoding-profile",
+    envvar="TLM_STERODYNAMICS_ENCODING_PROFILE",
+    help="Compression and chunking of the global and local SLR output files. 'fast' is uncompressed with chunks as written. 'compact' is zlib level 4 with shuffle, with chunks of the time series of one location. 'archive' is zlib level 9 with shuffle, with chunks of one year of every sample. Chunks hold at most --sample-chunksize samples. Zarr stores only take the compression. Defaults to zlib level 4 for global SLR and no compression for local SLR.",
+    default=None,
+    type=click.Choice(list(ENCODING_PROFILES)),
+)
+@click.option(
+    "--zarr-chunk-locations",
+    envvar="TLM_STERODYNAMICS_ZARR_CHUNK_LOCATIONS",
+    help="Number of locations in each chunk of Zarr local SLR output. If smaller than --chunksize, chunks are grouped into shards of --chunksize locations. Must evenly divide --chunksize. Defaults to --chunksize.",
+    default=None,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--scheduler",
+    envvar="TLM_STERODYNAMICS_SCHEDULER",
+    help="Dask scheduler used to project local ocean dynamics. 'processes' and 'distributed' start a local dask.distributed cluster, with single-threaded workers for 'processes'.",
+    default="threads",
+    show_default=True,
+    type=click.Choice(SCHEDULERS),
+)
+@click.option(
+    "--num-workers",
+    envvar="TLM_STERODYNAMICS_NUM_WORKERS",
+    help="Number of dask threads, processes, or local cluster workers. Defaults to the number of CPU cores. BLAS/OpenMP threads are capped to 1 per task unless the scheduler is 'synchronous', in which case they are capped to this value.",
+    default=None,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--threads-per-worker",
+    envvar="TLM_STERODYNAMICS_THREADS_PER_WORKER",
+    help="Number of threads for each worker of a 'distributed' scheduler.",
+    default=None,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--worker-memory-limit",
+    envvar="TLM_STERODYNAMICS_WORKER_MEMORY_LIMIT",
+    help="Memory limit for each worker of a 'distributed' scheduler (i.e. 4GiB).",
+    default="auto",
+    show_default=True,
+)
+@click.option(
+    "--memory-limit",
+    envvar="TLM_STERODYNAMICS_MEMORY_LIMIT",
+    help="Memory for projecting local ocean dynamics (i.e. 16GiB), shared by all workers. Picks --chunksize and --sample-chunksize from the number of locations, samples, and years and the number of workers, unless they are given.",
+    default=None,
+    callback=_parse_memory_limit,
+)
+@click.option(
+    "--metrics-file",
+    envvar="TLM_STERODYNAMICS_METRICS_FILE",
+    help="Path to write a JSON report of the wall time, CPU time, peak memory, bytes read and written, and number of models, sites, samples, and years of each stage.",
+    default=None,
+    type=str,
+)
+@click.option(
+    "--trace-file",
+    envvar="TLM_STERODYNAMICS_TRACE_FILE",
+    help="Path to write a Chrome trace event file of time spent in each stage, model file read, time decoding, monthly reduction, IDW, and output write. Open it in Perfetto (https://ui.perfetto.dev) or chrome://tracing.",
+    default=None,
+    type=str,
+)
+@click.option(
+    "--plan",
+    envvar="TLM_STERODYNAMICS_PLAN",
+    help="Only check the inputs and report the selected models, estimated peak memory, bytes to read, output size, and projected runtime, reading file metadata rather than data.",
+    is_flag=True,
+    default=False,
 )
 @click.option("--debug/--no-debug", default=False, envvar="TLM_STERODYNAMICS_DEBUG")
 def main(
@@ -156,7 +350,13 @@ def main(
     expansion_coefficients_file,
     gsat_rmses_file,
     location_file,
+    location_shard,
+    location_grid,
+    grid_coarsen,
+    grid_coastal_band,
     model_dir,
+    fit_store,
+    model_store,
     scenario,
     scenario_dsl,
     no_drift_corr,
@@ -167,9 +367,23 @@ def main(
     pyear_step,
     nsamps,
     seed,
+    projection_blocksize,
     chunksize,
+    sample_chunksize,
     output_gslr_file,
+    reuse_gslr_file,
     output_lslr_file,
+    output_quantiles,
+    encoding_profile,
+    zarr_chunk_locations,
+    scheduler,
+    num_workers,
+    threads_per_worker,
+    worker_memory_limit,
+    memory_limit,
+    metrics_file,
+    trace_file,
+    plan,
     debug,
 ) -> None:
     """
@@ -180,74 +394,254 @@ def main(
     else:
         logging.root.setLevel(logging.INFO)
 
-    logger.info("Starting tlm-sterodynamics")
+    if chunksize is None and memory_limit is None:
+        chunksize = 50
 
-    logger.info("Starting thermal expansion preprocessing")
-    te_pre_data = tlm_preprocess_thermalexpansion(
-        scenario,
-        pipeline_id,
-        climate_data_file,
-        expansion_coefficients_file,
-        gsat_rmses_file,
-    )
-    logger.info("Thermal expansion preprocessing complete")
+    if (
+        zarr_chunk_locations is not None
+        and chunksize is not None
+        and chunksize % zarr_chunk_locations != 0
+    ):
+        raise click.BadParameter(
+            "must evenly divide --chunksize", param_hint="--zarr-chunk-locations"
+        )
 
     if scenario_dsl == "":
         scenario_dsl = scenario
 
-    logger.info("Starting ocean dynamics preprocessing")
-    od_config, od_zostoga, od_zos = tlm_preprocess_oceandynamics(
-        scenario_dsl,
-        model_dir,
-        no_drift_corr,
-        no_correlation,
-        pyear_start,
-        pyear_end,
-        pyear_step,
-        location_file,
-        baseyear,
-        pipeline_id,
-    )
-    logger.info("Ocean dynamics preprocessing complete")
-
-    logger.info("Starting thermal expansion fitting")
-    te_fit_data = tlm_fit_thermalexpansion(te_pre_data)
-    logger.info("Thermal expansion fitting complete")
-
-    logger.info("Starting ocean dynamics fitting")
-    _, od_oceandynamics_fit = tlm_fit_oceandynamics(
-        od_config, od_zostoga, od_zos, pipeline_id
-    )
-    logger.info("Ocean dynamics fitting complete")
-
-    logger.info("Starting thermal expansion projection")
-    te_projections = tlm_project_thermalexpansion(
-        te_pre_data,
-        te_fit_data,
-        seed,
-        nsamps,
-        pipeline_id,
-        scenario,
-        pyear_start,
-        pyear_end,
-        pyear_step,
-        baseyear,
-        output_gslr_file,
-    )
-    logger.info("Thermal expansion projection complete")
-
-    if output_lslr_file:
-        logger.info("Starting ocean dynamics postprocessing")
-        tlm_postprocess_oceandynamics(
-            od_config,
-            od_zos,
-            od_oceandynamics_fit,
-            te_projections,
+    if plan:
+        run_plan = PlanRun(
+            scenario,
+            scenario_dsl,
+            model_dir,
+            climate_data_file,
+            expansion_coefficients_file,
+            gsat_rmses_file,
+            location_file,
+            np.arange(pyear_start, pyear_end + 1, pyear_step),
+            baseyear,
             nsamps,
-            seed,
+            concurrent_tasks(scheduler, num_workers, threads_per_worker),
             chunksize,
-            output_lslr_file,
+            sample_chunksize=sample_chunksize,
+            location_shard=location_shard,
+            location_grid=(grid_coarsen, grid_coastal_band) if location_grid else None,
+            output_quantiles=output_quantiles,
+            output_gslr_file=output_gslr_file,
+            output_lslr_file=output_lslr_file,
+            reuse_gslr_file=reuse_gslr_file,
+            projection_blocksize=projection_blocksize,
+            memory_limit=memory_limit,
+            zarr_chunk_locations=zarr_chunk_locations,
+        )
+        click.echo(FormatPlan(run_plan))
+        if run_plan["problems"]:
+            raise click.ClickException(
+                "Found {} problems with the inputs".format(len(run_plan["problems"]))
+            )
+        return
+
+    if location_grid and location_file is not None:
+        raise click.BadParameter(
+            "cannot be used with --location-grid", param_hint="--location-file"
+        )
+    if not location_grid and location_file is None:
+        raise click.MissingParameter(param_hint="--location-file", param_type="option")
+
+    if location_shard is not None and not reuse_gslr_file:
+        # Shard runs would otherwise all write the same global SLR file at once
+        raise click.BadParameter(
+            "requires --reuse-gslr-file. Write --output-gslr-file once with a run without --output-lslr-file first.",
+            param_hint="--location-shard",
         )
+
+    if reuse_gslr_file:
+        if not output_lslr_file:
+            raise click.BadParameter(
+                "requires --output-lslr-file", param_hint="--reuse-gslr-file"
+            )
+        if not os.path.isfile(output_gslr_file):
+            raise click.BadParameter(
+                f"{output_gslr_file} does not exist, so it cannot be reused",
+                param_hint="--output-gslr-file",
+            )
+        problems = []
+        ReusedSamples(
+            output_gslr_file,
+            nsamps,
+            np.arange(pyear_start, pyear_end + 1, pyear_step),
+            problems,
+        )
+        if problems:
+            raise click.BadParameter(
+                "; ".join(problems), param_hint="--reuse-gslr-file"
+            )
+    else:
+        for value, param_hint in (
+            (climate_data_file, "--climate-data-file"),
+            (expansion_coefficients_file, "--expansion-coefficients-file"),
+            (gsat_rmses_file, "--gsat-rmses-file"),
+        ):
+            if value is None:
+                raise click.MissingParameter(param_hint=param_hint, param_type="option")
+
+    # The report and trace are also written if a stage fails
+    metrics = RunMetrics(enabled=metrics_file is not None)
+    click.get_current_context().call_on_close(lambda: metrics.write(metrics_file))
+    if trace_file is not None:
+        tracing.enable()
+        click.get_current_context().call_on_close(
+            lambda: tracing.write_trace(trace_file)
+        )
+
+    logger.info("Starting tlm-sterodynamics")
+
+    if reuse_gslr_file:
+        logger.info(f"Reusing thermal expansion samples in {output_gslr_file}")
+    else:
+        logger.info("Starting thermal expansion preprocessing")
+        with metrics.stage("preprocess_thermalexpansion") as counts:
+            te_pre_data = tlm_preprocess_thermalexpansion(
+                scenario,
+                pipeline_id,
+                climate_data_file,
+                expansion_coefficients_file,
+                gsat_rmses_file,
+            )
+            counts["models"] = len(te_pre_data["expcoefs_models"])
+            (counts["samples"], counts["years"]) = te_pre_data["ohc_samps"].shape
+        logger.info("Thermal expansion preprocessing complete")
+        if nsamps > counts["samples"]:
+            raise click.BadParameter(
+                f"{nsamps} is more than the {counts['samples']} climate samples",
+                param_hint="--nsamps",
+            )
+
+    # Ocean dynamics is only needed for local projections
+    if output_lslr_file:
+        logger.info("Starting ocean dynamics preprocessing")
+        with metrics.stage("preprocess_oceandynamics") as counts:
+            od_config, od_zostoga, od_zos = tlm_preprocess_oceandynamics(
+                scenario_dsl,
+                model_dir,
+                no_drift_corr,
+                no_correlation,
+                pyear_start,
+                pyear_end,
+                pyear_step,
+                location_file,
+                baseyear,
+                pipeline_id,
+                location_shard=location_shard,
+                fit_store=fit_store,
+                model_store=model_store,
+                location_grid=(grid_coarsen, grid_coastal_band)
+                if location_grid
+                else None,
+            )
+            counts["models"] = len(od_zos["zos_modellist"])
+            counts["sites"] = len(od_zos["focus_site_ids"])
+            counts["years"] = len(od_zos["datayears"])
+        logger.info("Ocean dynamics preprocessing complete")
+
+    if not reuse_gslr_file:
+        logger.info("Starting thermal expansion fitting")
+        with metrics.stage("fit_thermalexpansion") as counts:
+            te_fit_data = tlm_fit_thermalexpansion(te_pre_data)
+            counts["models"] = len(te_fit_data["include_models"])
+        logger.info("Thermal expansion fitting complete")
+
+    if output_lslr_file:
+        logger.info("Starting ocean dynamics fitting")
+        with metrics.stage("fit_oceandynamics") as counts:
+            _, od_oceandynamics_fit = tlm_fit_oceandynamics(
+                od_config, od_zostoga, od_zos, pipeline_id
+            )
+            counts["models"] = od_zos["sZOS"].shape[1]
+            (counts["years"], counts["sites"]) = od_oceandynamics_fit[
+                "OceanDynMean"
+            ].shape
+        logger.info("Ocean dynamics fitting complete")
+
+    if not reuse_gslr_file:
+        logger.info("Starting thermal expansion projection")
+        with metrics.stage("project_thermalexpansion") as counts:
+            te_projections = tlm_project_thermalexpansion(
+                te_pre_data,
+                te_fit_data,
+                seed,
+                nsamps,
+                pipeline_id,
+                scenario,
+                pyear_start,
+                pyear_end,
+                pyear_step,
+                baseyear,
+                output_gslr_file,
+                output_quantiles=output_quantiles,
+                block_size=projection_blocksize,
+                encoding_profile=encoding_profile,
+            )
+            counts["models"] = len(te_projections["include_models"])
+            counts["samples"] = nsamps
+            counts["years"] = len(te_projections["targyears"])
+        logger.info("Thermal expansion projection complete")
+
+    if output_lslr_file:
+        if memory_limit is not None and (chunksize is None or sample_chunksize is None):
+            (chunksize, sample_chunksize) = auto_chunksizes(
+                memory_limit,
+                len(od_zos["focus_site_ids"]),
+                nsamps,
+                len(od_config["targyears"]),
+                concurrent_tasks(scheduler, num_workers, threads_per_worker),
+                chunksize=chunksize,
+                sample_chunksize=sample_chunksize,
+                whole_samples=output_quantiles is not None,
+                location_multiple=zarr_chunk_locations or 1,
+            )
+            logger.info(
+                f"Using chunks of {chunksize} locations and {sample_chunksize or nsamps} samples for a memory limit of {format_bytes(memory_limit)}"
+            )
+
+        logger.info("Starting ocean dynamics postprocessing")
+        with (
+            metrics.stage("postprocess_oceandynamics") as counts,
+            parallel_execution(
+                scheduler=scheduler,
+                num_workers=num_workers,
+                threads_per_worker=threads_per_worker,
+                worker_memory_limit=worker_memory_limit,
+            ),
+        ):
+            # Samples are always localized from the global SLR file, so runs
+            # that reuse it give identical results. Only summaries across
+            # samples are written with --output-quantiles, so samples are
+            # then kept in memory instead.
+            if reuse_gslr_file or output_quantiles is None:
+                te_projections = open_te_projections(
+                    output_gslr_file,
+                    nsamps,
+                    od_config["targyears"],
+                    sample_chunksize=sample_chunksize,
+                )
+            tlm_postprocess_oceandynamics(
+                od_config,
+                od_zos,
+                od_oceandynamics_fit,
+                te_projections,
+                nsamps,
+                seed,
+                chunksize,
+                output_lslr_file,
+                zarr_chunk_locations=zarr_chunk_locations,
+                output_quantiles=output_quantiles,
+                sample_chunksize=sample_chunksize,
+                encoding_profile=encoding_profile,
+            )
+            counts["sites"] = len(od_zos["focus_site_ids"])
+            counts["samples"] = nsamps
+            counts["years"] = len(te_projections["targyears"])
         logger.info("Ocean dynamics postprocessing complete")
     else:
         logger.info(
@@ -255,3 +649,27 @@ def main(
         )
 
     logger.info("tlm-sterodynamics complete")
+
+
+@click.command
+@click.argument("shard_files", nargs=-1, required=True)
+@click.option(
+    "--output-file",
+    envvar="TLM_STERODYNAMICS_MERGE_OUTPUT_FILE",
+    help="Path to write the merged local SLR file.",
+    required=True,
+    type=str,
+)
+@click.option("--debug/--no-debug", default=False, envvar="TLM_STERODYNAMICS_DEBUG")
+def merge(shard_files, output_file, debug) -> None:
+    """
+    Merge NetCDF local SLR files written by --location-shard runs into a single file along locations. The merged file references samples in the shard files rather than copying them, so shard files must be kept alongside it.
+    """
+    if debug:
+        logging.root.setLevel(logging.DEBUG)
+    else:
+        logging.root.setLevel(logging.INFO)
+
+    logger.info(f"Merging {len(shard_files)} location shards into {output_file}")
+    merge_shards(shard_files, output_file)
+    logger.info("Merging location shards complete")
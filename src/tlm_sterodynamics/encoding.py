@@ -0,0 +1,86 @@
+from zarr.codecs import BloscCodec, BloscShuffle
+
+""" encoding.py
+
+Named encoding profiles for the global and local SLR output files. A profile
+sets the compression, byte shuffle, and chunk shapes of the output variables
+to suit how the files are read:
+
+fast    = No compression, with chunks as they are written. Quickest to write
+          and largest on disk.
+compact = zlib level 4 with shuffle, with chunks holding every year and sample
+          of one location. Suits reading whole time series of a few locations.
+archive = zlib level 9 with shuffle, with chunks holding one year of every
+          sample of a batch of locations. Slowest to write and smallest on
+          disk. Suits reading single years, i.e. maps.
+
+Chunks never hold more samples than are written at a time, so samples that
+are written in blocks are not re-read and re-compressed by each block.
+
+Zarr stores keep their chunks, which line up with how they are written in
+parallel, and use the compression of the profile as a Blosc codec.
+
+Parameters:
+profile = Name of the encoding profile
+dims = Dimensions of an output variable
+sizes = Size of each dimension
+write_chunks = Size of each dimension written at a time, if not all of it (None is all)
+
+"""
+
+ENCODING_PROFILES = {
+    "fast": {"complevel": 0, "shuffle": False, "chunks": "write"},
+    "compact": {"complevel": 4, "shuffle": True, "chunks": "series"},
+    "archive": {"complevel": 9, "shuffle": True, "chunks": "year"},
+}
+
+
+def ChunkShape(profile, dims, sizes, write_chunks):
+    """Chunk shape of a variable with ``dims`` under an encoding profile"""
+    layout = ENCODING_PROFILES[profile]["chunks"]
+    shape = []
+    for dim in dims:
+        write_size = write_chunks.get(dim) or sizes[dim]
+        if layout == "series":
+            size = 1 if dim == "locations" else sizes[dim]
+        elif layout == "year" and dim == "years":
+            size = 1
+        elif layout == "year" and dim != "locations":
+            size = sizes[dim]
+        else:
+            size = write_size
+        if dim == "samples":
+            size = min(size, write_size)
+        shape.append(max(1, min(size, sizes[dim])))
+    return tuple(shape)
+
+
+def NetCDFEncoding(profile, dims, sizes, write_chunks):
+    """
+    Encoding of a netCDF variable under an encoding profile.
+
+    Keys are keyword arguments of netCDF4's ``createVariable``, which are
+    also valid xarray netCDF encodings.
+    """
+    settings = ENCODING_PROFILES[profile]
+    encoding = {
+        "zlib": settings["complevel"] > 0,
+        "shuffle": settings["shuffle"],
+        "chunksizes": ChunkShape(profile, dims, sizes, write_chunks),
+    }
+    if encoding["zlib"]:
+        encoding["complevel"] = settings["complevel"]
+    return encoding
+
+
+def ZarrCompressors(profile):
+    """Zarr compressors of an encoding profile, or None for no compression"""
+    settings = ENCODING_PROFILES[profile]
+    if settings["complevel"] == 0:
+        return None
+    shuffle = BloscShuffle.shuffle if settings["shuffle"] else BloscShuffle.noshuffle
+    return (
+        BloscCodec(
+            cname="zlib", clevel=settings["complevel"], shuffle=shuffle, typesize=4
+        ),
+    )
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+from netCDF4 import Dataset
+
+""" fit_store.py
+
+Persists per-site ocean dynamics fits so that later runs only localize, smooth,
+and fit sites that are not already in the store. Sites are matched by their
+exact latitude and longitude. Each store file holds fits for one identity of
+CMIP6 inputs and settings, so stored fits are never reused after the model
+archive or settings change.
+
+Parameters:
+store_dir = Directory of fit store files, one per input identity
+key = Identity of the CMIP6 inputs and settings the fits depend on
+
+"""
+
+logger = logging.getLogger(__name__)
+
+# Increment when a change to preprocessing or fitting changes per-site fits, so
+# that fits stored by older versions are not reused.
+STORE_VERSION = 1
+
+# Per-site fit variables (years, sites)
+FIT_VARIABLES = (
+    "OceanDynMean",
+    "OceanDynStd",
+    "OceanDynDOF",
+    "OceanDynN",
+    "OceanDynTECorr",
+)
+
+
+def FitStoreKey(modeldir, include_models, include_scenarios, settings):
+    """
+    Hash identifying the CMIP6 inputs and settings that per-site fits depend on.
+
+    Input files are identified by name, size, and modification time.
+    """
+    files = []
+    for varname in ("zos", "zostoga"):
+        for model in sorted(set(include_models)):
+            model_dir = os.path.join(modeldir, varname, model)
+            if not os.path.isdir(model_dir):
+                continue
+            for filename in sorted(os.listdir(model_dir)):
+                stat = os.stat(os.path.join(model_dir, filename))
+                files.append([varname, model, filename, stat.st_size, stat.st_mtime_ns])
+
+    identity = {
+        "version": STORE_VERSION,
+        "models": list(include_models),
+        "scenarios": list(include_scenarios),
+        "settings": settings,
+        "files": files,
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+def FitStorePath(store_dir, key):
+    return os.path.join(store_dir, "{}.nc".format(key))
+
+
+def LoadFitStore(store_dir, key):
+    """Stored fits for 'key', or None if nothing is stored yet"""
+    path = FitStorePath(store_dir, key)
+    if not os.path.isfile(path):
+        return None
+
+    with Dataset(path, "r") as nc:
+        nc.set_auto_mask(False)
+        stored = {name: nc.variables[name][:] for name in ("lat", "lon", "years")}
+        for name in FIT_VARIABLES:
+            stored[name] = nc.variables[name][:]
+
+    return stored
+
+
+def MatchSites(stored, lats, lons):
+    """
+    Index of each site in the stored fits, or -1 if the site is not stored.
+    """
+    stored_idx = np.full(len(lats), -1)
+    if stored is None:
+        return stored_idx
+
+    lookup = {
+        latlon: i
+        for i, latlon in enumerate(zip(stored["lat"].tolist(), stored["lon"].tolist()))
+    }
+    for i, latlon in enumerate(
+        zip(np.asarray(lats).tolist(), np.asarray(lons).tolist())
+    ):
+        stored_idx[i] = lookup.get(latlon, -1)
+
+    return stored_idx
+
+
+def FirstUniqueSites(lats, lons):
+    """Indices of the first of any sites with the same coordinates, in order"""
+    _, first_idx = np.unique(
+        np.stack((np.asarray(lats), np.asarray(lons)), axis=1),
+        axis=0,
+        return_index=True,
+    )
+    return np.sort(first_idx)
+
+
+def MergeFitStore(fit_store, od_fit, lats, lons):
+    """
+    Merge fits of newly fit sites with stored fits and add them to the store.
+
+    'od_fit' holds fits for the sites not found in the store, in site order.
+    Returns the fits for all sites.
+    """
+    stored = fit_store["stored"]
+    stored_idx = fit_store["stored_idx"]
+    new_sites = stored_idx < 0
+    nyears = len(od_fit["OceanDynYears"])
+
+    merged = dict(od_fit)
+    for name in FIT_VARIABLES:
+        new_fit = np.broadcast_to(od_fit[name], (nyears, np.sum(new_sites)))
+        merged[name] = np.empty((nyears, len(stored_idx)), dtype=new_fit.dtype)
+        merged[name][:, new_sites] = new_fit
+        if stored is not None:
+            merged[name][:, ~new_sites] = stored[name][:, stored_idx[~new_sites]]
+    merged["OceanDynN"] = merged["OceanDynN"].astype(int)
+    merged["OceanDynDOF"] = merged["OceanDynDOF"].astype(int)
+
+    if not np.any(new_sites):
+        return merged
+
+    # Only add the first of any repeated coordinates
+    new_lats = np.asarray(lats)[new_sites]
+    new_lons = np.asarray(lons)[new_sites]
+    first_idx = FirstUniqueSites(new_lats, new_lons)
+    new_lats = new_lats[first_idx]
+    new_lons = new_lons[first_idx]
+    new_fits = {
+        name: merged[name][:, new_sites][:, first_idx] for name in FIT_VARIABLES
+    }
+
+    if stored is not None:
+        new_lats = np.concatenate((stored["lat"], new_lats))
+        new_lons = np.concatenate((stored["lon"], new_lons))
+        new_fits = {
+            name: np.concatenate((stored[name], new_fits[name]), axis=1)
+            for name in FIT_VARIABLES
+        }
+
+    SaveFitStore(
+        fit_store["dir"],
+        fit_store["key"],
+        new_lats,
+        new_lons,
+        od_fit["OceanDynYears"],
+        new_fits,
+    )
+    logger.info(
+        "Added {} sites to fit store {}, now {} sites".format(
+            len(first_idx), fit_store["key"][:12], len(new_lats)
+        )
+    )
+
+    return merged
+
+
+def SaveFitStore(store_dir, key, lats, lons, years, fits):
+    """
+    Write the fit store for 'key'.
+
+    The file is written next to the store and then renamed, so concurrent
+    readers never see a partial store. If runs add sites concurrently, the last
+    one to finish wins and sites only fit by the others are fit again later.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    path = FitStorePath(store_dir, key)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+
+    with Dataset(tmp_path, "w", format="NETCDF4") as nc:
+        nc.createDimension("years", len(years))
+        nc.createDimension("sites", len(lats))
+        nc.createVariable("years", "i4", ("years",))[:] = years
+        nc.createVariable("lat", "f8", ("sites",))[:] = lats
+        nc.createVariable("lon", "f8", ("sites",))[:] = lons
+        for name in FIT_VARIABLES:
+            dtype = "i8" if name in ("OceanDynDOF", "OceanDynN") else "f8"
+            fit_var = nc.createVariable(name, dtype, ("years", "sites"), zlib=True)
+            fit_var[:] = fits[name]
+        nc.description = "Per-site ocean dynamics fits for tlm-sterodynamics"
+        nc.key = key
+
+    os.replace(tmp_path, path)
@@ -0,0 +1,114 @@
+import numpy as np
+import os
+from netCDF4 import Dataset
+from scipy.ndimage import binary_dilation
+
+""" grid_locations.py
+
+Defines locations as the ocean cells of the CMIP6 'zos' grid, instead of points
+from a location file, and localizes model fields to them without IDW. Cells
+can be averaged into blocks of cells and limited to a band along the coast.
+
+Parameters:
+model_dir = Directory of 'zos' model output. Each model is a subdirectory within this one.
+include_models = Models to look for the grid in
+coarsen = Number of grid cells along each side of a location's block of cells
+coastal_band = Only keep ocean cells within this many cells of land
+
+Note, this assumes all models have been put on the same grid. The ocean cells are
+those with values at the first time of the first model's historical run.
+Location ids index the (y, x) grid of locations in row-major order.
+
+"""
+
+
+def GridLocations(model_dir, include_models, coarsen=1, coastal_band=None):
+    """
+    Locations at the ocean cells of the model grid.
+
+    Returns location (names, ids, lats, lons) and a grid dict used to localize
+    model fields with GridZOS and to write 2D coordinates.
+    """
+    # Find the historical file of the first available model
+    filename = None
+    for model in include_models:
+        if "." in model or not os.path.isdir(os.path.join(model_dir, model)):
+            continue
+        filename_id = "zos_Omon_" + model + "_historical"
+        for this_filename in sorted(os.listdir(os.path.join(model_dir, model))):
+            if this_filename.startswith(filename_id):
+                filename = os.path.join(model_dir, model, this_filename)
+                break
+        if filename:
+            break
+    if filename is None:
+        raise Exception("No historical zos file found to define the location grid")
+
+    with Dataset(filename, "r") as nc_fid:
+        model_lats = np.asarray(nc_fid.variables["lat"][:], dtype=float)
+        model_lons = np.asarray(nc_fid.variables["lon"][:], dtype=float)
+        first = nc_fid.variables["zos"][0]
+        ocean = ~np.ma.getmaskarray(first) & ~np.isnan(np.ma.filled(first, np.nan))
+
+    # Only keep ocean cells within 'coastal_band' cells of land. Longitude wraps
+    # around.
+    cells = ocean
+    if coastal_band is not None:
+        land = np.pad(~ocean, ((0, 0), (coastal_band, coastal_band)), mode="wrap")
+        near_land = binary_dilation(
+            land, structure=np.ones((3, 3), dtype=bool), iterations=coastal_band
+        )[:, coastal_band : coastal_band + ocean.shape[1]]
+        cells = ocean & near_land
+
+    # Blocks of 'coarsen' x 'coarsen' cells, dropping partial blocks at the edges
+    ny = len(model_lats) // coarsen
+    nx = len(model_lons) // coarsen
+    cells = cells[: ny * coarsen, : nx * coarsen]
+    block_lats = model_lats[: ny * coarsen].reshape(ny, coarsen).mean(axis=1)
+    block_lons = model_lons[: nx * coarsen].reshape(nx, coarsen).mean(axis=1)
+    has_cells = cells.reshape(ny, coarsen, nx, coarsen).any(axis=(1, 3))
+
+    grid = {
+        "coarsen": coarsen,
+        "coastal_band": coastal_band,
+        "cells_shape": ocean.shape,
+        "cells": cells,
+        "grid_lat": np.broadcast_to(block_lats[:, np.newaxis], (ny, nx)).copy(),
+        "grid_lon": np.broadcast_to(block_lons[np.newaxis, :], (ny, nx)).copy(),
+        "ids": np.flatnonzero(has_cells),
+    }
+
+    ids = grid["ids"]
+    lats = grid["grid_lat"].ravel()[ids]
+    lons = grid["grid_lon"].ravel()[ids]
+    names = ids.astype(str)
+
+    return (names, ids, lats, lons, grid)
+
+
+def GridZOS(reduced_data, grid, site_ids):
+    """
+    Localize a model field (lon, lat, years) to grid locations (sites, years).
+
+    Each location is the mean of the valid values of its block of cells, as
+    IDW with equal weights would give.
+    """
+    coarsen = grid["coarsen"]
+    nx = grid["grid_lat"].shape[1]
+    nyears = reduced_data.shape[2]
+
+    # Indices of the cells in each location's block, as (sites, lat, lon)
+    (block_y, block_x) = np.divmod(np.asarray(site_ids), nx)
+    offsets = np.arange(coarsen)
+    lat_idx = (block_y[:, np.newaxis] * coarsen + offsets)[:, :, np.newaxis]
+    lon_idx = (block_x[:, np.newaxis] * coarsen + offsets)[:, np.newaxis, :]
+
+    # Only the cells of the locations are gathered, as (sites, cells, years)
+    data = reduced_data[lon_idx, lat_idx].reshape(-1, coarsen * coarsen, nyears)
+    cells = grid["cells"][lat_idx, lon_idx].reshape(-1, coarsen * coarsen)
+    valid = cells[:, :, np.newaxis] & ~np.isnan(data)
+    if coarsen == 1:
+        return np.where(valid[:, 0], data[:, 0], np.nan)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sum(np.where(valid, data, 0.0), axis=1) / np.sum(valid, axis=1)
@@ -0,0 +1,161 @@
+import os
+import time
+
+import h5py
+import numpy as np
+
+""" merge_shards.py
+
+Merges localized projections written by separate '--location-shard' runs into a
+single NetCDF4/HDF5 file without copying samples. Variables along the
+'locations' dimension are HDF5 virtual datasets that read from the shard files
+in place. Small 1D location variables (i.e. lat, lon) and coordinates are
+copied.
+
+Parameters:
+shard_files = Paths to shard output files, in shard order
+output_file = Path of the merged file to write
+
+Note that the merged file only holds references to the shard files. Shard files
+must not be moved or deleted unless they are moved together with the merged
+file. Source paths are stored relative to the merged file.
+
+"""
+
+# HDF5 attributes managed by netCDF-C and the HDF5 dimension scale API. These
+# are recreated rather than copied.
+_RESERVED_ATTRS = {
+    "CLASS",
+    "NAME",
+    "DIMENSION_LIST",
+    "REFERENCE_LIST",
+    "_Netcdf4Dimid",
+    "_Netcdf4Coordinates",
+    "_NCProperties",
+}
+
+# Start of the dimension scale name netCDF-C gives dimensions that have no
+# coordinate variable.
+_DIMENSION_ONLY = b"This is a netCDF dimension but not a netCDF variable."
+
+
+def _variable_dims(dset):
+    """Names of the dimensions of a NetCDF4 variable opened with h5py"""
+    if dset.attrs.get("CLASS") == b"DIMENSION_SCALE":
+        return (dset.name.lstrip("/"),)
+    return tuple(
+        dset.file[ref[0]].name.lstrip("/") for ref in dset.attrs["DIMENSION_LIST"]
+    )
+
+
+def _copy_attrs(src, dst):
+    for k, v in src.attrs.items():
+        if k not in _RESERVED_ATTRS:
+            dst.attrs[k] = v
+
+
+def merge_shards(shard_files, output_file):
+    """
+    Merge localized shard outputs along 'locations' into a virtual file.
+
+    Raises ValueError if shards do not share the same variables, dimensions,
+    and non-location coordinates, such as samples and years.
+    """
+    if not shard_files:
+        raise ValueError("No shard files to merge")
+
+    shards = [h5py.File(f, "r") for f in shard_files]
+    try:
+        first = shards[0]
+        variables = {
+            name: _variable_dims(dset)
+            for name, dset in first.items()
+            if isinstance(dset, h5py.Dataset)
+        }
+        if "locations" not in variables:
+            raise ValueError(f"{shard_files[0]} has no 'locations' dimension")
+
+        # Check that shards line up before referencing them.
+        for path, shard in zip(shard_files[1:], shards[1:]):
+            shard_variables = {
+                name: _variable_dims(dset)
+                for name, dset in shard.items()
+                if isinstance(dset, h5py.Dataset)
+            }
+            if shard_variables != variables:
+                raise ValueError(
+                    f"{path} variables or dimensions do not match {shard_files[0]}"
+                )
+            for name, dims in variables.items():
+                if "locations" not in dims and not np.array_equal(
+                    shard[name][...], first[name][...]
+                ):
+                    raise ValueError(
+                        f"{path} variable {name!r} does not match {shard_files[0]}"
+                    )
+
+        nlocs = [shard["locations"].shape[0] for shard in shards]
+        locations = np.concatenate([shard["locations"][...] for shard in shards])
+        if len(np.unique(locations)) != len(locations):
+            raise ValueError("Shards have overlapping locations")
+        offsets = np.concatenate(([0], np.cumsum(nlocs)))
+
+        outdir = os.path.dirname(os.path.abspath(output_file))
+        with h5py.File(output_file, "w") as out:
+            _copy_attrs(first, out)
+            out.attrs["history"] = (
+                "Merged from {} location shards {}; ".format(
+                    len(shards), time.ctime(time.time())
+                )
+                + first.attrs.get("history", b"").decode()
+            )
+
+            # Dimension coordinates first so variables can attach to them.
+            dim_names = [n for n, d in variables.items() if d == (n,)]
+            for name in dim_names:
+                if name == "locations":
+                    data = locations
+                else:
+                    data = first[name][...]
+                dset = out.create_dataset(name, data=data)
+                _copy_attrs(first[name], dset)
+                # Keep netCDF-C's name for dimensions without a coordinate
+                # variable, so they are not read back as coordinates.
+                scale_name = first[name].attrs.get("NAME", b"")
+                if scale_name.startswith(_DIMENSION_ONLY):
+                    dset.make_scale(scale_name.decode())
+                else:
+                    dset.make_scale(name)
+
+            for name, dims in variables.items():
+                if name in dim_names:
+                    continue
+                src = first[name]
+                if "locations" not in dims or len(dims) == 1:
+                    # Small, so just copy.
+                    if "locations" in dims:
+                        data = np.concatenate([shard[name][...] for shard in shards])
+                    else:
+                        data = src[...]
+                    dset = out.create_dataset(name, data=data)
+                else:
+                    axis = dims.index("locations")
+                    shape = list(src.shape)
+                    shape[axis] = int(offsets[-1])
+                    layout = h5py.VirtualLayout(shape=tuple(shape), dtype=src.dtype)
+                    for i, (path, shard) in enumerate(zip(shard_files, shards)):
+                        region = [slice(None)] * len(shape)
+                        region[axis] = slice(int(offsets[i]), int(offsets[i + 1]))
+                        layout[tuple(region)] = h5py.VirtualSource(
+                            os.path.relpath(os.path.abspath(path), outdir),
+                            name,
+                            shape=shard[name].shape,
+                        )
+                    fillvalue = src.attrs.get("_FillValue", [None])[0]
+                    dset = out.create_virtual_dataset(name, layout, fillvalue=fillvalue)
+                _copy_attrs(src, dset)
+                for i, dim in enumerate(dims):
+                    dset.dims[i].attach_scale(out[dim])
+    finally:
+        for shard in shards:
+            shard.close()
@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from importlib.metadata import PackageNotFoundError, version
+
+from tlm_sterodynamics.tracing import span
+
+""" metrics.py
+
+Measures the wall time, CPU time, peak memory, and I/O of each stage of a run,
+along with the number of models, sites, samples, and years it processed, and
+writes them as a JSON report.
+
+Parameters:
+metrics_file = Path of the JSON report to write
+
+Note that CPU time includes worker processes once they exit, but I/O only
+counts this process. Peak memory is per stage where Linux allows resetting
+the peak resident set size, and otherwise the peak since the process started.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+# Increment when fields of the report change meaning
+REPORT_VERSION = 1
+
+# Problem sizes recorded for each stage
+COUNTS = ("models", "sites", "samples", "years")
+
+
+def _read_proc(name):
+    """Fields of /proc/self/<name> as a dict, or {} if it is not available"""
+    try:
+        with open(os.path.join("/proc/self", name)) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return {}
+    return dict(line.split(":", 1) for line in lines if ":" in line)
+
+
+def _reset_peak_rss():
+    """Reset the peak resident set size (Linux only). True if it was reset."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def _peak_rss():
+    """Peak resident set size in bytes"""
+    status = _read_proc("status")
+    if "VmHWM" in status:
+        return int(status["VmHWM"].split()[0]) * 1024
+
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _snapshot():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = _read_proc("io")
+    return {
+        "wall": time.perf_counter(),
+        "cpu": own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        "read": int(io["rchar"]) if "rchar" in io else None,
+        "write": int(io["wchar"]) if "wchar" in io else None,
+    }
+
+
+class RunMetrics:
+    """
+    Per-stage performance metrics of a run.
+
+    Does nothing unless ``enabled``, so stages can always be wrapped in
+    ``stage()``.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+        self.started = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        self._start = _snapshot() if enabled else None
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager measuring one stage.
+
+        Yields a dict that the stage fills in with the number of models, sites,
+        samples, and years it processed. The stage is also traced.
+        """
+        counts = {}
+        with span(name, cat="stage"):
+            if not self.enabled:
+                yield counts
+                return
+
+            peak_is_stage = _reset_peak_rss()
+            start = _snapshot()
+            completed = False
+            try:
+                yield counts
+                completed = True
+            finally:
+                end = _snapshot()
+                record = {
+                    "stage": name,
+                    "completed": completed,
+                    "wall_seconds": end["wall"] - start["wall"],
+                    "cpu_seconds": end["cpu"] - start["cpu"],
+                    "peak_rss_bytes": _peak_rss(),
+                    "peak_rss_scope": "stage" if peak_is_stage else "process",
+                    "bytes_read": _delta(start, end, "read"),
+                    "bytes_written": _delta(start, end, "write"),
+                }
+                record.update({k: counts.get(k) for k in COUNTS})
+                self.stages.append(record)
+                logger.debug(
+                    "{} took {:.2f}s wall, {:.2f}s CPU, {:.1f} MiB peak RSS".format(
+                        name,
+                        record["wall_seconds"],
+                        record["cpu_seconds"],
+                        record["peak_rss_bytes"] / 2**20,
+                    )
+                )
+
+    def report(self):
+        end = _snapshot()
+        try:
+            package_version = version("tlm-sterodynamics")
+        except PackageNotFoundError:
+            package_version = None
+        return {
+            "report_version": REPORT_VERSION,
+            "version": package_version,
+            "started": self.started,
+            "total": {
+                "wall_seconds": end["wall"] - self._start["wall"],
+                "cpu_seconds": end["cpu"] - self._start["cpu"],
+                "bytes_read": _delta(self._start, end, "read"),
+                "bytes_written": _delta(self._start, end, "write"),
+                "peak_rss_bytes": max(
+                    (stage["peak_rss_bytes"] for stage in self.stages), default=None
+                ),
+            },
+            "stages": self.stages,
+        }
+
+    def write(self, path):
+        """Write the JSON report to ``path``"""
+        if not self.enabled:
+            return
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+            f.write("\n")
+        logger.info(f"Wrote performance metrics to {path}")
+
+
+def _delta(start, end, key):
+    if start[key] is None or end[key] is None:
+        return None
+    return end[key] - start[key]
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+from netCDF4 import Dataset
+
+from tlm_sterodynamics.fit_store import FirstUniqueSites
+
+""" model_store.py
+
+Persists each CMIP6 model's annual mean 'zos' localized to sites, so that a
+model is only read and localized again for sites it has not been localized to.
+Adding a model to the archive then only costs reading and localizing that
+model; the ensemble statistics are recomputed from the stored series.
+
+Parameters:
+store_dir = Directory of model store files, one per model and input identity
+key = Identity of the model's input files and localization settings
+
+"""
+
+logger = logging.getLogger(__name__)
+
+# Increment when a change to reading or localizing models changes the stored
+# series, so that series stored by older versions are not reused.
+STORE_VERSION = 1
+
+
+def ModelStoreKey(model_dir, varname, model, filenames, settings):
+    """
+    Hash identifying one model's input files and localization settings.
+
+    Input files are identified by name, size, and modification time.
+    """
+    files = []
+    for runtype, filename in filenames.items():
+        stat = os.stat(os.path.join(model_dir, model, filename))
+        files.append([runtype, filename, stat.st_size, stat.st_mtime_ns])
+
+    identity = {
+        "version": STORE_VERSION,
+        "varname": varname,
+        "model": model,
+        "settings": settings,
+        "files": files,
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+def ModelStorePath(store_dir, key):
+    return os.path.join(store_dir, "{}.nc".format(key))
+
+
+def LoadModelStore(store_dir, key):
+    """Stored series for 'key', or None if nothing is stored yet"""
+    path = ModelStorePath(store_dir, key)
+    if not os.path.isfile(path):
+        return None
+
+    with Dataset(path, "r") as nc:
+        nc.set_auto_mask(False)
+        stored = {name: nc.variables[name][:] for name in nc.variables}
+
+    return stored
+
+
+def AddToModelStore(store_dir, key, model, varname, years, stored, lats, lons, data):
+    """
+    Add one model's series (sites, years) for new sites to its store.
+    """
+    first_idx = FirstUniqueSites(lats, lons)
+    lats = np.asarray(lats)[first_idx]
+    lons = np.asarray(lons)[first_idx]
+    data = data[first_idx]
+    if stored is not None:
+        lats = np.concatenate((stored["lat"], lats))
+        lons = np.concatenate((stored["lon"], lons))
+        data = np.concatenate((stored[varname], data))
+
+    os.makedirs(store_dir, exist_ok=True)
+    path = ModelStorePath(store_dir, key)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+
+    with Dataset(tmp_path, "w", format="NETCDF4") as nc:
+        nc.createDimension("sites", len(lats))
+        nc.createDimension("years", len(years))
+        nc.createVariable("years", "i4", ("years",))[:] = years
+        nc.createVariable("lat", "f8", ("sites",))[:] = lats
+        nc.createVariable("lon", "f8", ("sites",))[:] = lons
+        data_var = nc.createVariable(varname, "f8", ("sites", "years"), zlib=True)
+        data_var[:] = data
+        nc.description = "Localized {} of {} for tlm-sterodynamics".format(
+            varname, model
+        )
+        nc.model = model
+        nc.key = key
+
+    # Renamed into place so concurrent readers never see a partial store
+    os.replace(tmp_path, path)
+    logger.debug(
+        "Added {} sites to model store for {}, now {} sites".format(
+            len(first_idx), model, len(lats)
+        )
+    )
@@ -0,0 +1,225 @@
+import logging
+import os
+from contextlib import contextmanager
+
+import dask
+from threadpoolctl import threadpool_limits
+
+""" parallel.py
+
+Configures how the dask graph for localized projections is executed and caps
+BLAS/OpenMP threads so dask workers and native thread pools do not
+oversubscribe shared nodes.
+
+Parameters:
+scheduler = One of "synchronous", "threads", "processes", or "distributed"
+num_workers = Number of dask threads/processes, or local cluster workers
+threads_per_worker = Threads per worker of a local dask.distributed cluster
+worker_memory_limit = Per-worker memory limit of a local dask.distributed cluster
+memory_limit = Memory for localized projections, shared by all tasks running at once
+
+"""
+
+logger = logging.getLogger(__name__)
+
+SCHEDULERS = ("synchronous", "threads", "processes", "distributed")
+
+# Environment variables read by common BLAS and OpenMP runtimes. These are
+# inherited by spawned worker processes.
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "NUMBA_NUM_THREADS",
+)
+
+# Share of the memory limit used by chunks. The rest is headroom for dask,
+# the ocean dynamics fits, and the thermal expansion samples.
+CHUNK_MEMORY_FRACTION = 0.5
+
+
+def concurrent_tasks(scheduler, num_workers=None, threads_per_worker=None):
+    """Number of dask tasks that may run at once"""
+    if scheduler == "synchronous":
+        return 1
+    ntasks = num_workers or os.cpu_count() or 1
+    if scheduler == "distributed" and threads_per_worker is not None:
+        ntasks *= threads_per_worker
+    return ntasks
+
+
+def location_memory(nsamps, nyears):
+    """
+    Approximate bytes per location of a task generating local samples.
+
+    The float32 output block is counted twice, for the copy made when it is
+    written.
+    """
+    return 8 * nsamps * nyears
+
+
+def task_memory(nsamps, nyears):
+    """
+    Approximate fixed bytes of a task generating local samples.
+
+    Each task holds float64 and float32 copies of the thermal expansion
+    samples and their anomaly for its samples, however many locations it has.
+    """
+    return 24 * nsamps * nyears
+
+
+def chunk_memory(nlocations, nsamps, nyears):
+    """Approximate peak bytes of one task generating local samples"""
+    return nlocations * location_memory(nsamps, nyears) + task_memory(nsamps, nyears)
+
+
+def auto_chunksizes(
+    memory_limit,
+    nlocations,
+    nsamps,
+    nyears,
+    ntasks,
+    chunksize=None,
+    sample_chunksize=None,
+    whole_samples=False,
+    location_multiple=1,
+):
+    """
+    Location and sample chunk sizes so ``ntasks`` tasks fit in ``memory_limit``.
+
+    A given ``chunksize`` or ``sample_chunksize`` is kept. Location chunks are
+    a multiple of ``location_multiple`` and no larger than needed to give each
+    task a chunk. Chunks hold every sample unless that does not fit and
+    ``whole_samples`` is not set. Returns (chunksize, sample_chunksize), where
+    a sample_chunksize of None means every sample at once.
+    """
+    budget = memory_limit * CHUNK_MEMORY_FRACTION / ntasks
+
+    if chunksize is None:
+        # Enough location chunks to keep every task busy
+        most_locations = -(-nlocations // ntasks)
+        most_locations = -(-most_locations // location_multiple) * location_multiple
+        task_nsamps = sample_chunksize or nsamps
+        fits = int(
+            max(0, budget - task_memory(task_nsamps, nyears))
+            // location_memory(task_nsamps, nyears)
+        )
+        fits = fits // location_multiple * location_multiple
+        chunksize = max(location_multiple, min(fits, most_locations))
+
+    if sample_chunksize is None and chunk_memory(chunksize, nsamps, nyears) > budget:
+        if whole_samples:
+            logger.warning(
+                f"Chunks of {chunksize} locations with all {nsamps} samples do not fit in the memory limit"
+            )
+        else:
+            sample_chunksize = int(budget // chunk_memory(chunksize, 1, nyears))
+            sample_chunksize = max(1, min(sample_chunksize, nsamps))
+
+    return (chunksize, sample_chunksize)
+
+
+def native_thread_limit(scheduler, num_workers=None):
+    """
+    Number of BLAS/OpenMP threads each dask task may use.
+
+    Parallel schedulers get their parallelism from dask itself, so native
+    thread pools are capped to one thread per task. The synchronous scheduler
+    runs one task at a time and may use ``num_workers`` native threads instead.
+    Returns None if native threads should be left alone.
+    """
+    if scheduler == "synchronous":
+        return num_workers
+    return 1
+
+
+@contextmanager
+def limit_native_threads(nthreads):
+    """
+    Context manager capping BLAS/OpenMP threads to ``nthreads``.
+
+    Sets the runtime environment variables for any processes spawned in the
+    context and limits the thread pools already loaded into this process with
+    threadpoolctl. Does nothing if ``nthreads`` is None.
+    """
+    if nthreads is None:
+        yield
+        return
+
+    saved_env = {k: os.environ.get(k) for k in THREAD_ENV_VARS}
+    os.environ.update({k: str(nthreads) for k in THREAD_ENV_VARS})
+
+    try:
+        with threadpool_limits(limits=nthreads):
+            yield
+    finally:
+        for k, v in saved_env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+@contextmanager
+def parallel_execution(
+    scheduler="threads",
+    num_workers=None,
+    threads_per_worker=None,
+    worker_memory_limit="auto",
+):
+    """
+    Context manager running dask computations with the requested scheduler.
+
+    The "processes" and "distributed" schedulers start a local
+    ``dask.distributed`` cluster of worker processes that is shut down when
+    the context exits. "processes" workers are single-threaded.
+    """
+    if scheduler not in SCHEDULERS:
+        raise ValueError(
+            f"Invalid scheduler {scheduler!r}, must be one of {', '.join(SCHEDULERS)}"
+        )
+
+    nthreads = native_thread_limit(scheduler, num_workers)
+    with limit_native_threads(nthreads):
+        if scheduler in ("processes", "distributed"):
+            # xarray cannot share its netCDF write lock with the processes of
+            # dask's multiprocessing scheduler, so process-based execution
+            # runs on a local dask.distributed cluster of worker processes.
+            if scheduler == "processes":
+                threads_per_worker = 1
+            with _local_cluster(
+                num_workers, threads_per_worker, worker_memory_limit, nthreads
+            ):
+                yield
+        else:
+            config = {"scheduler": scheduler}
+            if num_workers is not None:
+                config["num_workers"] = num_workers
+            with dask.config.set(config):
+                logger.debug(f"Using dask {scheduler} scheduler")
+                yield
+
+
+@contextmanager
+def _local_cluster(n_workers, threads_per_worker, memory_limit, nthreads):
+    from dask.distributed import Client, LocalCluster
+
+    # Workers are spawned with these environment variables set.
+    worker_env = dict(dask.config.get("distributed.nanny.pre-spawn-environ"))
+    if nthreads is not None:
+        worker_env.update({k: str(nthreads) for k in THREAD_ENV_VARS})
+
+    with (
+        dask.config.set({"distributed.nanny.pre-spawn-environ": worker_env}),
+        LocalCluster(
+            n_workers=n_workers,
+            threads_per_worker=threads_per_worker,
+            memory_limit=memory_limit,
+            processes=True,
+        ) as cluster,
+        Client(cluster) as client,
+    ):
+        logger.info(f"Started local dask cluster {client.dashboard_link}")
+        yield
@@ -0,0 +1,448 @@
+import os
+
+import h5py
+import numpy as np
+from dask.utils import format_bytes
+from netCDF4 import Dataset
+
+from tlm_sterodynamics.grid_locations import GridLocations
+from tlm_sterodynamics.parallel import auto_chunksizes, chunk_memory
+from tlm_sterodynamics.read_locationfile import LocationShard, ReadLocationFile
+from tlm_sterodynamics.tlm_sterodynamics_preprocess_oceandynamics import (
+    FindInputModels,
+)
+
+""" plan.py
+
+Plans a run without doing the heavy work. Checks that the inputs exist and
+hold the scenario, then estimates the peak memory, bytes read, output size,
+and runtime of the run from file metadata, the CMIP6 model manifest, the
+number of locations, and the projection years.
+
+Parameters:
+scenario = Scenario of the climate samples
+scenario_dsl = Scenario of the CMIP6 models
+model_dir = Directory of 'tas', 'zos', and 'zostoga' CMIP6 model output
+targyears = Projection years
+nsamps = Number of samples
+ntasks = Number of dask tasks that run at once
+
+Estimates are rough. Reads assume whole model files are read, so they are an
+upper bound when localizing points, which only reads the grid box around them,
+and when stores already hold sites or models. Runtimes use the rates below,
+measured on one core of a typical node. They leave out the thermal expansion
+and ocean dynamics fits, which only fit a few values per model or location and
+take a small part of a run.
+
+"""
+
+# Years ocean dynamics are localized and fit for
+OD_DATA_YEARS = (1861, 2300)
+
+# First year of the two-layer model climate samples
+CLIMATE_FIRST_YEAR = 1750
+
+# Memory of the interpreter and libraries before any data is loaded
+BASE_MEMORY = 250 * 2**20
+
+# Rates used to project runtime
+READ_BYTES_PER_SECOND = 500e6
+SITE_MODEL_SECONDS = 0.008
+SAMPLE_VALUES_PER_SECOND = 25e6
+
+
+def ModelFile(model_dir, varname, model, runtype):
+    """Path of the CMIP6 file of a model run, or None if there is none"""
+    directory = os.path.join(model_dir, varname, model)
+    prefix = "{}_Omon_{}_{}".format(varname, model, runtype)
+    if not os.path.isdir(directory):
+        return None
+    for filename in sorted(os.listdir(directory)):
+        if filename.startswith(prefix):
+            return os.path.join(directory, filename)
+    return None
+
+
+def ModelManifest(model_dir, scenario):
+    """
+    CMIP6 models that have every file the run needs.
+
+    Returns the selected (model, scenario) pairs, a dict of the reason each
+    other model is left out, and the zos and zostoga files of selected models.
+    """
+    (include_models, include_scenarios) = FindInputModels(
+        os.path.join(model_dir, "tas"), os.path.join(model_dir, "zos"), scenario
+    )
+    selected = []
+    excluded = {}
+    files = {"zos": [], "zostoga": []}
+    for model, model_scenario in zip(include_models, include_scenarios):
+        model_files = {
+            (varname, runtype): ModelFile(model_dir, varname, model, runtype)
+            for varname in files
+            for runtype in ("historical", model_scenario)
+        }
+        missing = [
+            "{} {}".format(*key) for key, path in model_files.items() if path is None
+        ]
+        if missing:
+            excluded[model] = "no " + ", ".join(missing)
+            continue
+        selected.append((model, model_scenario))
+        for (varname, _), path in model_files.items():
+            files[varname].append(path)
+    return (selected, excluded, files)
+
+
+def ClimateSamples(climate_data_file, scenario, problems):
+    """
+    Number of climate samples and years of the scenario, and bytes to read.
+
+    Temperature target scenarios read every scenario and keep a subset of the
+    samples, so the number of samples is an upper bound for them.
+    """
+    try:
+        hf = h5py.File(climate_data_file, "r")
+    except OSError as e:
+        problems.append("Cannot open climate data file: {}".format(e))
+        return (0, 0, 0)
+    with hf:
+        if scenario.startswith("tlim"):
+            scenarios = [k for k in hf.keys() if k != "year"]
+            variables = ("ocean_heat_content", "surface_temperature")
+        else:
+            scenarios = [scenario]
+            variables = ("ocean_heat_content",)
+        nsamps = 0
+        nyears = 0
+        nbytes = 0
+        for this_scenario in scenarios:
+            if this_scenario not in hf:
+                problems.append(
+                    "Scenario {} is not in {}".format(this_scenario, climate_data_file)
+                )
+                continue
+            for variable in variables:
+                if variable not in hf[this_scenario]:
+                    problems.append(
+                        "{} has no {} for {}".format(
+                            climate_data_file, variable, this_scenario
+                        )
+                    )
+                    continue
+                dset = hf[this_scenario][variable]
+                nbytes += dset.id.get_storage_size()
+            if "ocean_heat_content" in hf[this_scenario]:
+                (nyears, scenario_samps) = hf[this_scenario]["ocean_heat_content"].shape
+                nsamps += scenario_samps
+    return (nsamps, nyears, nbytes)
+
+
+def ReusedSamples(gslr_file, nsamps, targyears, problems):
+    """Check from its header that a global SLR file holds the samples to reuse"""
+    try:
+        nc = Dataset(gslr_file, "r")
+    except OSError as e:
+        problems.append("Cannot open global SLR file to reuse: {}".format(e))
+        return
+    with nc:
+        if nc.dimensions.get("samples") is None:
+            problems.append("{} holds quantiles, not samples".format(gslr_file))
+        elif len(nc.dimensions["samples"]) != nsamps:
+            problems.append(
+                "{} holds {} samples, but nsamps is {}".format(
+                    gslr_file, len(nc.dimensions["samples"]), nsamps
+                )
+            )
+        if "years" not in nc.variables or not np.array_equal(
+            nc.variables["years"][:], targyears
+        ):
+            problems.append(
+                "Years in {} do not match the projection years".format(gslr_file)
+            )
+
+
+def CountLocations(location_file, location_shard, location_grid, model_dir, models):
+    """Number of locations to localize"""
+    if location_grid is None:
+        location_file = os.path.join(os.path.dirname(__file__), location_file)
+        (_, site_ids, _, _) = ReadLocationFile(location_file, shard=location_shard)
+        return len(site_ids)
+
+    (coarsen, coastal_band) = location_grid
+    (_, site_ids, _, _, _) = GridLocations(
+        os.path.join(model_dir, "zos"),
+        models,
+        coarsen=coarsen,
+        coastal_band=coastal_band,
+    )
+    if location_shard is None:
+        return len(site_ids)
+    shard = LocationShard(len(site_ids), *location_shard)
+    return shard.stop - shard.start
+
+
+def VariableBytes(path, varname):
+    """Uncompressed bytes of a netCDF variable, from its header"""
+    with Dataset(path, "r") as nc:
+        var = nc.variables[varname]
+        return int(np.prod(var.shape)) * var.dtype.itemsize
+
+
+def PlanRun(
+    scenario,
+    scenario_dsl,
+    model_dir,
+    climate_data_file,
+    expansion_coefficients_file,
+    gsat_rmses_file,
+    location_file,
+    targyears,
+    baseyear,
+    nsamps,
+    ntasks,
+    chunksize,
+    sample_chunksize=None,
+    location_shard=None,
+    location_grid=None,
+    output_quantiles=None,
+    output_gslr_file=None,
+    output_lslr_file=None,
+    reuse_gslr_file=False,
+    projection_blocksize=None,
+    memory_limit=None,
+    zarr_chunk_locations=None,
+):
+    """
+    Plan of a run, as a dict.
+
+    Chunk sizes that are None are picked from ``memory_limit``, as in a run.
+    Problems that would stop the run are listed under "problems".
+    """
+    problems = []
+    nyears = len(targyears)
+    nquantiles = None if output_quantiles is None else len(output_quantiles)
+
+    output_dirs = {
+        os.path.dirname(os.path.abspath(path))
+        for path in (output_gslr_file, output_lslr_file)
+        if path
+    }
+    for directory in sorted(output_dirs):
+        if not os.path.isdir(directory):
+            problems.append("Output directory {} does not exist".format(directory))
+
+    if location_shard is not None and not reuse_gslr_file:
+        problems.append(
+            "Shard runs must reuse the global SLR file, so they do not all write it"
+        )
+
+    bytes_read = {"thermal_expansion": 0, "zostoga": 0, "zos": 0}
+
+    # Thermal expansion inputs
+    climate_samps = 0
+    climate_years = 0
+    if reuse_gslr_file:
+        if not output_lslr_file:
+            problems.append("Reusing the global SLR file needs a local SLR file")
+        ReusedSamples(output_gslr_file, nsamps, targyears, problems)
+        bytes_read["thermal_expansion"] = nsamps * nyears * 4
+    else:
+        for path, name in (
+            (climate_data_file, "climate data"),
+            (expansion_coefficients_file, "expansion coefficients"),
+            (gsat_rmses_file, "GSAT RMSEs"),
+        ):
+            if path is None:
+                problems.append("No {} file given".format(name))
+            elif name != "climate data" and not os.path.isfile(path):
+                problems.append("Input file {} does not exist".format(path))
+        if climate_data_file is not None:
+            (climate_samps, climate_years, bytes_read["thermal_expansion"]) = (
+                ClimateSamples(climate_data_file, scenario, problems)
+            )
+        if climate_samps and nsamps > climate_samps:
+            problems.append(
+                "nsamps is {}, but there are only {} climate samples".format(
+                    nsamps, climate_samps
+                )
+            )
+        climate_last_year = CLIMATE_FIRST_YEAR + climate_years - 1
+        if climate_years and not (
+            CLIMATE_FIRST_YEAR <= min(targyears) and max(targyears) <= climate_last_year
+        ):
+            problems.append(
+                "Projection years must be within the climate years {}-{}".format(
+                    CLIMATE_FIRST_YEAR, climate_last_year
+                )
+            )
+
+    if not (OD_DATA_YEARS[0] <= min(targyears) and max(targyears) <= OD_DATA_YEARS[1]):
+        problems.append("Projection years must be within {}-{}".format(*OD_DATA_YEARS))
+    if not (OD_DATA_YEARS[0] <= baseyear <= OD_DATA_YEARS[1]):
+        problems.append("Baseyear must be within {}-{}".format(*OD_DATA_YEARS))
+
+    # CMIP6 model manifest
+    selected = []
+    excluded = {}
+    largest_zos = 0
+    missing_subdirs = [
+        subdir
+        for subdir in ("tas", "zos", "zostoga")
+        if not os.path.isdir(os.path.join(model_dir, subdir))
+    ]
+    if missing_subdirs:
+        problems.append(
+            "Model directory {} has no {}".format(model_dir, ", ".join(missing_subdirs))
+        )
+    else:
+        try:
+            (selected, excluded, files) = ModelManifest(model_dir, scenario_dsl)
+        except (OSError, ValueError) as e:
+            problems.append(str(e))
+        else:
+            if not selected:
+                problems.append("No CMIP6 models found for {}".format(scenario_dsl))
+            for varname in ("zostoga", "zos"):
+                bytes_read[varname] = sum(os.path.getsize(f) for f in files[varname])
+            if files["zos"]:
+                largest_zos = max(VariableBytes(f, "zos") for f in files["zos"])
+    models = [model for (model, _) in selected]
+
+    # Locations
+    nlocations = 0
+    if location_grid is not None and location_file is not None:
+        problems.append("A location file cannot be used with the location grid")
+    elif location_grid is None and location_file is None:
+        problems.append("No location file or location grid given")
+    elif selected or location_grid is None:
+        try:
+            nlocations = CountLocations(
+                location_file, location_shard, location_grid, model_dir, models
+            )
+        except (OSError, ValueError) as e:
+            problems.append("Cannot read locations: {}".format(e))
+
+    if memory_limit is not None and nlocations:
+        (chunksize, sample_chunksize) = auto_chunksizes(
+            memory_limit,
+            nlocations,
+            nsamps,
+            nyears,
+            ntasks,
+            chunksize=chunksize,
+            sample_chunksize=sample_chunksize,
+            whole_samples=output_quantiles is not None,
+            location_multiple=zarr_chunk_locations or 1,
+        )
+    if chunksize is None:
+        chunksize = 1
+    if output_quantiles is not None or sample_chunksize is None:
+        sample_chunksize = nsamps
+
+    # Ocean dynamics is only read and fit for local projections
+    if not output_lslr_file:
+        (bytes_read["zostoga"], bytes_read["zos"]) = (0, 0)
+        (largest_zos, nlocations) = (0, 0)
+
+    # Output sizes, uncompressed
+    gslr_values = nyears * (nsamps if nquantiles is None else nquantiles + 2)
+    lslr_values = nlocations * gslr_values
+    output_bytes = {
+        "gslr": 0 if reuse_gslr_file else 4 * gslr_values,
+        "lslr": 4 * lslr_values if output_lslr_file else 0,
+    }
+
+    # Peak memory of each stage beyond the inputs kept for the whole run
+    ndatayears = OD_DATA_YEARS[1] - OD_DATA_YEARS[0] + 1
+    te_inputs = 8 * climate_samps * climate_years
+    block = projection_blocksize or nsamps
+    stage_memory = {
+        "preprocess_thermalexpansion": 2 * te_inputs,
+        # Masked float32 ZOS of one model and the localized series of all models
+        "preprocess_oceandynamics": largest_zos * 5 // 4
+        + 32 * ndatayears * nlocations * len(models),
+        "project_thermalexpansion": 8 * nsamps * nyears + 24 * block * nyears,
+        "postprocess_oceandynamics": 0,
+    }
+    if output_lslr_file:
+        nchunks = -(-nlocations // chunksize) * -(-nsamps // sample_chunksize)
+        stage_memory["postprocess_oceandynamics"] = 24 * nsamps * nyears + min(
+            ntasks, nchunks
+        ) * chunk_memory(chunksize, sample_chunksize, nyears)
+    peak_memory = BASE_MEMORY + te_inputs + max(stage_memory.values())
+
+    # Projected runtime of each stage
+    runtime = {
+        "preprocess_thermalexpansion": bytes_read["thermal_expansion"]
+        / READ_BYTES_PER_SECOND,
+        "preprocess_oceandynamics": (bytes_read["zos"] + bytes_read["zostoga"])
+        / READ_BYTES_PER_SECOND
+        + SITE_MODEL_SECONDS * nlocations * len(models),
+        "project_thermalexpansion": 0.0,
+        "postprocess_oceandynamics": 0.0,
+    }
+    if not reuse_gslr_file:
+        runtime["project_thermalexpansion"] = nsamps * nyears / SAMPLE_VALUES_PER_SECOND
+    if output_lslr_file:
+        runtime["postprocess_oceandynamics"] = (
+            nlocations * nsamps * nyears / (SAMPLE_VALUES_PER_SECOND * ntasks)
+        )
+
+    return {
+        "problems": problems,
+        "scenario": scenario,
+        "models": selected,
+        "excluded_models": excluded,
+        "locations": nlocations,
+        "samples": nsamps,
+        "climate_samples": climate_samps,
+        "years": nyears,
+        "tasks": ntasks,
+        "chunksize": chunksize,
+        "sample_chunksize": sample_chunksize,
+        "bytes_read": bytes_read,
+        "output_bytes": output_bytes,
+        "stage_memory_bytes": stage_memory,
+        "peak_memory_bytes": peak_memory,
+        "runtime_seconds": runtime,
+    }
+
+
+def FormatPlan(plan):
+    """Readable summary of a plan"""
+    models = [
+        model if model_scenario == plan["scenario"] else f"{model} ({model_scenario})"
+        for (model, model_scenario) in plan["models"]
+    ]
+    lines = ["Models ({}): {}".format(len(models), ", ".join(models) or "none")]
+    for model, reason in sorted(plan["excluded_models"].items()):
+        lines.append("  Excluded {}: {}".format(model, reason))
+    lines += [
+        "Locations: {}".format(plan["locations"]),
+        "Samples: {}".format(plan["samples"]),
+        "Projection years: {}".format(plan["years"]),
+        "Chunks: {} locations x {} samples, {} tasks at once".format(
+            plan["chunksize"], plan["sample_chunksize"], plan["tasks"]
+        ),
+        "Bytes to read: {} (thermal expansion {}, zostoga {}, zos up to {})".format(
+            format_bytes(sum(plan["bytes_read"].values())),
+            format_bytes(plan["bytes_read"]["thermal_expansion"]),
+            format_bytes(plan["bytes_read"]["zostoga"]),
+            format_bytes(plan["bytes_read"]["zos"]),
+        ),
+        "Output size: global {}, local {} (uncompressed)".format(
+            format_bytes(plan["output_bytes"]["gslr"]),
+            format_bytes(plan["output_bytes"]["lslr"]),
+        ),
+        "Estimated peak memory: {}".format(format_bytes(plan["peak_memory_bytes"])),
+        "Projected runtime: {:.0f}s, not counting the fit stages".format(
+            sum(plan["runtime_seconds"].values())
+        ),
+    ]
+    for stage, seconds in plan["runtime_seconds"].items():
+        lines.append("  {}: {:.0f}s".format(stage, seconds))
+    if plan["problems"]:
+        lines.append("Problems:")
+        lines += ["  " + problem for problem in plan["problems"]]
+    return "\n".join(lines)
@@ -0,0 +1,90 @@
+import numpy as np
+
+""" random_streams.py
+
+Reproducible random draws that only depend on the seed and the index of each
+sample, so results are identical however samples are split into blocks,
+chunks, workers, or location shards.
+
+Samples are grouped into fixed blocks of SAMPLE_BLOCK samples. Each block has
+its own generator, seeded with SeedSequence(seed, spawn_key=(stream, block)),
+which always draws a whole block. Draws for any range of samples are cut from
+the blocks that cover it.
+
+Permutations of samples are a keyed Feistel network over the sample indices,
+so the position of any sample can be computed on its own.
+
+Parameters:
+seed = Seed of the run
+stream = Which random quantity is drawn (one of the *_STREAM constants)
+
+"""
+
+# Number of samples drawn by each generator. Changing this changes draws.
+SAMPLE_BLOCK = 4096
+
+# Independent streams of random draws
+EXPCOEF_STREAM = 0
+QUANTILE_STREAM = 1
+
+# Rounds of the Feistel network used for permutations
+FEISTEL_ROUNDS = 6
+
+
+def SampleBlockRNG(seed, stream, block):
+    """Generator for one block of samples of a stream"""
+    return np.random.default_rng(
+        np.random.SeedSequence(seed, spawn_key=(stream, block))
+    )
+
+
+def SampleNormal(seed, stream, start, stop):
+    """Standard normal draws for samples [start, stop)"""
+    draws = np.empty(stop - start)
+    for block in range(start // SAMPLE_BLOCK, -(-stop // SAMPLE_BLOCK)):
+        block_start = block * SAMPLE_BLOCK
+        lo = max(start, block_start)
+        hi = min(stop, block_start + SAMPLE_BLOCK)
+        block_draws = SampleBlockRNG(seed, stream, block).standard_normal(SAMPLE_BLOCK)
+        draws[lo - start : hi - start] = block_draws[
+            lo - block_start : hi - block_start
+        ]
+    return draws
+
+
+def _mix(x):
+    """64-bit integer mixing function (the splitmix64 finalizer)"""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def SamplePermutation(seed, stream, n, start, stop):
+    """
+    Position of samples [start, stop) in a random permutation of range(n).
+
+    The permutation is a Feistel network on the smallest even number of bits
+    covering n. Positions outside [0, n) are walked through the network again
+    until they fall inside, which keeps it a permutation of range(n).
+    """
+    half_bits = max(1, (int(n - 1).bit_length() + 1) // 2)
+    half_mask = np.uint64((1 << half_bits) - 1)
+    shift = np.uint64(half_bits)
+    keys = np.random.SeedSequence(seed, spawn_key=(stream,)).generate_state(
+        FEISTEL_ROUNDS, dtype=np.uint64
+    )
+
+    def feistel(x):
+        left = x >> shift
+        right = x & half_mask
+        with np.errstate(over="ignore"):
+            for key in keys:
+                (left, right) = (right, left ^ (_mix(right ^ key) & half_mask))
+        return (left << shift) | right
+
+    x = np.arange(start, stop, dtype=np.uint64)
+    outside = np.ones(len(x), dtype=bool)
+    while np.any(outside):
+        x[outside] = feistel(x[outside])
+        outside = x >= np.uint64(n)
+    return x.astype(np.int64)
@@ -1,48 +1,232 @@
+import io
 import numpy as np
-import re
+import os
 
 """ read_locationfile.py
 
 Reads in the location file in order to get site names, site ids, lats, and lons
 
 Parameters:
-location_file = Background Rate file
+location_file = Tab-separated location file, or a NetCDF (.nc), NumPy (.npy), or
+                Parquet (.parquet) file of locations
+shard = Optional (shard index, number of shards) pair. If given, only return the
+        locations in this zero-based shard of the file.
 
 """
 
 
-def ReadLocationFile(location_file):
-    # Initialize variables to hold data and site information
-    names = []
-    ids = []
-    lats = []
-    lons = []
-
-    # Compile the regex for finding commented lines
-    comment_regex = re.compile(r"^#")
-
-    # Open the rate file
-    with open(location_file, "r") as f:
-        # Loop over the lines of the file
-        for line in f:
-            # Skip commented lines
-            if re.search(comment_regex, line):
-                continue
-
-            # Split the line into components
-            (this_name, this_id, this_lat, this_lon) = line.split("\t")
-
-            # Store the information
-            names.append(this_name)
-            ids.append(int(this_id))
-            lats.append(float(this_lat))
-            lons.append(float(this_lon))
-
-    # Cast everything as numpy arrays
-    names = np.array(names)
-    ids = np.array(ids)
-    lats = np.array(lats)
-    lons = np.array(lons)
+def LocationShard(n_locations, shard_index, nshards):
+    """
+    Slice of the locations that make up a shard.
+
+    Locations are split, in file order, into ``nshards`` contiguous blocks of
+    nearly equal size so every run over the same location file partitions it
+    the same way. Shards are zero-indexed.
+    """
+    if nshards < 1 or not (0 <= shard_index < nshards):
+        raise ValueError(
+            "Invalid location shard {}/{}, shard index must be within [0, {})".format(
+                shard_index, nshards, nshards
+            )
+        )
+    size, extra = divmod(n_locations, nshards)
+    start = shard_index * size + min(shard_index, extra)
+    stop = start + size + (1 if shard_index < extra else 0)
+    if start == stop:
+        raise ValueError(
+            "Location shard {}/{} is empty, there are only {} locations".format(
+                shard_index, nshards, n_locations
+            )
+        )
+    return slice(start, stop)
+
+
+# File extensions of binary location files
+NETCDF_EXTENSIONS = (".nc", ".nc4", ".netcdf")
+NUMPY_EXTENSIONS = (".npy",)
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+
+
+def ReadTextLocations(location_file):
+    """
+    Parse a tab-separated location file in one vectorized pass.
+
+    Lines are name, id, lat, lon. Files with only id, lat, and lon are also
+    accepted, in which case names are the ids. Extra fields are ignored.
+    """
+    # Scan the raw bytes for the number of fields and the longest name, so the
+    # whole file can be parsed into a typed array at once
+    with open(location_file, "rb") as f:
+        data = f.read()
+    nfields = None
+    for line in io.BytesIO(data):
+        if line.strip() and not line.startswith(b"#"):
+            nfields = len(line.split(b"\t"))
+            break
+    if nfields is None:
+        return (
+            np.array([], dtype=str),
+            np.array([], dtype=int),
+            np.array([]),
+            np.array([]),
+        )
+    if nfields < 3:
+        raise ValueError(
+            "Location file {} needs name, id, lat, and lon fields separated by tabs".format(
+                location_file
+            )
+        )
+
+    raw = np.frombuffer(data, dtype=np.uint8)
+    line_starts = np.concatenate(([0], np.flatnonzero(raw == ord("\n")) + 1))
+    if nfields == 3:
+        dtype = [("id", "i8"), ("lat", "f8"), ("lon", "f8")]
+    else:
+        tabs = np.flatnonzero(raw == ord("\t"))
+        first_tabs = tabs[np.minimum(np.searchsorted(tabs, line_starts), len(tabs) - 1)]
+        max_name = max(1, int(np.max(first_tabs - line_starts, initial=1)))
+        dtype = [
+            ("name", "U{}".format(max_name)),
+            ("id", "i8"),
+            ("lat", "f8"),
+            ("lon", "f8"),
+        ]
+
+    # Only lines starting with '#' are comments. If '#' also appears elsewhere,
+    # such as in a name, comment lines are dropped before parsing.
+    hashes = np.flatnonzero(raw == ord("#"))
+    hash_lines = np.minimum(np.searchsorted(line_starts, hashes), len(line_starts) - 1)
+    if np.all(line_starts[hash_lines] == hashes):
+        lines = location_file
+        comments = "#"
+    else:
+        lines = (
+            line for line in io.StringIO(data.decode()) if not line.startswith("#")
+        )
+        comments = None
+
+    table = np.loadtxt(
+        lines,
+        delimiter="\t",
+        comments=comments,
+        dtype=dtype,
+        usecols=np.arange(len(dtype)),
+        ndmin=1,
+    )
+
+    ids = table["id"]
+    if nfields == 3:
+        names = ids.astype(str)
+    else:
+        names = table["name"]
+        names = names.astype(
+            "U{}".format(max(1, np.max(np.char.str_len(names), initial=1)))
+        )
+
+    return (names, ids, table["lat"], table["lon"])
+
+
+def ReadNetCDFLocations(location_file):
+    """
+    Read locations from 1D 'lat' and 'lon' NetCDF variables.
+
+    Ids are read from a 'locations' or 'id' variable and names from a 'name'
+    variable, if present. Local SLR output files can be read this way.
+    """
+    from netCDF4 import Dataset
+
+    with Dataset(location_file, "r") as nc:
+        nc.set_auto_mask(False)
+        lats = np.asarray(nc.variables["lat"][:], dtype=float).ravel()
+        lons = np.asarray(nc.variables["lon"][:], dtype=float).ravel()
+        ids = np.arange(len(lats))
+        for name in ("locations", "id"):
+            if name in nc.variables:
+                ids = np.asarray(nc.variables[name][:]).ravel()
+                break
+        names = None
+        if "name" in nc.variables:
+            names = np.asarray(nc.variables["name"][:]).astype(str).ravel()
+
+    return (names, ids, lats, lons)
+
+
+def ReadNumpyLocations(location_file):
+    """
+    Read locations from a '.npy' array.
+
+    Either a structured array with 'lat' and 'lon' fields, and optionally 'id'
+    and 'name' fields, or a 2D array with columns lat, lon or id, lat, lon.
+    """
+    table = np.load(location_file, allow_pickle=False)
+    if table.dtype.names is not None:
+        fields = table.dtype.names
+        return (
+            table["name"] if "name" in fields else None,
+            table["id"] if "id" in fields else np.arange(len(table)),
+            table["lat"],
+            table["lon"],
+        )
+    if table.ndim == 2 and table.shape[1] == 2:
+        return (None, np.arange(len(table)), table[:, 0], table[:, 1])
+    if table.ndim == 2 and table.shape[1] == 3:
+        return (None, table[:, 0], table[:, 1], table[:, 2])
+    raise ValueError(
+        "Location file {} must be a structured array or have 2 (lat, lon) or 3 (id, lat, lon) columns".format(
+            location_file
+        )
+    )
+
+
+def ReadParquetLocations(location_file):
+    """
+    Read locations from 'lat' and 'lon' columns of a Parquet file.
+
+    'id' and 'name' columns are optional. Requires pyarrow.
+    """
+    import pandas as pd
+
+    try:
+        table = pd.read_parquet(location_file)
+    except ImportError as e:
+        raise ImportError(
+            "Reading Parquet location files requires pyarrow to be installed"
+        ) from e
+    return (
+        table["name"].to_numpy() if "name" in table else None,
+        table["id"].to_numpy() if "id" in table else np.arange(len(table)),
+        table["lat"].to_numpy(),
+        table["lon"].to_numpy(),
+    )
+
+
+def ReadLocationFile(location_file, shard=None):
+    # Read locations based on the file type
+    ext = os.path.splitext(location_file)[1].lower()
+    if ext in NETCDF_EXTENSIONS:
+        (names, ids, lats, lons) = ReadNetCDFLocations(location_file)
+    elif ext in NUMPY_EXTENSIONS:
+        (names, ids, lats, lons) = ReadNumpyLocations(location_file)
+    elif ext in PARQUET_EXTENSIONS:
+        (names, ids, lats, lons) = ReadParquetLocations(location_file)
+    else:
+        (names, ids, lats, lons) = ReadTextLocations(location_file)
+
+    # Cast everything as numpy arrays. Names default to the ids.
+    ids = np.asarray(ids).astype(int)
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    if names is None:
+        names = ids.astype(str)
+    names = np.asarray(names).astype(str)
+
+    # Only keep the locations in the requested shard
+    if shard is not None:
+        shard_idx = LocationShard(len(ids), *shard)
+        names = names[shard_idx]
+        ids = ids[shard_idx]
+        lats = lats[shard_idx]
+        lons = lons[shard_idx]
 
     # Return variables
     return (names, ids, lats, lons)
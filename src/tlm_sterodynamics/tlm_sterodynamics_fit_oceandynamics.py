@@ -2,6 +2,7 @@ import numpy as np
 import os
 import sys
 import argparse
+from tlm_sterodynamics.fit_store import MergeFitStore
 
 """ tlm_fit_oceandynamics.py
 
@@ -14,6 +15,182 @@ pipeline_id = Unique identifier for the pipeline running this code
 """
 
 
+def MyInterp(x, fp, good, extrap=False, no_neg_rate=False):
+    """
+    Interpolate/extrapolate values from years with enough models.
+
+    Operates on every column of 'fp' (years x sites) at once. Values between
+    good years are linearly interpolated. Outside of the good years, values are
+    linearly extrapolated with the mean rate of change of the good years in
+    2061-2100 if 'extrap', otherwise they are NaN before the first good year and
+    held at the last good value after it. Columns without good years are
+    undefined and should be handled by the caller.
+    """
+    nyears, ncols = fp.shape
+    cols = np.arange(ncols)
+    year_idx = np.arange(nyears)[:, np.newaxis]
+
+    # Nearest good year at or before/after each year
+    prev_idx = np.maximum.accumulate(np.where(good, year_idx, -1), axis=0)
+    next_idx = np.minimum.accumulate(np.where(good, year_idx, nyears)[::-1], axis=0)[
+        ::-1
+    ]
+    first_idx = np.argmax(good, axis=0)
+    last_idx = nyears - 1 - np.argmax(good[::-1], axis=0)
+
+    # Linear interpolation between neighboring good years (as in np.interp)
+    p = np.clip(prev_idx, 0, nyears - 1)
+    n = np.clip(next_idx, 0, nyears - 1)
+    fp_p = np.take_along_axis(fp, p, axis=0)
+    fp_n = np.take_along_axis(fp, n, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (fp_n - fp_p) / (x[n] - x[p])
+        out = slope * (x[:, np.newaxis] - x[p]) + fp_p
+    out = np.where(p == n, fp_p, out)
+
+    before = prev_idx < 0
+    after = next_idx >= nyears
+    fp_first = fp[first_idx, cols]
+    fp_last = fp[last_idx, cols]
+    if extrap:
+        # Rate of change between consecutive good years in 2061-2100. Columns
+        # are grouped by which years are good so that each rate is averaged
+        # exactly as it would be for a single column.
+        delta_mask = good & ((x > 2060) & (x <= 2100))[:, np.newaxis]
+        extrap_delta = np.full(ncols, np.nan)
+        packed = np.ascontiguousarray(np.packbits(delta_mask, axis=0).T)
+        patterns, pattern_idx = np.unique(
+            packed.view(np.dtype((np.void, packed.shape[1]))).ravel(),
+            return_inverse=True,
+        )
+        for k in np.arange(len(patterns)):
+            these_cols = np.flatnonzero(pattern_idx == k)
+            delta_idx = np.flatnonzero(delta_mask[:, these_cols[0]])
+            if len(delta_idx) < 2:
+                continue
+            these_fp = np.ascontiguousarray(fp[np.ix_(delta_idx, these_cols)].T)
+            extrap_delta[these_cols] = np.mean(
+                np.diff(these_fp, axis=1) / np.diff(x[delta_idx]), axis=1
+            )
+        if no_neg_rate:
+            extrap_delta[extrap_delta < 0.0] = 0.0
+
+        out = np.where(
+            before, fp_first + (x[:, np.newaxis] - x[first_idx]) * extrap_delta, out
+        )
+        out = np.where(
+            after, fp_last + (x[:, np.newaxis] - x[last_idx]) * extrap_delta, out
+        )
+    else:
+        out = np.where(before, np.nan, out)
+        out = np.where(after, fp_last, out)
+
+    return out
+
+
+# Approximate size in bytes of each scratch array used by OceanDynStats
+STATS_BLOCK_BYTES = 2**26
+
+
+def OceanDynStats(sZOS, sZOSTOGAadj, year_idx, year_2099_idx, no_correlation):
+    """
+    Mean, std, and number of models of ZOS and its correlation with ZOSTOGA.
+
+    Extreme models are removed first. Sites are processed in blocks so that
+    scratch memory stays near STATS_BLOCK_BYTES per array no matter the number
+    of sites, and each block is demeaned once and reused for the std and
+    correlation. 'sZOS' is (all years, models, sites), 'sZOSTOGAadj' is
+    already trimmed to 'year_idx'. Mean and std are in mm. Returns a
+    correlation of 0.0 if 'no_correlation'.
+    """
+    nsites = sZOS.shape[2]
+    nyears = len(year_idx)
+    block_size = max(1, STATS_BLOCK_BYTES // (nyears * sZOS.shape[1] * 8))
+
+    OceanDynMean = np.empty((nyears, nsites))
+    OceanDynStd = np.empty((nyears, nsites))
+    OceanDynN = np.empty((nyears, nsites), dtype=int)
+    OceanDynTECorr = 0.0 if no_correlation else np.empty((nyears, nsites))
+
+    # ZOSTOGA is only demeaned once. Missing years contribute nothing to the
+    # correlation sums.
+    if not no_correlation:
+        zostoga_demean = sZOSTOGAadj - np.nanmean(sZOSTOGAadj, axis=1)[:, np.newaxis]
+        zostoga_ss = np.nansum(zostoga_demean**2, axis=1)[:, np.newaxis]
+        zostoga_demean = np.nan_to_num(zostoga_demean, nan=0.0)[:, :, np.newaxis]
+
+    for start in np.arange(0, nsites, block_size):
+        block = slice(start, min(start + block_size, nsites))
+
+        # Pick out indices for year between 2000 and 2300 (consistent with K14)
+        # and trim data
+        zos = np.take(sZOS[:, :, block], year_idx, axis=0)
+        zos_2099 = zos[year_2099_idx, :, :]
+
+        # Determine which locations have enough models initially to warrant further
+        # checks on extremeness. Points with less than 7 models available are
+        # permitted to bypass the extremeness checks.
+        extremeness_model_check = np.sum(~np.isnan(zos_2099), axis=1) < 7
+
+        # For points that have enough pre-extremeness check models, calculate and
+        # remove "extremeness" as models whose year 2099 value is over 10x the
+        # median across models in year 2099.
+        ext_num = np.abs(zos_2099)
+        ext_denom = np.nanmedian(np.abs(zos_2099), axis=1)
+        extremeness = ext_num / ext_denom
+        with np.errstate(invalid="ignore"):
+            model_idx = (
+                extremeness < 10
+            )  # Wrapped in np.errstate call to surpress warning of 'nan' in less-than test
+        nan_mask = np.where(
+            np.logical_or(model_idx, extremeness_model_check), 1.0, np.nan
+        )
+        zos_2099 = zos_2099 * nan_mask
+
+        # For points that have enough pre-extremeness check models, calculate and
+        # remove "extremeness" as models that in year 2099 have values (less the
+        # mean across models) are greater than 3 standard deviations across models
+        ext_num = zos_2099 - np.nanmean(zos_2099, axis=1)
+        ext_denom = np.nanstd(zos_2099, axis=1)
+        extremeness = np.abs(ext_num / ext_denom)
+        std_limit = np.where(ext_denom < 0.2, 1, 0)
+        with np.errstate(invalid="ignore"):
+            model_idx = (
+                extremeness < 3
+            )  # Wrapped in np.errstate call to surpress warning of 'nan' in greater-than test
+        nan_mask *= np.where(
+            np.logical_or(model_idx, np.logical_or(extremeness_model_check, std_limit)),
+            1.0,
+            np.nan,
+        )
+        zos *= nan_mask
+
+        # Calculate the OD mean, std, and N. Missing values are zeroed so the
+        # sums below skip them, as np.nanmean and np.nanstd do.
+        missing = np.isnan(zos)
+        n = np.sum(~missing, axis=1)
+        np.copyto(zos, 0.0, where=missing)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.sum(zos, axis=1) / n
+            zos -= mean[:, np.newaxis, :]
+            np.copyto(zos, 0.0, where=missing)
+            zos_ss = np.sum(zos * zos, axis=1)
+            OceanDynMean[:, block] = mean * 1000.0
+            OceanDynStd[:, block] = np.sqrt(zos_ss / n) * 1000.0
+        OceanDynN[:, block] = n
+
+        # Calculate the correlation of ZOS with thermal expansion if needed
+        # Note: Correlation returns 'np.nan' if 'corr_denom' == 0
+        if not no_correlation:
+            zos *= zostoga_demean
+            corr_num = np.sum(zos, axis=1)
+            corr_denom = np.sqrt(zos_ss * zostoga_ss)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                OceanDynTECorr[:, block] = corr_num / corr_denom
+
+    return (OceanDynMean, OceanDynStd, OceanDynN, OceanDynTECorr)
+
+
 def tlm_fit_oceandynamics(my_config, my_zostoga, my_zos, pipeline_id):
     datayears = my_config["datayears"]
     no_correlation = my_config["no_correlation"]
@@ -23,38 +200,11 @@ def tlm_fit_oceandynamics(my_config, my_zostoga, my_zos, pipeline_id):
 
     sZOS = my_zos["sZOS"]
     sZOSTOGAadj = my_zos["sZOSTOGAadj"]
-    focus_site_ids = my_zos["focus_site_ids"]
 
     # Subset of data years
     year_idx = np.flatnonzero(np.logical_and(datayears > 2000, datayears <= 2300))
     year_2099_idx = np.flatnonzero(datayears[year_idx] == 2099)
 
-    # Function to replace locations/times where number of models is below a
-    # threshold with an interpolation/extrapolation.
-    def MyInterp(x, xp, fp, extrap=False, right=np.nan, left=np.nan, no_neg_rate=False):
-        sort_idx = np.argsort(xp)
-        temp_xp = xp[sort_idx]
-        temp_fp = fp[sort_idx]
-        delta_idx = np.flatnonzero(np.logical_and(temp_xp > 2060, temp_xp <= 2100))
-        extrap_delta = np.mean(
-            np.diff(temp_fp[delta_idx]) / np.diff(temp_xp[delta_idx])
-        )
-        if extrap_delta < 0.0 and no_neg_rate:
-            extrap_delta = 0.0
-
-        def pointwise(x):
-            if x < temp_xp[0]:
-                return temp_fp[0] + (x - temp_xp[0]) * extrap_delta
-            if x > temp_xp[-1]:
-                return temp_fp[-1] + (x - temp_xp[-1]) * extrap_delta
-            else:
-                return np.interp(x, temp_xp, temp_fp)
-
-        if extrap:
-            return np.array(list(map(pointwise, x)))
-        else:
-            return np.interp(x, xp, fp, left=left, right=right)
-
     # Minimum number of models needed for mean/sd/corr calculations
     # To Do: This should eventually be a commandline option
     min_n_models = 5
@@ -92,23 +242,22 @@ def tlm_fit_oceandynamics(my_config, my_zostoga, my_zos, pipeline_id):
     # Interpolate/extrapolate values as needed
     temp_good_idx = np.flatnonzero(ThermExpN >= min_n_models)
     if len(temp_good_idx) > 0:
+        temp_good = (ThermExpN >= min_n_models)[:, np.newaxis]
         temp_replace_idx = np.flatnonzero(ThermExpN <= min_n_models)
         ThermExpDOF[temp_replace_idx] = ThermExpN[temp_good_idx[-1]]
         ThermExpStd[temp_replace_idx] = MyInterp(
-            ThermExpYears[temp_replace_idx],
-            ThermExpYears[temp_good_idx],
-            ThermExpStd[temp_good_idx],
+            ThermExpYears,
+            ThermExpStd[:, np.newaxis],
+            temp_good,
             extrap=do_extrap,
-            right=ThermExpStd[temp_good_idx[-1]],
             no_neg_rate=True,
-        )
+        )[temp_replace_idx, 0]
         ThermExpMean[temp_replace_idx] = MyInterp(
-            ThermExpYears[temp_replace_idx],
-            ThermExpYears[temp_good_idx],
-            ThermExpMean[temp_good_idx],
+            ThermExpYears,
+            ThermExpMean[:, np.newaxis],
+            temp_good,
             extrap=do_extrap,
-            right=ThermExpMean[temp_good_idx[-1]],
-        )
+        )[temp_replace_idx, 0]
 
     else:
         ThermExpStd[:] = 0.0
@@ -130,72 +279,20 @@ def tlm_fit_oceandynamics(my_config, my_zostoga, my_zos, pipeline_id):
 
     # -------------------- Begin Ocean Dynamics -------------------------------------------
 
-    # Pick out indices for year between 2000 and 2300 (consistent with K14) and trim data
-    sZOS = sZOS[year_idx, :, :]
-
-    # Determine which locations have enough models initially to warrant further
-    # checks on extremeness. Points with less than 7 models available are
-    # permitted to bypass the extremeness checks.
-    extremeness_model_check = np.sum(~np.isnan(sZOS[year_2099_idx, :, :]), axis=1) < 7
-
-    # For points that have enough pre-extremeness check models, calculate and
-    # remove "extremeness" as models whose year 2099 value is over 10x the
-    # median across models in year 2099.
-    ext_num = np.abs(sZOS[year_2099_idx, :, :])
-    ext_denom = np.nanmedian(np.abs(sZOS[year_2099_idx, :, :]), axis=1)
-    extremeness = ext_num / ext_denom
-    with np.errstate(invalid="ignore"):
-        model_idx = (
-            extremeness < 10
-        )  # Wrapped in np.errstate call to surpress warning of 'nan' in less-than test
-    nan_mask = np.where(np.logical_or(model_idx, extremeness_model_check), 1.0, np.nan)
-    sZOS = sZOS * nan_mask
-
-    # For points that have enough pre-extremeness check models, calculate and
-    # remove "extremeness" as models that in year 2099 have values (less the
-    # mean across models) are greater than 3 standard deviations across models
-    ext_num = sZOS[year_2099_idx, :, :] - np.nanmean(sZOS[year_2099_idx, :, :], axis=1)
-    ext_denom = np.nanstd(sZOS[year_2099_idx, :, :], axis=1)
-    extremeness = np.abs(ext_num / ext_denom)
-    std_limit = np.where(ext_denom < 0.2, 1, 0)
-    with np.errstate(invalid="ignore"):
-        model_idx = (
-            extremeness < 3
-        )  # Wrapped in np.errstate call to surpress warning of 'nan' in greater-than test
-    nan_mask = np.where(
-        np.logical_or(model_idx, np.logical_or(extremeness_model_check, std_limit)),
-        1.0,
-        np.nan,
-    )
-    sZOS = sZOS * nan_mask
+    # Trim sZOSTOGAadj to the same year range as sZOS
+    sZOSTOGAadj = sZOSTOGAadj[year_idx, :]
 
-    # Calculate the OD mean, std, and N
-    OceanDynMean = np.nanmean(sZOS, axis=1) * 1000.0
-    OceanDynStd = np.nanstd(sZOS, axis=1) * 1000.0
-    OceanDynN = np.nansum(~np.isnan(sZOS), axis=1)
+    # Calculate the OD mean, std, N, and correlation with TE, after removing
+    # extreme models, a block of sites at a time
+    (OceanDynMean, OceanDynStd, OceanDynN, OceanDynTECorr) = OceanDynStats(
+        sZOS, sZOSTOGAadj, year_idx, year_2099_idx, no_correlation
+    )
     OceanDynDOF = np.copy(OceanDynN)
 
     # Any points that have 0 models available for the calculation should be have
     # the mean set to NAN
     OceanDynMean[OceanDynN == 0] = np.nan
 
-    # Trim sZOSTOGAadj to same year range as sZOS
-    sZOSTOGAadj = sZOSTOGAadj[year_idx, :]
-
-    # Calculate the correlation of ZOS with thermal expansion if needed
-    # Note: Correlation returns 'np.nan' if 'corr_denom' == 0
-    if no_correlation:
-        OceanDynTECorr = 0.0
-    else:
-        zos_demean = sZOS - np.nanmean(sZOS, axis=1)[:, np.newaxis, :]
-        zostoga_demean = sZOSTOGAadj - np.nanmean(sZOSTOGAadj, axis=1)[:, np.newaxis]
-        corr_num = np.nansum(zos_demean * zostoga_demean[:, :, np.newaxis], axis=1)
-        corr_denom = np.sqrt(
-            np.nansum(zos_demean**2, axis=1)
-            * np.nansum(zostoga_demean**2, axis=1)[:, np.newaxis]
-        )
-        OceanDynTECorr = corr_num / corr_denom
-
     # For consistency with original matlab code, apply the year 2100 extension
     # OceanDynMean[year_2099_idx+1,:] = OceanDynMean[year_2099_idx,:] + (OceanDynMean[year_2099_idx,:] - OceanDynMean[year_2099_idx-1,:])
     # OceanDynStd[year_2099_idx+1,:] = OceanDynStd[year_2099_idx,:] + (OceanDynStd[year_2099_idx,:] - OceanDynStd[year_2099_idx-1,:])
@@ -209,38 +306,42 @@ def tlm_fit_oceandynamics(my_config, my_zostoga, my_zos, pipeline_id):
     # Set any instance where correlation with TE is NAN to zero
     OceanDynTECorr[np.isnan(OceanDynTECorr)] = 0.0
 
-    # Interpolate/extrapolate values as needed
-    for i in np.arange(len(focus_site_ids)):
-        temp_good_idx = np.flatnonzero(OceanDynN[:, i] >= min_n_models)
-        if len(temp_good_idx) > 0:
-            temp_replace_idx = np.flatnonzero(OceanDynN[:, i] <= min_n_models)
-            OceanDynDOF[temp_replace_idx, i] = OceanDynN[temp_good_idx[-1], i]
-            OceanDynTECorr[temp_replace_idx, i] = MyInterp(
-                OceanDynYears[temp_replace_idx],
-                OceanDynYears[temp_good_idx],
-                OceanDynTECorr[temp_good_idx, i],
-                right=OceanDynTECorr[temp_good_idx[-1], i],
-            )
-            OceanDynStd[temp_replace_idx, i] = MyInterp(
-                OceanDynYears[temp_replace_idx],
-                OceanDynYears[temp_good_idx],
-                OceanDynStd[temp_good_idx, i],
-                extrap=do_extrap,
-                right=OceanDynStd[temp_good_idx[-1], i],
-                no_neg_rate=True,
-            )
-            OceanDynMean[temp_replace_idx, i] = MyInterp(
-                OceanDynYears[temp_replace_idx],
-                OceanDynYears[temp_good_idx],
-                OceanDynMean[temp_good_idx, i],
-                extrap=do_extrap,
-                right=OceanDynMean[temp_good_idx[-1], i],
-            )
+    # Interpolate/extrapolate values as needed, for all sites at once
+    temp_good = OceanDynN >= min_n_models
+    temp_has_good = np.any(temp_good, axis=0)
+    temp_replace = np.logical_and(OceanDynN <= min_n_models, temp_has_good)
+    temp_last_good_idx = len(OceanDynYears) - 1 - np.argmax(temp_good[::-1], axis=0)
+    OceanDynDOF = np.where(
+        temp_replace,
+        OceanDynN[temp_last_good_idx, np.arange(OceanDynN.shape[1])],
+        OceanDynDOF,
+    )
+    OceanDynTECorr = np.where(
+        temp_replace,
+        MyInterp(OceanDynYears, OceanDynTECorr, temp_good),
+        OceanDynTECorr,
+    )
+    OceanDynStd = np.where(
+        temp_replace,
+        MyInterp(
+            OceanDynYears,
+            OceanDynStd,
+            temp_good,
+            extrap=do_extrap,
+            no_neg_rate=True,
+        ),
+        OceanDynStd,
+    )
+    OceanDynMean = np.where(
+        temp_replace,
+        MyInterp(OceanDynYears, OceanDynMean, temp_good, extrap=do_extrap),
+        OceanDynMean,
+    )
 
-        else:
-            OceanDynStd[:, i] = 0.0
-            OceanDynMean[:, i] = np.nan  # 0.0
-            OceanDynTECorr[:, i] = 0.0
+    # Sites without enough models in any year
+    OceanDynStd[:, ~temp_has_good] = 0.0
+    OceanDynMean[:, ~temp_has_good] = np.nan  # 0.0
+    OceanDynTECorr[:, ~temp_has_good] = 0.0
 
     # Ensure correlation remains within [-1,1]
     OceanDynTECorr = np.maximum(-1.0, np.minimum(1.0, OceanDynTECorr))
@@ -260,6 +361,15 @@ def tlm_fit_oceandynamics(my_config, my_zostoga, my_zos, pipeline_id):
         "OceanDynTECorr": OceanDynTECorr,
     }
 
+    # Fill in sites from the fit store and store the newly fit sites
+    if my_zos.get("fit_store") is not None:
+        output_oceandynamics_fit = MergeFitStore(
+            my_zos["fit_store"],
+            output_oceandynamics_fit,
+            my_zos["focus_site_lats"],
+            my_zos["focus_site_lons"],
+        )
+
     return output_thermalexp_fit, output_oceandynamics_fit
 
 
@@ -1,11 +1,21 @@
 import numpy as np
 import time
 import argparse
+import warnings
 from scipy.stats import norm
 from scipy.stats import t
 
+import dask.array
 import xarray as xr
 
+from tlm_sterodynamics.encoding import NetCDFEncoding, ZarrCompressors
+from tlm_sterodynamics.random_streams import (
+    QUANTILE_STREAM,
+    SAMPLE_BLOCK,
+    SamplePermutation,
+)
+from tlm_sterodynamics.tracing import span, traced
+
 
 """ tlm_postprocess_oceandynamics.py
 
@@ -16,6 +26,8 @@ ocean dynamics and thermal expansion contributions.
 Parameters:
 nsamps = Number of samples to draw
 rng_seed = Seed value for the random number generator
+sample_chunksize = Number of samples to generate and write at a time
+encoding_profile = Optional name of the encoding profile of the output file
 pipeline_id = Unique identifier for the pipeline running this code
 
 Note that the value of 'nsamps' and 'rng_seed' are shared between the projection stage
@@ -33,6 +45,10 @@ def tlm_postprocess_oceandynamics(
     rng_seed,
     chunksize,
     output_lslr_file,
+    zarr_chunk_locations=None,
+    output_quantiles=None,
+    sample_chunksize=None,
+    encoding_profile=None,
 ):
     # Extract the relevant data
     targyears = my_config["targyears"]
@@ -41,18 +57,37 @@ def tlm_postprocess_oceandynamics(
     GCMprobscale = my_config["GCMprobscale"]
     no_correlation = my_config["no_correlation"]
 
+    # Quantiles across samples need every sample of a location at once.
+    if sample_chunksize is None or output_quantiles is not None:
+        sample_chunksize = nsamps
+
     # Read in the TE projections data file ------------------------
-    te_samps = xr.DataArray(
-        my_te_projections["thermsamps"],
-        dims=("samples", "years"),
-        coords=(np.arange(nsamps), targyears),
-    )
+    te_samps = my_te_projections["thermsamps"]
+    if not isinstance(te_samps, xr.DataArray):
+        te_samps = xr.DataArray(
+            te_samps,
+            dims=("samples", "years"),
+            coords=(np.arange(nsamps), targyears),
+        )
+    # Samples may be read lazily from a global SLR file. Statistics are
+    # reduced over fixed blocks of samples so they do not depend on the
+    # chunks samples are read in, or on whether they are in memory.
+    te_stats = te_samps.chunk({"samples": SAMPLE_BLOCK})
 
-    # Evenly sample quantile space and permutate
-    quantile_samps = np.linspace(0, 1, nsamps + 2)[1 : (nsamps + 1)]
-    rng = np.random.default_rng(rng_seed)
-    quantile_samps = rng.permutation(quantile_samps)
-    q = xr.DataArray(quantile_samps, dims=["samples"], coords=[np.arange(nsamps)])
+    # Standardized thermal expansion anomaly used to condition ocean dynamics.
+    te_anom = (te_samps - te_stats.mean(dim="samples")) / te_stats.std(dim="samples")
+    te_samps = te_samps.chunk({"samples": sample_chunksize})
+    te_anom = te_anom.chunk({"samples": sample_chunksize})
+
+    # Evenly sample quantile space and permutate. Quantiles are generated a
+    # chunk of samples at a time and only depend on the seed and sample index.
+    q = xr.DataArray(
+        dask.array.arange(nsamps, chunks=sample_chunksize).map_blocks(
+            _quantile_samples, rng_seed, nsamps, dtype=np.float64
+        ),
+        dims=["samples"],
+        coords=[np.arange(nsamps)],
+    )
 
     # Determine the thermal expansion scale coefficient
     ThermExpScale = norm.ppf(0.95) / norm.ppf(GCMprobscale)
@@ -80,44 +115,64 @@ def tlm_postprocess_oceandynamics(
         .chunk({"locations": chunksize})
     )
 
-    # Calculate the conditional mean and std dev if correlation is needed
-    if no_correlation:
-        condmean = od_fit["od_mean"]
-        condstd = ThermExpScale * od_fit["od_std"]
+    kernel_args = (
+        od_fit["od_mean"],
+        od_fit["od_std"],
+        od_fit["od_tecorr"],
+        od_fit["od_dof"],
+        q,
+        te_anom,
+        te_samps,
+    )
+    kernel_kwargs = {"therm_exp_scale": ThermExpScale, "no_correlation": no_correlation}
+
+    if output_quantiles is None:
+        # Generate the float32 samples in one fused pass per chunk of locations
+        # and samples. This avoids materializing the conditional mean, std dev,
+        # and ocean dynamic samples as separate full-size float64
+        # intermediates, and memory per task does not grow with nsamps.
+        samps = xr.apply_ufunc(
+            _sea_level_change_kernel,
+            *kernel_args,
+            kwargs=kernel_kwargs,
+            input_core_dims=[["years"]] * 4 + [[], ["years"], ["years"]],
+            output_core_dims=[["years"]],
+            dask="parallelized",
+            output_dtypes=[np.float32],
+        ).transpose("years", "locations", "samples")
+
+        samps.name = "sea_level_change"
+        samps.attrs = {"units": "mm"}
+        samps = samps.to_dataset()
     else:
-        condmean = od_fit["od_mean"] + od_fit["od_std"] * od_fit["od_tecorr"] * (
-            (te_samps - te_samps.mean(dim="samples")) / te_samps.std(dim="samples")
+        # Summarize each chunk of locations as soon as its samples are
+        # generated so the full sample cube is never written.
+        slc_q, slc_mean, slc_std = xr.apply_ufunc(
+            _sea_level_change_summary_kernel,
+            *kernel_args,
+            kwargs=kernel_kwargs | {"quantiles": output_quantiles},
+            input_core_dims=[["years"]] * 4
+            + [["samples"], ["samples", "years"], ["samples", "years"]],
+            output_core_dims=[["years", "quantiles"], ["years"], ["years"]],
+            dask="parallelized",
+            output_dtypes=[np.float32] * 3,
+            dask_gufunc_kwargs={"output_sizes": {"quantiles": len(output_quantiles)}},
         )
-        condstd = (
-            ThermExpScale * od_fit["od_std"] * np.sqrt(1 - od_fit["od_tecorr"] ** 2)
+        samps = xr.Dataset(
+            {
+                "sea_level_change": slc_q.transpose("quantiles", "years", "locations"),
+                "sea_level_change_mean": slc_mean.transpose("years", "locations"),
+                "sea_level_change_std": slc_std.transpose("years", "locations"),
+            },
+            coords={"quantiles": np.asarray(output_quantiles)},
         )
-
-    # Use `t.ppf()' to get ocean dynamic samples but it needs to work on
-    # chunked, dask-backed xarray Datasets/Arrays because the data we're
-    # working with is potentially larger than memory.
-    # We apply `constd` and `condmean` directly rather than use t.ppf()'s
-    # "loc" and "scale" args because this appears to scale and handle
-    # multiple chunked dimensions a bit more easily.
-    od_samps = (
-        xr.apply_ufunc(
-            lambda q, dof: t.ppf(q, dof),
-            q,
-            od_fit["od_dof"],
-            vectorize=True,
-            input_core_dims=[["samples"], []],
-            output_core_dims=[["samples"]],
-            dask="parallelized",
-            output_dtypes=[float],
+        for v in samps.data_vars:
+            samps[v].attrs = {"units": "mm"}
+        samps["sea_level_change_mean"].attrs["long_name"] = "Mean across samples"
+        samps["sea_level_change_std"].attrs["long_name"] = (
+            "Standard deviation across samples"
         )
-        * condstd
-        + condmean
-    )
 
-    samps = od_samps + te_samps
-
-    samps.name = "sea_level_change"
-    samps.attrs = {"units": "mm"}
-    samps = samps.to_dataset()
     samps.attrs = {
         "description": "Local SLR contributions from thermal expansion and dynamic sea-level according to Kopp 2014 CMIP6/TLM workflow",
         "history": "Created " + time.ctime(time.time()),
@@ -126,15 +181,240 @@ def tlm_postprocess_oceandynamics(
         "baseyear": baseyear,
     }
     # ∵ lat and lon were variables, not coords, in original code.
-    samps["lat"] = od_fit["lat"]
-    samps["lon"] = od_fit["lon"]
+    samps["lat"] = od_fit["lat"].astype("float32")
+    samps["lon"] = od_fit["lon"].astype("float32")
+
+    # Grid locations are gathered from the cells of a 2D grid, following the CF
+    # conventions for compression by gathering.
+    if my_zos.get("grid") is not None:
+        samps["grid_lat"] = (("y", "x"), my_zos["grid"]["grid_lat"].astype("float32"))
+        samps["grid_lon"] = (("y", "x"), my_zos["grid"]["grid_lon"].astype("float32"))
+        samps["grid_lat"].attrs = {"units": "degrees_north"}
+        samps["grid_lon"].attrs = {"units": "degrees_east"}
+        samps = samps.set_coords(["grid_lat", "grid_lon"])
+        samps["locations"].attrs["compress"] = "y x"
+
+    # Samples are generated as they are written
+    if is_zarr_path(output_lslr_file):
+        with span("write zarr", locations=samps.sizes["locations"]):
+            write_zarr(
+                samps,
+                output_lslr_file,
+                chunksize,
+                zarr_chunk_locations,
+                chunk_samples=sample_chunksize,
+                encoding_profile=encoding_profile,
+            )
+    else:
+        encoding = {}
+        if encoding_profile is not None:
+            write_chunks = {"locations": chunksize, "samples": sample_chunksize}
+            encoding = {
+                name: NetCDFEncoding(encoding_profile, da.dims, da.sizes, write_chunks)
+                for name, da in samps.data_vars.items()
+                if "locations" in da.dims and da.ndim >= 2
+            }
+        with span("write netcdf", locations=samps.sizes["locations"]):
+            samps.to_netcdf(output_lslr_file, encoding=encoding)
+
+
+def open_te_projections(path, nsamps, targyears, sample_chunksize=None):
+    """
+    Lazily open the thermal expansion samples of a global SLR file.
+
+    Returns a dict like the output of ``tlm_project_thermalexpansion``, with
+    ``thermsamps`` as a dask-backed float64 (samples, years) DataArray read
+    ``sample_chunksize`` samples at a time, to match the chunks of local
+    samples. The file must hold ``nsamps`` samples of the ``targyears``.
+    """
+    if sample_chunksize is None:
+        sample_chunksize = nsamps
+    ds = xr.open_dataset(path)
+    if "samples" not in ds.dims:
+        raise ValueError(f"{path} holds quantiles of global SLR, not samples")
+    if ds.sizes["samples"] != nsamps:
+        raise ValueError(
+            f"{path} holds {ds.sizes['samples']} samples, but nsamps is {nsamps}"
+        )
+    if not np.array_equal(ds["years"], targyears):
+        raise ValueError(f"Years in {path} do not match the projection years")
+
+    # Read whole stored chunks, then split them into chunks of local samples
+    te_samps = ds["sea_level_change"]
+    read_samples = sample_chunksize
+    stored_chunks = te_samps.encoding.get("chunksizes")
+    if stored_chunks is not None:
+        stored_samples = stored_chunks[te_samps.dims.index("samples")]
+        read_samples = -(-sample_chunksize // stored_samples) * stored_samples
+    te_samps = te_samps.chunk({"samples": read_samples, "years": -1}).chunk(
+        {"samples": sample_chunksize}
+    )
+
+    te_samps = te_samps.isel(locations=0, drop=True)
+    return {
+        "thermsamps": te_samps.astype(np.float64).transpose("samples", "years"),
+        "targyears": ds["years"].values,
+        "baseyear": ds.attrs["baseyear"],
+        "scenario": ds.attrs["scenario"],
+    }
+
+
+def is_zarr_path(path):
+    """Is output to ``path`` written as a Zarr store rather than NetCDF?"""
+    return str(path).rstrip("/").endswith(".zarr")
+
+
+def write_zarr(
+    samps,
+    path,
+    chunksize,
+    chunk_locations=None,
+    chunk_samples=None,
+    encoding_profile=None,
+):
+    """
+    Write localized projections to a Zarr store.
+
+    Zarr chunks of ``sea_level_change`` hold all years and samples (or
+    quantiles) for ``chunk_locations`` locations so downstream steps can
+    cheaply read single locations. If ``chunk_locations`` is smaller than
+    ``chunksize``, chunks are grouped into shards of ``chunksize`` locations.
+    If samples are generated ``chunk_samples`` at a time, chunks and shards
+    only hold that many samples. Either way, each dask chunk maps onto whole
+    Zarr chunks or shards, so chunks are written in parallel without locking.
+    An ``encoding_profile`` only sets the compression of the chunks. Metadata
+    is consolidated once all chunks are written.
+    """
+    if chunk_locations is None:
+        chunk_locations = chunksize
+    if chunksize % chunk_locations != 0:
+        raise ValueError(
+            f"chunksize ({chunksize}) must be a multiple of the Zarr chunk locations ({chunk_locations})"
+        )
+
+    encoding = {}
+    for name, da in samps.data_vars.items():
+        if "locations" not in da.dims or da.ndim < 2:
+            continue
+        sizes = dict(da.sizes)
+        if chunk_samples is not None and "samples" in sizes:
+            sizes["samples"] = chunk_samples
+        encoding[name] = {
+            "chunks": tuple(
+                chunk_locations if d == "locations" else sizes[d] for d in da.dims
+            )
+        }
+        if chunk_locations < chunksize:
+            encoding[name]["shards"] = tuple(
+                chunksize if d == "locations" else sizes[d] for d in da.dims
+            )
+        if encoding_profile is not None:
+            encoding[name]["compressors"] = ZarrCompressors(encoding_profile)
+
+    # Metadata is consolidated once, after every chunk is written, so readers
+    # can open the store with xr.open_zarr's defaults. Zarr warns that
+    # consolidated metadata is not yet in the Zarr format 3 specification,
+    # but xarray and zarr-python read it.
+    with warnings.catch_warnings():
+        warnings.filterwarnings(
+            "ignore", message="Consolidated metadata", category=UserWarning
+        )
+        samps.to_zarr(path, mode="w", encoding=encoding, consolidated=True)
+
+
+def _quantile_samples(samples, seed, nsamps):
+    """Evenly spaced quantiles of a chunk of sample indices, randomly permuted"""
+    perm = SamplePermutation(seed, QUANTILE_STREAM, nsamps, samples[0], samples[-1] + 1)
+    return (perm + 1) / (nsamps + 1)
+
+
+def _sea_level_change_kernel(*args, **kwargs):
+    """
+    Local sea-level change for a block of locations and samples.
+
+    Takes the arguments of ``_generate_samples`` with the ocean dynamics fit
+    arrays broadcast against samples. Returns float32 local sea-level change
+    with shape (locations, samples, years).
+    """
+    return np.moveaxis(_generate_samples(*args, **kwargs), 1, 2)
+
+
+@traced("generate samples")
+def _generate_samples(
+    od_mean,
+    od_std,
+    od_tecorr,
+    od_dof,
+    q,
+    te_anom,
+    te_samps,
+    therm_exp_scale,
+    no_correlation,
+):
+    """
+    Fused sample generation for a block of locations and samples.
+
+    Ocean dynamics fit arrays are (locations, ..., years). Quantile draws are
+    (..., samples) and the thermal expansion samples and their standardized
+    anomaly are (..., samples, years). Returns float32 local sea-level change
+    with shape (locations, years, samples). Output is cast down to float32
+    because this data can be very large and doesn't need the extra precision.
+    Scratch memory is bounded by a single (locations, samples) year slice.
+    """
+    nyears = od_mean.shape[-1]
+    (od_mean, od_std, od_tecorr, od_dof) = (
+        a.reshape(-1, nyears) for a in (od_mean, od_std, od_tecorr, od_dof)
+    )
+    q = q.reshape(-1)
+    te_anom = te_anom.reshape(-1, nyears).astype(np.float32)
+    te_samps = te_samps.reshape(-1, nyears).astype(np.float32)
+    nlocs = od_mean.shape[0]
+
+    # Conditional mean and std dev coefficients are small (locations, years).
+    if no_correlation:
+        condstd = therm_exp_scale * od_std
+        te_coef = None
+    else:
+        condstd = therm_exp_scale * od_std * np.sqrt(1 - od_tecorr**2)
+        te_coef = (od_std * od_tecorr).astype(np.float32)
+    condstd = condstd.astype(np.float32)
+    od_mean = od_mean.astype(np.float32)
+
+    # DOF are integer model counts, so a block only has a handful of unique
+    # values. Evaluate t.ppf() once per unique DOF and gather from that table.
+    dof_values, dof_idx = np.unique(od_dof, return_inverse=True)
+    dof_idx = dof_idx.reshape(od_dof.shape)
+    tq = t.ppf(q[np.newaxis, :], dof_values[:, np.newaxis]).astype(np.float32)
+
+    out = np.empty((nlocs, nyears, q.size), dtype=np.float32)
+    for j in range(nyears):
+        block = out[:, j, :]
+        np.take(tq, dof_idx[:, j], axis=0, out=block)
+        block *= condstd[:, j, np.newaxis]
+        block += od_mean[:, j, np.newaxis]
+        if te_coef is not None:
+            block += te_coef[:, j, np.newaxis] * te_anom[np.newaxis, :, j]
+        block += te_samps[np.newaxis, :, j]
+
+    return out
+
 
-    # Casting down to float32 because this data can be very large.
-    # Casting float64 -> float32 reduces size by half and don't need
-    # extra precision anyways.
-    samps = samps.astype("float32")
+def _sea_level_change_summary_kernel(*args, quantiles, **kwargs):
+    """
+    Quantiles, mean, and std dev across samples for a block of locations.
 
-    samps.to_netcdf(output_lslr_file)
+    Takes the same arguments as ``_generate_samples``. Quantiles are exact,
+    sorting the samples generated for the block. Returns float32 arrays with
+    shapes (locations, years, quantiles), (locations, years), and
+    (locations, years).
+    """
+    samps = _generate_samples(*args, **kwargs)
+    samps_mean = samps.mean(axis=-1, dtype=np.float64).astype(np.float32)
+    samps_std = samps.std(axis=-1, dtype=np.float64).astype(np.float32)
+    # Samples are discarded after this so they can be partitioned in place.
+    samps_q = np.quantile(samps, quantiles, axis=-1, overwrite_input=True)
+    samps_q = np.moveaxis(samps_q, 0, -1).astype(np.float32)
+    return samps_q, samps_mean, samps_std
 
 
 if __name__ == "__main__":
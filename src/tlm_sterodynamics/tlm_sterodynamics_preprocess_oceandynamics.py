@@ -1,3 +1,4 @@
+import logging
 import numpy as np
 import os
 import sys
@@ -11,8 +12,10 @@ import cftime
 from netCDF4 import Dataset
 
 # from DriftCorr import DriftCorr
-from tlm_sterodynamics.read_locationfile import ReadLocationFile
-from tlm_sterodynamics.Smooth import Smooth
+from tlm_sterodynamics.read_locationfile import LocationShard, ReadLocationFile
+from tlm_sterodynamics.grid_locations import GridLocations
+from tlm_sterodynamics.Smooth import NanSmooth
+from tlm_sterodynamics.fit_store import FitStoreKey, LoadFitStore, MatchSites
 
 """ tlm_preprocess_oceandynamics.py
 
@@ -25,10 +28,16 @@ modeldir = Directory that contains the ZOS and ZOSTOGA CMIP6 model data
 driftcorr = Apply the drift correction?
 locationfilename = File that contains points for localization
 pipeline_id = Unique identifier for the pipeline running this code
+location_shard = Optional (shard index, number of shards) pair of locations to process
+fit_store = Optional directory of stored per-site fits. Only sites missing from it are localized.
+model_store = Optional directory of stored per-model localized ZOS. Models are only read for sites missing from it.
+location_grid = Optional (coarsen, coastal_band) pair. Sites are then the ocean cells of the ZOS grid instead of locationfilename.
 
 
 """
 
+logger = logging.getLogger(__name__)
+
 
 def FindInputModels(tasdir, zosdir, scenario):
     # Acceptable SSP scenarios
@@ -74,7 +83,7 @@ def FindInputModels(tasdir, zosdir, scenario):
 
     else:
         # This is an invalid scenario
-        raise Exception("Invalid scenario definition: {}".format(scenario))
+        raise ValueError("Invalid scenario definition: {}".format(scenario))
 
     return (include_models, include_scenarios)
 
@@ -198,6 +207,10 @@ def tlm_preprocess_oceandynamics(
     locationfilename,
     baseyear,
     pipeline_id,
+    location_shard=None,
+    fit_store=None,
+    model_store=None,
+    location_grid=None,
 ):
     # Define variables
     datayears = np.arange(1861, 2301)
@@ -240,11 +253,7 @@ def tlm_preprocess_oceandynamics(
     )
 
     # Center, suture, and smooth ZOSTOGA
-    sZOSTOGA = np.nan * ZOSTOGA
-    for i in np.arange(0, ZOSTOGA.shape[1]):
-        (ZOSTOGA[:, i], sZOSTOGA[:, i]) = SmoothZOSTOGA(
-            ZOSTOGA[:, i], datayears, baseyear, smoothwin
-        )
+    (ZOSTOGA, sZOSTOGA) = SmoothZOSTOGA(ZOSTOGA, datayears, baseyear, smoothwin)
 
     # Store the configuration in a pickle
     output_config = {
@@ -269,11 +278,66 @@ def tlm_preprocess_oceandynamics(
 
     # ------------ Begin Ocean Dynamics ---------------------------------------------------
 
-    # Load the site locations
-    locationfile = os.path.join(os.path.dirname(__file__), locationfilename)
-    (_, focus_site_ids, focus_site_lats, focus_site_lons) = ReadLocationFile(
-        locationfile
-    )
+    # Load the site locations, either from the location file or the ocean cells
+    # of the ZOS grid
+    if location_grid is None:
+        grid = None
+        locationfile = os.path.join(os.path.dirname(__file__), locationfilename)
+        (_, focus_site_ids, focus_site_lats, focus_site_lons) = ReadLocationFile(
+            locationfile, shard=location_shard
+        )
+    else:
+        (coarsen, coastal_band) = location_grid
+        (_, focus_site_ids, focus_site_lats, focus_site_lons, grid) = GridLocations(
+            zos_modeldir,
+            include_models,
+            coarsen=coarsen,
+            coastal_band=coastal_band,
+        )
+        if location_shard is not None:
+            shard_idx = LocationShard(len(focus_site_ids), *location_shard)
+            focus_site_ids = focus_site_ids[shard_idx]
+            focus_site_lats = focus_site_lats[shard_idx]
+            focus_site_lons = focus_site_lons[shard_idx]
+        logger.info(
+            "Using {} locations on a {} x {} grid".format(
+                len(focus_site_ids), *grid["grid_lat"].shape
+            )
+        )
+
+    # Only localize and fit sites that are not already in the fit store
+    if fit_store is None:
+        od_fit_store = None
+        fit_site_idx = np.arange(len(focus_site_ids))
+    else:
+        store_settings = {
+            "scenario": scenario,
+            "datayears": datayears.tolist(),
+            "smoothwin": smoothwin,
+            "baseyear": int(baseyear),
+            "driftcorr": bool(driftcorr),
+            "no_correlation": bool(no_correlation),
+            "maxDOF": int(maxDOF),
+        }
+        if location_grid is not None:
+            store_settings["grid"] = list(location_grid)
+        store_key = FitStoreKey(
+            modeldir, include_models, include_scenarios, store_settings
+        )
+        stored = LoadFitStore(fit_store, store_key)
+        stored_idx = MatchSites(stored, focus_site_lats, focus_site_lons)
+        fit_site_idx = np.flatnonzero(stored_idx < 0)
+        logger.info(
+            "Found {} of {} sites in fit store".format(
+                len(focus_site_ids) - len(fit_site_idx), len(focus_site_ids)
+            )
+        )
+        od_fit_store = {
+            "dir": fit_store,
+            "key": store_key,
+            "stored": stored,
+            "stored_idx": stored_idx,
+        }
 
     # Load the ZOS data
     (zos_modellist, zos_scenariolist, ZOS_raw) = IncludeCMIP6ZOSModels(
@@ -282,8 +346,11 @@ def tlm_preprocess_oceandynamics(
         datayears,
         include_models,
         include_scenarios,
-        focus_site_lats,
-        focus_site_lons,
+        focus_site_lats[fit_site_idx],
+        focus_site_lons[fit_site_idx],
+        model_store=model_store,
+        grid=grid,
+        focus_sites_ids=focus_site_ids[fit_site_idx],
     )
 
     # Find the overlap between ZOS and ZOSTOGA
@@ -313,24 +380,13 @@ def tlm_preprocess_oceandynamics(
         ZOS = ZOS_raw
 
     # Smooth ZOS and ZOSTOGA over 19 year smoothing window
-    def nanSmooth(x, w):
-        idx = np.flatnonzero(~np.isnan(x))
-        temp = x
-        if len(idx) > 0:
-            temp[idx] = Smooth(x[idx], w)
-        return temp
-
-    sZOS = np.apply_along_axis(nanSmooth, axis=0, arr=ZOS, w=smoothwin)
-    sZOSTOGAadj = np.apply_along_axis(nanSmooth, axis=0, arr=ZOSTOGAadj, w=smoothwin)
+    sZOS = NanSmooth(ZOS, smoothwin)
+    sZOSTOGAadj = NanSmooth(ZOSTOGAadj, smoothwin)
 
     # Center the smoothed ZOS/ZOSTOGAadj to the baseyear
     baseyear_idx = np.flatnonzero(datayears == baseyear)
-    sZOS = np.apply_along_axis(
-        lambda z, idx: z - z[idx], axis=0, arr=sZOS, idx=baseyear_idx
-    )
-    sZOSTOGAadj = np.apply_along_axis(
-        lambda z, idx: z - z[idx], axis=0, arr=sZOSTOGAadj, idx=baseyear_idx
-    )
+    sZOS -= sZOS[baseyear_idx]
+    sZOSTOGAadj -= sZOSTOGAadj[baseyear_idx]
 
     # Store the ZOS variable in a pickle
     output_zos = {
@@ -343,6 +399,10 @@ def tlm_preprocess_oceandynamics(
         "focus_site_lons": focus_site_lons,
         "sZOSTOGAadj": sZOSTOGAadj,
         "comb_modellist": comb_modellist,
+        "fit_store": od_fit_store,
+        "grid": None
+        if grid is None
+        else {"grid_lat": grid["grid_lat"], "grid_lon": grid["grid_lon"]},
     }
 
     return output_config, output_zostoga, output_zos
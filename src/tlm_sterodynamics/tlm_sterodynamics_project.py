@@ -4,6 +4,9 @@ import os
 import argparse
 import time
 from netCDF4 import Dataset
+from tlm_sterodynamics.encoding import NetCDFEncoding
+from tlm_sterodynamics.random_streams import EXPCOEF_STREAM, SampleNormal
+from tlm_sterodynamics.tracing import span
 
 """ tlm_project_oceandynamics.py
 
@@ -13,9 +16,11 @@ Localized projections for ocean dynamics are done in post-processing to remain c
 with the other module in this module set.
 
 Parameters:
-nsamps = Numer of samples to produce
+nsamps = Numer of samples to produce, from the first 'nsamps' climate samples
 seed = Seed for the random number generator
 pipeline_id = Unique identifier for the pipeline running this code
+block_size = Number of samples to project and write at a time
+encoding_profile = Optional name of the encoding profile of the output file
 
 Note that the value of 'nsamps' and 'seed' are passed to both the projection stage and
 post-processing stage when run within FACTS.
@@ -37,6 +42,9 @@ def tlm_project_thermalexpansion(
     pyear_step,
     baseyear,
     output_gslr_file,
+    output_quantiles=None,
+    block_size=None,
+    encoding_profile=None,
 ):
     """
     # Load the configuration file
@@ -56,9 +64,6 @@ def tlm_project_thermalexpansion(
     # baseyear = my_config["baseyear"]
     targyears = np.arange(pyear_start, pyear_end + 1, pyear_step)
 
-    # Set the RNG seed
-    rng = np.random.default_rng(seed)
-
     ohc_samps = preprocessed_data["ohc_samps"]
     scenario = preprocessed_data["scenario"]
     data_years = preprocessed_data["data_years"]
@@ -67,36 +72,27 @@ def tlm_project_thermalexpansion(
     std_expcoefs = fit_data["std_expcoefs"]
     include_models = fit_data["include_models"]
 
-    # Generate indices that sample from OHC values
+    # Generate indices that sample from OHC values. The first nsamps climate
+    # samples are projected.
     # ohc_samps_idx = rng.choice(np.arange(ohc_samps.shape[0]), nsamps)
-    ohc_samps_idx = np.arange(ohc_samps.shape[0])
-    ohc_samps = ohc_samps[ohc_samps_idx, :]
-
-    # Generate samples assuming normal distribution
-    expcoef_samps = rng.normal(loc=mean_expcoefs, scale=std_expcoefs, size=(nsamps, 1))
+    if nsamps > ohc_samps.shape[0]:
+        raise ValueError(
+            f"nsamps is {nsamps}, but there are only {ohc_samps.shape[0]} climate samples"
+        )
+    ohc_samps_idx = np.arange(nsamps)
 
-    # Produce the projection samples
-    gte_samps = ohc_samps * expcoef_samps
-
-    # Center these samples on the baseyear
     baseyear_idx = np.flatnonzero(data_years == baseyear)
-    gte_samps = gte_samps - gte_samps[:, baseyear_idx]
+    targyear_idx = np.flatnonzero(np.isin(data_years, targyears))
 
-    # Subset the samples for the projection years
-    targyear_idx = np.isin(data_years, targyears)
-    gte_samps = gte_samps[:, targyear_idx]
+    # Project samples in blocks, if requested, to bound memory use.
+    if block_size is None:
+        block_size = nsamps
 
-    # Invert the dimensions of the variable and convert from m to mm
-    gte_samps *= 1000.0
-
-    # Save the projections to a pickle
-    output = {
-        "thermsamps": gte_samps,
-        "targyears": targyears,
-        "baseyear": baseyear,
-        "include_models": include_models,
-        "scenario": scenario,
-    }
+    # Full set of projection samples are only kept to summarize across
+    # samples. Otherwise post-processing reads them back from the output file.
+    gte_samps = None
+    if output_quantiles is not None:
+        gte_samps = np.empty((nsamps, len(targyear_idx)))
 
     # Write the total global projections to a netcdf file
     rootgrp = Dataset(output_gslr_file, "w", format="NETCDF4")
@@ -104,24 +100,56 @@ def tlm_project_thermalexpansion(
     # Define Dimensions
     nyr = len(targyears)
     _ = rootgrp.createDimension("years", nyr)
-    _ = rootgrp.createDimension("samples", nsamps)
+    if output_quantiles is None:
+        _ = rootgrp.createDimension("samples", nsamps)
+    else:
+        _ = rootgrp.createDimension("quantiles", len(output_quantiles))
     _ = rootgrp.createDimension("locations", 1)
 
     # Populate dimension variables
     year_var = rootgrp.createVariable("years", "i4", ("years",))
-    samp_var = rootgrp.createVariable("samples", "i8", ("samples",))
+    if output_quantiles is None:
+        samp_var = rootgrp.createVariable("samples", "i8", ("samples",))
+    else:
+        q_var = rootgrp.createVariable("quantiles", "f8", ("quantiles",))
     loc_var = rootgrp.createVariable("locations", "i8", ("locations",))
     lat_var = rootgrp.createVariable("lat", "f4", ("locations",))
     lon_var = rootgrp.createVariable("lon", "f4", ("locations",))
 
+    # Encoding of the data variables
+    sizes = {"years": nyr, "locations": 1, "samples": nsamps}
+    if output_quantiles is not None:
+        sizes["quantiles"] = len(output_quantiles)
+
+    def encoding(dims, default):
+        if encoding_profile is None:
+            return default
+        return NetCDFEncoding(encoding_profile, dims, sizes, {"samples": block_size})
+
     # Create a data variable
-    samps = rootgrp.createVariable(
-        "sea_level_change",
-        "f4",
-        ("samples", "years", "locations"),
-        zlib=True,
-        complevel=4,
-    )
+    if output_quantiles is None:
+        dims = ("samples", "years", "locations")
+        samps = rootgrp.createVariable(
+            "sea_level_change",
+            "f4",
+            dims,
+            **encoding(dims, {"zlib": True, "complevel": 4}),
+        )
+    else:
+        dims = ("quantiles", "years", "locations")
+        samps = rootgrp.createVariable(
+            "sea_level_change",
+            "f4",
+            dims,
+            **encoding(dims, {"zlib": True, "complevel": 4}),
+        )
+        dims = ("years", "locations")
+        samps_mean = rootgrp.createVariable(
+            "sea_level_change_mean", "f4", dims, **encoding(dims, {})
+        )
+        samps_std = rootgrp.createVariable(
+            "sea_level_change_std", "f4", dims, **encoding(dims, {})
+        )
 
     # Assign attributes
     rootgrp.description = "Global SLR contribution from Thermal Expansion according to Two-Layer Model workflow"
@@ -134,8 +162,47 @@ def tlm_project_thermalexpansion(
 
     # Put the data into the netcdf variables
     year_var[:] = targyears
-    samp_var[:] = np.arange(nsamps)
-    samps[:, :, :] = gte_samps[:, :, np.newaxis]
+    if output_quantiles is None:
+        samp_var[:] = np.arange(nsamps)
+
+    for start in range(0, nsamps, block_size):
+        stop = min(start + block_size, nsamps)
+
+        # Generate samples assuming normal distribution. Draws only depend on
+        # the seed and sample index, so they do not depend on block_size.
+        expcoef_samps = SampleNormal(seed, EXPCOEF_STREAM, start, stop)[:, np.newaxis]
+        expcoef_samps = mean_expcoefs + std_expcoefs * expcoef_samps
+
+        # Only gather the baseyear and projection year OHC samples. Projecting
+        # every year since 1750 and subsetting afterwards needs several
+        # (samples, all years) temporary arrays.
+        block_idx = ohc_samps_idx[start:stop]
+        ohc_base = ohc_samps[np.ix_(block_idx, baseyear_idx)]
+        ohc_targ = ohc_samps[np.ix_(block_idx, targyear_idx)]
+
+        # Produce the projection samples, centered on the baseyear
+        gte_block = ohc_targ * expcoef_samps
+        gte_block -= ohc_base * expcoef_samps
+
+        # Convert from m to mm
+        gte_block *= 1000.0
+
+        if output_quantiles is None:
+            with span("write netcdf", samples=stop - start):
+                samps[start:stop, :, 0] = gte_block
+        if gte_samps is not None:
+            gte_samps[start:stop] = gte_block
+
+    if output_quantiles is not None:
+        # Only write a summary across samples.
+        q_var[:] = output_quantiles
+        samps[:, :, 0] = np.quantile(gte_samps, output_quantiles, axis=0)
+        samps_mean.units = "mm"
+        samps_mean.long_name = "Mean across samples"
+        samps_mean[:, 0] = np.mean(gte_samps, axis=0)
+        samps_std.units = "mm"
+        samps_std.long_name = "Standard deviation across samples"
+        samps_std[:, 0] = np.std(gte_samps, axis=0)
     lat_var[:] = np.inf
     lon_var[:] = np.inf
     loc_var[:] = -1
@@ -143,6 +210,20 @@ def tlm_project_thermalexpansion(
     # Close the netcdf
     rootgrp.close()
 
+    # Samples kept in memory are rounded to the float32 of a samples output
+    # file, so post-processing gets the same input either way.
+    if gte_samps is not None:
+        gte_samps = gte_samps.astype(np.float32).astype(np.float64)
+
+    # Save the projections to a pickle
+    output = {
+        "thermsamps": gte_samps,
+        "targyears": targyears,
+        "baseyear": baseyear,
+        "include_models": include_models,
+        "scenario": scenario,
+    }
+
     return output
 
 
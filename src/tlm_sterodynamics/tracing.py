@@ -0,0 +1,123 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+""" tracing.py
+
+Lightweight spans around the hot paths of reading, localizing, and writing data,
+exported as a Chrome trace event file. Traces open in Perfetto
+(https://ui.perfetto.dev) or chrome://tracing.
+
+Parameters:
+trace_file = Path of the JSON trace file to write
+
+Tracing is off unless enable() is called. span() then returns a shared no-op
+context manager, so spans cost a single check. Spans in dask worker processes
+are not recorded, only those in this process and its threads.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+# Recorded events, or None when tracing is off
+_events = None
+_origin_ns = 0
+
+_NO_SPAN = nullcontext()
+
+
+class _Span:
+    __slots__ = ("name", "cat", "args", "start_ns")
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end_ns = time.perf_counter_ns()
+        event = {
+            "name": self.name,
+            "cat": self.cat,
+            "ph": "X",
+            "ts": (self.start_ns - _origin_ns) / 1000,
+            "dur": (end_ns - self.start_ns) / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        if self.args:
+            event["args"] = self.args
+        # Appending to a list is atomic, so threads can record spans
+        _events.append(event)
+        return False
+
+
+def enable():
+    """Start recording spans"""
+    global _events, _origin_ns
+    _events = []
+    _origin_ns = time.perf_counter_ns()
+
+
+def is_enabled():
+    return _events is not None
+
+
+def span(name, cat="tlm", **args):
+    """
+    Context manager recording a span named ``name`` if tracing is on.
+
+    Keyword arguments are shown with the span, so they should be cheap and
+    JSON serializable.
+    """
+    if _events is None:
+        return _NO_SPAN
+    return _Span(name, cat, args)
+
+
+def traced(name, cat="tlm"):
+    """Decorator recording a span around each call if tracing is on"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _events is None:
+                return func(*args, **kwargs)
+            with _Span(name, cat, {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def write_trace(path):
+    """Write recorded spans to ``path`` as a Chrome trace event file"""
+    if _events is None:
+        return
+
+    thread_names = {t.ident: t.name for t in threading.enumerate()}
+    metadata = [
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": {"name": thread_names.get(tid, str(tid))},
+        }
+        for tid in sorted({event["tid"] for event in _events})
+    ]
+    with open(path, "w") as f:
+        json.dump(
+            {"traceEvents": metadata + _events, "displayTimeUnit": "ms"},
+            f,
+        )
+    logger.info(f"Wrote {len(_events)} trace spans to {path}")
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+from synthetic import make_synthetic_inputs  # noqa: E402
+
+""" conftest.py
+
+Fixtures shared by the tests. Synthetic inputs are written once per session
+with the benchmark input generator, on a coarse grid so full runs are quick.
+
+"""
+
+TEST_INPUTS = {
+    "nmodels": 6,
+    "nlat": 18,
+    "nlon": 36,
+    "nsamps": 40,
+    "nlocations": 8,
+    "scenario": "ssp585",
+    "seed": 0,
+}
+
+
+@pytest.fixture(scope="session")
+def synthetic_inputs(tmp_path_factory):
+    return make_synthetic_inputs(
+        str(tmp_path_factory.mktemp("synthetic")), **TEST_INPUTS
+    )
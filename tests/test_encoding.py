@@ -0,0 +1,29 @@
+import pytest
+
+from tlm_sterodynamics.encoding import ChunkShape
+
+""" test_encoding.py
+
+Checks the chunk shapes of the encoding profiles.
+
+"""
+
+DIMS = ("years", "locations", "samples")
+SIZES = {"years": 29, "locations": 100, "samples": 2000}
+
+
+@pytest.mark.parametrize(
+    "profile, sample_chunksize, expected",
+    [
+        ("fast", None, (29, 7, 2000)),
+        ("fast", 500, (29, 7, 500)),
+        ("compact", None, (29, 1, 2000)),
+        ("compact", 500, (29, 1, 500)),
+        ("archive", None, (1, 7, 2000)),
+        ("archive", 500, (1, 7, 500)),
+        ("archive", 5000, (1, 7, 2000)),
+    ],
+)
+def test_chunk_shape(profile, sample_chunksize, expected):
+    write_chunks = {"locations": 7, "samples": sample_chunksize}
+    assert ChunkShape(profile, DIMS, SIZES, write_chunks) == expected
@@ -0,0 +1,262 @@
+import numpy as np
+import pytest
+
+from tlm_sterodynamics import tlm_sterodynamics_fit_oceandynamics as fit_od
+
+""" test_fit_oceandynamics.py
+
+Checks the blocked and vectorized ocean dynamics fit against reference copies
+of the original whole-array and per-site code, on inputs with missing models
+and years, sites with fewer than 7 models, and extreme models.
+
+"""
+
+DATAYEARS = np.arange(1991, 2301)
+NMODELS = 12
+NSITES = 12
+
+
+def fit_inputs(seed=0):
+    """ZOS (years, models, sites), ZOSTOGA, and adjusted ZOSTOGA (years, models)"""
+    rng = np.random.default_rng(seed)
+    nyears = len(DATAYEARS)
+    t = ((DATAYEARS - 1990) / 100)[:, np.newaxis, np.newaxis]
+    rate = rng.normal(0.1, 0.05, (1, NMODELS, NSITES))
+    zos = rate * t**2 + rng.normal(0, 0.01, (nyears, NMODELS, NSITES))
+
+    # Spread across models beyond the 0.2 standard deviation limit
+    zos[:, :, 5:7] *= 10
+    # Extreme models, over 10x the median and over 3 standard deviations
+    zos[:, 0, 5] *= 50
+    zos[:, 1, 6] += 30 * t[:, 0, 0]
+    # Fewer than 7 models, and fewer than 5 models in every year
+    zos[:, 5:, 1] = np.nan
+    zos[:, 4:, 2] = np.nan
+    # Models ending before or starting after the 2061-2100 window
+    zos[DATAYEARS > 2150, 3:, 3] = np.nan
+    zos[DATAYEARS < 2050, 4:, 4] = np.nan
+    zos[DATAYEARS > 2120, 8:, 4] = np.nan
+    # No models at all
+    zos[:, :, 8] = np.nan
+    # Missing years scattered across models
+    zos[:, :, 9:][rng.random((nyears, NMODELS, 3)) < 0.4] = np.nan
+    zos[np.isin(DATAYEARS, [2080, 2099]), :6, 10] = np.nan
+
+    zostoga = rate[0, :, 0] * t[:, 0, :] ** 2 * 0.3
+    zostoga[DATAYEARS > 2200, 4:] = np.nan
+    zostoga_adj = zostoga + rng.normal(0, 0.005, zostoga.shape)
+    zostoga_adj[rng.random(zostoga.shape) < 0.05] = np.nan
+    return (zos, zostoga, zostoga_adj)
+
+
+def reference_interp(
+    x, xp, fp, extrap=False, right=np.nan, left=np.nan, no_neg_rate=False
+):
+    """Original interpolation/extrapolation of a single site"""
+    sort_idx = np.argsort(xp)
+    temp_xp = xp[sort_idx]
+    temp_fp = fp[sort_idx]
+    delta_idx = np.flatnonzero(np.logical_and(temp_xp > 2060, temp_xp <= 2100))
+    extrap_delta = np.mean(np.diff(temp_fp[delta_idx]) / np.diff(temp_xp[delta_idx]))
+    if extrap_delta < 0.0 and no_neg_rate:
+        extrap_delta = 0.0
+
+    def pointwise(x):
+        if x < temp_xp[0]:
+            return temp_fp[0] + (x - temp_xp[0]) * extrap_delta
+        if x > temp_xp[-1]:
+            return temp_fp[-1] + (x - temp_xp[-1]) * extrap_delta
+        else:
+            return np.interp(x, temp_xp, temp_fp)
+
+    if extrap:
+        return np.array(list(map(pointwise, x)))
+    else:
+        return np.interp(x, xp, fp, left=left, right=right)
+
+
+def reference_stats(sZOS, sZOSTOGAadj, year_idx, year_2099_idx, no_correlation):
+    """Original ocean dynamics statistics, over every site at once"""
+    sZOS = sZOS[year_idx, :, :]
+    extremeness_model_check = np.sum(~np.isnan(sZOS[year_2099_idx, :, :]), axis=1) < 7
+    ext_num = np.abs(sZOS[year_2099_idx, :, :])
+    ext_denom = np.nanmedian(np.abs(sZOS[year_2099_idx, :, :]), axis=1)
+    extremeness = ext_num / ext_denom
+    with np.errstate(invalid="ignore"):
+        model_idx = extremeness < 10
+    nan_mask = np.where(np.logical_or(model_idx, extremeness_model_check), 1.0, np.nan)
+    sZOS = sZOS * nan_mask
+
+    ext_num = sZOS[year_2099_idx, :, :] - np.nanmean(sZOS[year_2099_idx, :, :], axis=1)
+    ext_denom = np.nanstd(sZOS[year_2099_idx, :, :], axis=1)
+    extremeness = np.abs(ext_num / ext_denom)
+    std_limit = np.where(ext_denom < 0.2, 1, 0)
+    with np.errstate(invalid="ignore"):
+        model_idx = extremeness < 3
+    nan_mask = np.where(
+        np.logical_or(model_idx, np.logical_or(extremeness_model_check, std_limit)),
+        1.0,
+        np.nan,
+    )
+    sZOS = sZOS * nan_mask
+
+    OceanDynMean = np.nanmean(sZOS, axis=1) * 1000.0
+    OceanDynStd = np.nanstd(sZOS, axis=1) * 1000.0
+    OceanDynN = np.nansum(~np.isnan(sZOS), axis=1)
+
+    if no_correlation:
+        OceanDynTECorr = 0.0
+    else:
+        zos_demean = sZOS - np.nanmean(sZOS, axis=1)[:, np.newaxis, :]
+        zostoga_demean = sZOSTOGAadj - np.nanmean(sZOSTOGAadj, axis=1)[:, np.newaxis]
+        corr_num = np.nansum(zos_demean * zostoga_demean[:, :, np.newaxis], axis=1)
+        corr_denom = np.sqrt(
+            np.nansum(zos_demean**2, axis=1)
+            * np.nansum(zostoga_demean**2, axis=1)[:, np.newaxis]
+        )
+        OceanDynTECorr = corr_num / corr_denom
+    return (OceanDynMean, OceanDynStd, OceanDynN, OceanDynTECorr)
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+@pytest.mark.parametrize("no_correlation", [False, True])
+@pytest.mark.parametrize("block_sites", [1, 5, NSITES])
+def test_ocean_dyn_stats(monkeypatch, no_correlation, block_sites):
+    (zos, _, zostoga_adj) = fit_inputs()
+    year_idx = np.flatnonzero((DATAYEARS > 2000) & (DATAYEARS <= 2300))
+    year_2099_idx = np.flatnonzero(DATAYEARS[year_idx] == 2099)
+    monkeypatch.setattr(
+        fit_od, "STATS_BLOCK_BYTES", block_sites * len(year_idx) * NMODELS * 8
+    )
+
+    expected = reference_stats(
+        zos, zostoga_adj[year_idx], year_idx, year_2099_idx, no_correlation
+    )
+    result = fit_od.OceanDynStats(
+        zos, zostoga_adj[year_idx], year_idx, year_2099_idx, no_correlation
+    )
+    for name, res, exp in zip(("mean", "std", "n", "corr"), result, expected):
+        np.testing.assert_allclose(res, exp, rtol=1e-12, atol=1e-9, err_msg=name)
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+@pytest.mark.parametrize(
+    "extrap, no_neg_rate", [(False, False), (True, False), (True, True)]
+)
+def test_my_interp(extrap, no_neg_rate):
+    rng = np.random.default_rng(1)
+    years = DATAYEARS[DATAYEARS > 2000]
+    nyears = len(years)
+    fp = rng.normal(0, 1, (nyears, 8)).cumsum(axis=0)
+    good = rng.random((nyears, 8)) < 0.5
+    # Good years only inside, before, or after the 2061-2100 window, a single
+    # good year in it, and a single good year overall
+    good[:, 1] = (years > 2070) & (years < 2090)
+    good[:, 2] = years < 2080
+    good[:, 3] = years > 2085
+    good[:, 4] = (years < 2050) | (years == 2075) | (years > 2200)
+    good[:, 5] = years == 2150
+    # Columns with the same good years share an extrapolation rate
+    good[:, 7] = good[:, 6]
+
+    result = fit_od.MyInterp(years, fp, good, extrap=extrap, no_neg_rate=no_neg_rate)
+    for i in np.arange(fp.shape[1]):
+        good_idx = np.flatnonzero(good[:, i])
+        replace_idx = np.flatnonzero(~good[:, i])
+        expected = reference_interp(
+            years[replace_idx],
+            years[good_idx],
+            fp[good_idx, i],
+            extrap=extrap,
+            right=fp[good_idx[-1], i],
+            no_neg_rate=no_neg_rate,
+        )
+        np.testing.assert_allclose(
+            result[replace_idx, i], expected, rtol=1e-12, atol=1e-9, err_msg=str(i)
+        )
+        np.testing.assert_array_equal(result[good_idx, i], fp[good_idx, i])
+
+
+def reference_site_loop(years, mean, std, n, corr, maxDOF):
+    """Original per-site interpolation/extrapolation of the OD statistics"""
+    dof = np.copy(n)
+    mean[n == 0] = np.nan
+    corr[np.isnan(corr)] = 0.0
+    for i in np.arange(n.shape[1]):
+        temp_good_idx = np.flatnonzero(n[:, i] >= 5)
+        if len(temp_good_idx) > 0:
+            temp_replace_idx = np.flatnonzero(n[:, i] <= 5)
+            dof[temp_replace_idx, i] = n[temp_good_idx[-1], i]
+            corr[temp_replace_idx, i] = reference_interp(
+                years[temp_replace_idx],
+                years[temp_good_idx],
+                corr[temp_good_idx, i],
+                right=corr[temp_good_idx[-1], i],
+            )
+            std[temp_replace_idx, i] = reference_interp(
+                years[temp_replace_idx],
+                years[temp_good_idx],
+                std[temp_good_idx, i],
+                extrap=True,
+                right=std[temp_good_idx[-1], i],
+                no_neg_rate=True,
+            )
+            mean[temp_replace_idx, i] = reference_interp(
+                years[temp_replace_idx],
+                years[temp_good_idx],
+                mean[temp_good_idx, i],
+                extrap=True,
+                right=mean[temp_good_idx[-1], i],
+            )
+        else:
+            std[:, i] = 0.0
+            mean[:, i] = np.nan
+            corr[:, i] = 0.0
+    corr = np.maximum(-1.0, np.minimum(1.0, corr))
+    dof -= 1
+    dof[dof > maxDOF] = maxDOF
+    dof[dof < 1] = 1
+    return (mean, std, dof, corr)
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_fit_matches_per_site_loop():
+    (zos, zostoga, zostoga_adj) = fit_inputs()
+    year_idx = np.flatnonzero((DATAYEARS > 2000) & (DATAYEARS <= 2300))
+    year_2099_idx = np.flatnonzero(DATAYEARS[year_idx] == 2099)
+    years = DATAYEARS[year_idx]
+
+    (te_fit, od_fit) = fit_od.tlm_fit_oceandynamics(
+        {"datayears": DATAYEARS, "no_correlation": False, "maxDOF": 8},
+        {"sZOSTOGA": zostoga},
+        {
+            "sZOS": zos,
+            "sZOSTOGAadj": zostoga_adj,
+            "focus_site_ids": np.arange(NSITES),
+        },
+        "test",
+    )
+
+    (mean, std, n, corr) = reference_stats(
+        zos, zostoga_adj[year_idx], year_idx, year_2099_idx, False
+    )
+    (mean, std, dof, corr) = reference_site_loop(years, mean, std, n, corr, 8)
+    for name, exp in zip(("Mean", "Std", "DOF", "TECorr"), (mean, std, dof, corr)):
+        np.testing.assert_allclose(
+            od_fit["OceanDyn" + name], exp, rtol=1e-12, atol=1e-9, err_msg=name
+        )
+    np.testing.assert_array_equal(od_fit["OceanDynN"], n)
+
+    # Thermal expansion is a single site with models missing after 2200
+    (mean, std, dof, _) = reference_site_loop(
+        years,
+        np.nanmean(zostoga[year_idx, :], axis=1)[:, np.newaxis] * 1000,
+        np.nanstd(zostoga[year_idx, :], axis=1)[:, np.newaxis] * 1000,
+        np.sum(~np.isnan(zostoga[year_idx, :]), axis=1)[:, np.newaxis],
+        np.zeros((len(years), 1)),
+        8,
+    )
+    for name, exp in zip(("Mean", "Std", "DOF"), (mean, std, dof)):
+        np.testing.assert_allclose(
+            te_fit["ThermExp" + name], exp[:, 0], rtol=1e-12, atol=1e-9, err_msg=name
+        )
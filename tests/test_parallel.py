@@ -0,0 +1,46 @@
+import pytest
+
+from tlm_sterodynamics.parallel import (
+    CHUNK_MEMORY_FRACTION,
+    auto_chunksizes,
+    chunk_memory,
+    location_memory,
+)
+
+""" test_parallel.py
+
+Checks that chunk sizes picked from a memory limit fill, but do not exceed,
+the memory budget of each task.
+
+"""
+
+GiB = 2**30
+
+
+@pytest.mark.parametrize(
+    "memory_limit, nlocations, nsamps, nyears, ntasks",
+    [
+        (1 * GiB, 10000, 20000, 9, 4),
+        (16 * GiB, 100000, 2000, 29, 8),
+        (4 * GiB, 50000, 100000, 29, 1),
+        (256 * 2**20, 1000, 2237, 29, 2),
+    ],
+)
+def test_auto_chunksizes_fill_budget(memory_limit, nlocations, nsamps, nyears, ntasks):
+    budget = memory_limit * CHUNK_MEMORY_FRACTION / ntasks
+    (chunksize, sample_chunksize) = auto_chunksizes(
+        memory_limit, nlocations, nsamps, nyears, ntasks
+    )
+    used = chunk_memory(chunksize, sample_chunksize or nsamps, nyears)
+    assert used <= budget
+    # Within one more location, or one more sample of every location
+    if sample_chunksize is None:
+        assert used + location_memory(nsamps, nyears) > budget
+    else:
+        assert chunk_memory(chunksize, sample_chunksize + 1, nyears) > budget
+
+
+def test_auto_chunksizes_keep_every_task_busy():
+    (chunksize, sample_chunksize) = auto_chunksizes(64 * GiB, 100, 2000, 29, 8)
+    assert chunksize == 13
+    assert sample_chunksize is None
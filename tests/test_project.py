@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from tlm_sterodynamics.tlm_sterodynamics_project import tlm_project_thermalexpansion
+
+""" test_project.py
+
+Checks which climate samples the thermal expansion projection uses.
+
+"""
+
+DATA_YEARS = np.arange(1750, 2301)
+
+
+@pytest.fixture
+def te_inputs():
+    rng = np.random.default_rng(0)
+    t = np.clip(DATA_YEARS - 1850, 0, None) / 250
+    preprocessed = {
+        "ohc_samps": rng.lognormal(0, 0.25, (50, 1)) * t**2,
+        "scenario": "ssp585",
+        "data_years": DATA_YEARS,
+    }
+    fit = {"mean_expcoefs": 0.115, "std_expcoefs": 0.01, "include_models": ["A"]}
+    return (preprocessed, fit)
+
+
+def project(te_inputs, nsamps, path):
+    (preprocessed, fit) = te_inputs
+    tlm_project_thermalexpansion(
+        preprocessed, fit, 1234, nsamps, "test", "ssp585", 2020, 2100, 10, 2005, path
+    )
+    return xr.open_dataset(path).sea_level_change.load()
+
+
+def test_nsamps_uses_first_climate_samples(te_inputs, tmp_path):
+    every = project(te_inputs, 50, tmp_path / "every.nc")
+    first = project(te_inputs, 30, tmp_path / "first.nc")
+    np.testing.assert_array_equal(first, every.isel(samples=slice(0, 30)))
+
+
+def test_nsamps_above_climate_samples(te_inputs, tmp_path):
+    with pytest.raises(ValueError, match="only 50 climate samples"):
+        project(te_inputs, 60, tmp_path / "gslr.nc")
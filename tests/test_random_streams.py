@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from tlm_sterodynamics.random_streams import (
+    EXPCOEF_STREAM,
+    QUANTILE_STREAM,
+    SAMPLE_BLOCK,
+    SampleNormal,
+    SamplePermutation,
+)
+
+""" test_random_streams.py
+
+Checks that permutations are permutations for any number of samples, and that
+draws for any split of the samples concatenate to the draws for all of them.
+
+"""
+
+SEED = 1234
+
+
+def splits(n, rng):
+    """Split points of [0, n) around block edges, with empty first and last ranges"""
+    points = {0, n // 2, n}
+    for edge in np.arange(SAMPLE_BLOCK, n, SAMPLE_BLOCK):
+        points.update([edge - 1, edge, edge + 1])
+    points.update(rng.integers(0, n + 1, 5).tolist())
+    return [0] + sorted(points) + [n]
+
+
+@pytest.mark.parametrize("n", [1, 2, 3, 4, 5, 17, 4096, 4097, 20000])
+def test_sample_permutation_is_permutation(n):
+    perm = SamplePermutation(SEED, QUANTILE_STREAM, n, 0, n)
+    np.testing.assert_array_equal(np.sort(perm), np.arange(n))
+
+
+@pytest.mark.parametrize("n", [1, 3, 4097, 20000])
+def test_sample_permutation_splits(n):
+    full = SamplePermutation(SEED, QUANTILE_STREAM, n, 0, n)
+    points = splits(n, np.random.default_rng(n))
+    parts = [
+        SamplePermutation(SEED, QUANTILE_STREAM, n, start, stop)
+        for (start, stop) in zip(points[:-1], points[1:])
+    ]
+    np.testing.assert_array_equal(np.concatenate(parts), full)
+
+
+@pytest.mark.parametrize("n", [1, 3, 4095, 4096, 4097, 20000])
+def test_sample_normal_splits(n):
+    full = SampleNormal(SEED, EXPCOEF_STREAM, 0, n)
+    points = splits(n, np.random.default_rng(n))
+    parts = [
+        SampleNormal(SEED, EXPCOEF_STREAM, start, stop)
+        for (start, stop) in zip(points[:-1], points[1:])
+    ]
+    np.testing.assert_array_equal(np.concatenate(parts), full)
+    # Draws do not depend on how many samples follow
+    np.testing.assert_array_equal(
+        SampleNormal(SEED, EXPCOEF_STREAM, 0, 2 * n + 1)[:n], full
+    )
+
+
+def test_streams_differ():
+    assert not np.array_equal(
+        SampleNormal(SEED, EXPCOEF_STREAM, 0, 100),
+        SampleNormal(SEED, QUANTILE_STREAM, 0, 100),
+    )
+    assert not np.array_equal(
+        SamplePermutation(SEED, QUANTILE_STREAM, 100, 0, 100),
+        SamplePermutation(SEED + 1, QUANTILE_STREAM, 100, 0, 100),
+    )
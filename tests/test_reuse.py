@@ -0,0 +1,59 @@
+import numpy as np
+import xarray as xr
+from click.testing import CliRunner
+
+from tlm_sterodynamics.cli import main
+
+""" test_reuse.py
+
+Checks that localizing from a reused global SLR file gives exactly the local
+samples of a single run.
+
+"""
+
+
+def run(synthetic_inputs, gslr_file, lslr_file, *args):
+    result = CliRunner().invoke(
+        main,
+        [
+            "--pipeline-id=test",
+            "--scenario=ssp585",
+            "--nsamps=40",
+            "--pyear-end=2100",
+            "--chunksize=3",
+            "--scheduler=synchronous",
+            "--model-dir={}".format(synthetic_inputs["model_dir"]),
+            "--location-file={}".format(synthetic_inputs["location_file"]),
+            "--output-gslr-file={}".format(gslr_file),
+            "--output-lslr-file={}".format(lslr_file),
+            *args,
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    with xr.open_dataset(lslr_file) as ds:
+        return ds["sea_level_change"].load()
+
+
+def test_reuse_matches_single_run(synthetic_inputs, tmp_path):
+    gslr_file = tmp_path / "gslr.nc"
+    single = run(
+        synthetic_inputs,
+        gslr_file,
+        tmp_path / "single.nc",
+        "--climate-data-file={}".format(synthetic_inputs["climate_data_file"]),
+        "--expansion-coefficients-file={}".format(
+            synthetic_inputs["expansion_coefficients_file"]
+        ),
+        "--gsat-rmses-file={}".format(synthetic_inputs["gsat_rmses_file"]),
+    )
+    assert np.isfinite(single.values).all()
+    for sample_chunksize in ("7", "40"):
+        reused = run(
+            synthetic_inputs,
+            gslr_file,
+            tmp_path / "reused.nc",
+            "--reuse-gslr-file",
+            "--sample-chunksize={}".format(sample_chunksize),
+        )
+        np.testing.assert_array_equal(reused.values, single.values)
@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+
+from tlm_sterodynamics.Smooth import NanSmooth, Smooth
+from tlm_sterodynamics.SmoothZOSTOGA import SmoothZOSTOGA
+
+""" test_smooth.py
+
+Checks the batched smoothing against the original per-column smoothing, on
+columns with leading, trailing, and interior NaN values.
+
+"""
+
+YEARS = np.arange(1980, 2101)
+
+
+def nan_columns(shape, seed=0):
+    """Random walks (years, ...) with every kind of NaN run in some columns"""
+    rng = np.random.default_rng(seed)
+    x = rng.normal(0, 1, (len(YEARS),) + shape).cumsum(axis=0)
+    x2 = x.reshape(len(YEARS), -1)
+    x2[:10, 0] = np.nan
+    x2[-7:, 1] = np.nan
+    x2[:3, 2] = np.nan
+    x2[-20:, 2] = np.nan
+    x2[50:53, 3] = np.nan
+    x2[:, 4] = np.nan
+    # Columns sharing a NaN pattern are smoothed together
+    x2[:10, 5] = np.nan
+    x2[:, 6:][rng.random((len(YEARS), x2.shape[1] - 6)) < 0.2] = np.nan
+    return x
+
+
+def reference_nan_smooth(x, w):
+    """Original smoothing of each column without its NaN values"""
+
+    def nanSmooth(x, w):
+        idx = np.flatnonzero(~np.isnan(x))
+        temp = x
+        if len(idx) > 0:
+            temp[idx] = Smooth(x[idx], w)
+        return temp
+
+    return np.apply_along_axis(nanSmooth, axis=0, arr=np.copy(x), w=w)
+
+
+def reference_smooth_zostoga(ZOSTOGA, years, baseyear, smoothwin):
+    """Original suturing and smoothing of a single model"""
+    ZOSTOGA = np.copy(ZOSTOGA)
+    sZOSTOGA = np.nan * ZOSTOGA
+    temp1 = years <= (baseyear + 10)
+    temp2 = years >= (baseyear - 10)
+    center_inds = np.flatnonzero(temp1 * temp2)
+    good_inds = center_inds[np.flatnonzero(~np.isnan(ZOSTOGA[center_inds]))]
+    if len(good_inds) > 0:
+        ZOSTOGA = ZOSTOGA - np.mean(ZOSTOGA[good_inds])
+    syear_ind = np.flatnonzero(years == 2007)[0]
+    diffa = ZOSTOGA[syear_ind] - ZOSTOGA[syear_ind - 1]
+    diffb = ZOSTOGA[syear_ind - 2] - ZOSTOGA[syear_ind - 1]
+    if np.abs(diffa) > 20 * np.abs(diffb):
+        offset = diffa - diffb
+        ZOSTOGA[syear_ind:] = ZOSTOGA[syear_ind:] - offset
+    good_inds = np.nonzero(~np.isnan(ZOSTOGA))[0]
+    if len(good_inds) > 0:
+        sZOSTOGA[good_inds] = Smooth(ZOSTOGA[good_inds], smoothwin)
+    sZOSTOGA = sZOSTOGA - sZOSTOGA[np.flatnonzero(years == baseyear)]
+    return (ZOSTOGA, sZOSTOGA)
+
+
+@pytest.mark.parametrize("w", [3, 5, 19])
+@pytest.mark.parametrize("shape", [(), (12,), (4, 5)])
+def test_nan_smooth(w, shape):
+    if shape == ():
+        x = nan_columns((8,))[:, 0]
+    else:
+        x = nan_columns(shape)
+    before = np.copy(x)
+    result = NanSmooth(x, w)
+    np.testing.assert_array_equal(x, before)
+    if shape == ():
+        expected = reference_nan_smooth(x[:, np.newaxis], w)[:, 0]
+    else:
+        expected = reference_nan_smooth(x, w)
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(x))
+    np.testing.assert_allclose(result, expected, rtol=1e-13, atol=1e-13)
+
+
+def test_smooth_zostoga():
+    zostoga = nan_columns((10,), seed=1) / 100
+    year_2007 = np.flatnonzero(YEARS == 2007)[0]
+    # Sutured models, one with leading and one with trailing NaN values, and a
+    # jump too small to count as a suture
+    zostoga[year_2007:, 0] += 5.0
+    zostoga[year_2007:, 1] -= 3.0
+    diffb = zostoga[year_2007 - 2, 3] - zostoga[year_2007 - 1, 3]
+    zostoga[year_2007:, 3] += 19 * np.abs(diffb) - (
+        zostoga[year_2007, 3] - zostoga[year_2007 - 1, 3]
+    )
+    # No values near the baseyear to center on
+    zostoga[:40, 9] = np.nan
+    before = np.copy(zostoga)
+
+    (result, sresult) = SmoothZOSTOGA(zostoga, YEARS, 2005, 19)
+    np.testing.assert_array_equal(zostoga, before)
+    # Only the sutured models have their later years shifted
+    shift = (before - result)[year_2007] - (before - result)[year_2007 - 1]
+    np.testing.assert_array_equal(np.abs(shift) > 1e-12, np.arange(10) < 2)
+    for i in np.arange(zostoga.shape[1]):
+        (expected, sexpected) = reference_smooth_zostoga(zostoga[:, i], YEARS, 2005, 19)
+        np.testing.assert_allclose(result[:, i], expected, rtol=1e-13, atol=1e-13)
+        np.testing.assert_allclose(sresult[:, i], sexpected, rtol=1e-13, atol=1e-13)
+
+    # A single model as a vector
+    (result, sresult) = SmoothZOSTOGA(zostoga[:, 0], YEARS, 2005, 19)
+    (expected, sexpected) = reference_smooth_zostoga(zostoga[:, 0], YEARS, 2005, 19)
+    np.testing.assert_allclose(result, expected, rtol=1e-13, atol=1e-13)
+    np.testing.assert_allclose(sresult, sexpected, rtol=1e-13, atol=1e-13)